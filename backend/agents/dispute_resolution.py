@@ -1,31 +1,121 @@
 from models import DisputeSubmission, Evidence
-import vertexai
-from vertexai.generative_models import GenerativeModel
-import os
-from dotenv import load_dotenv
-import asyncio
 import json
-from db import get_split_chat_history  # Import the helper function
+import time
+import metrics
+from db_async import AsyncSessionLocal, unit_of_work, get_split_chat_records, update_evidence_metadata, claim_funds_release
+from video_analysis import analyze_video  # Import the video analysis function
+from llm_client import get_llm_client
+from model_cascade import ModelCascade, parse_confidence
+from llm_resilience import LLMUnavailableError
+from prompt_budget import ChatPromptBudget, PROMPT_TOKEN_BUDGET, estimate_tokens, observe_prompt, observe_latency
 
-load_dotenv()
+def evidence_metadata(evidence) -> dict:
+    """
+    Returns the metadata of either a pydantic Evidence or an EvidenceDB row
+    (where it lives in the "evidence_metadata" column).
+    """
+    if hasattr(evidence, "evidence_metadata"):
+        return evidence.evidence_metadata or {}
+    return evidence.metadata or {}
 
-PROJECT_ID = os.environ.get("PROJECT_ID")
-vertexai.init(project=PROJECT_ID, location="us-central1")
+# Streamed chat replies are plain text for the user followed by a decision line,
+# so the text can be shown while it is generated and the decision parsed at the end.
+DECISION_MARKER = "DECISION:"
 
-from video_analysis import analyze_video  # Import the video analysis function
-from db import update_evidence_metadata  # Import the function to update evidence metadata
+def parse_streamed_decision(output: str) -> dict:
+    """
+    Parses the complete output of resolve_from_chat_stream into status, reason
+    and requires_human_review. Also accepts a bare JSON answer in the
+    resolve_from_chat format. Anything unparseable is escalated.
+    """
+    text, _, decision = output.partition(DECISION_MARKER)
+    try:
+        if decision:
+            parsed = json.loads(decision.strip().strip("`").strip())
+            parsed["reason"] = text.strip()
+        else:
+            parsed = json.loads(output.strip().strip("`").removeprefix("json").strip())
+        status = parsed.get("status", "escalated")
+        return {
+            "status": status,
+            "reason": parsed.get("reason", ""),
+            "requires_human_review": bool(parsed.get("requires_human_review", status == "escalated")),
+        }
+    except (ValueError, AttributeError):
+        return {"status": "escalated", "reason": text.strip(), "requires_human_review": True}
+
+def parse_text_decision(response_text: str) -> dict:
+    """
+    Parses the free-text answer of DisputeResolver.resolve.
+    In a real application, you would parse the response more carefully,
+    potentially using a structured output format (e.g., JSON) from the LLM.
+    Here, we'll do a simple text-based parsing.
+    """
+    text_response = response_text.lower()
+    if "approved" in text_response:
+        status = "approved"
+    elif "rejected" in text_response:
+        status = "rejected"
+    else:
+        status = "escalated"
+    return {"status": status, "reason": response_text, "confidence": parse_confidence(response_text)}
+
+def _degraded_resolution(error: Exception) -> dict:
+    """Rules-only outcome when the model was unavailable (shed, timed out or failing): a human decides."""
+    metrics.incr("dispute.decided_by.rules_degraded")
+    return {
+        "status": "escalated",
+        "reason": f"Model unavailable, escalated for human review: {error}",
+        "requires_human_review": True,
+        "degraded": True,
+    }
 
 class DisputeResolver:
     def __init__(self):
-        self.model = GenerativeModel("gemini-2.0-flash-001")
+        self.llm = get_llm_client("gemini-2.0-flash-001")
+        # Dispute decisions (resolve, finalize_resolution) go to the fast model first
+        # and only uncertain or high-value disputes reach the strong model.
+        self.cascade = ModelCascade("dispute", default_model="gemini-2.0-flash-001")
+        # Fits chat history into the prompt token budget; older overflow is summarized by the same model.
+        self.chat_budget = ChatPromptBudget(summarizer=self.llm)
 
-    async def resolve(self, dispute: DisputeSubmission, evidence: Evidence = None) -> dict:
+    async def analyze_evidence(self, evidence: Evidence = None):
+        """
+        Runs the model-based analysis for the given evidence, if its type has one.
+        Returns the analysis text for video evidence and None otherwise.
+        """
+        if not evidence or evidence.file_type != "video":
+            return None
+        try:
+            video_result = await analyze_video(evidence.file_url, evidence.content_hash)
+            # Update evidence metadata with video analysis result if possible
+            if hasattr(evidence, "id") and evidence.id is not None:
+                async with unit_of_work() as session:
+                    await update_evidence_metadata(session, evidence.id, {"analysis_result": video_result})
+            else:
+                # If no id is available, update the metadata in-memory
+                evidence.metadata["analysis_result"] = video_result
+        except Exception as e:
+            video_result = f"Video analysis error: {e}"
+        return video_result
+
+    async def resolve(
+        self,
+        dispute: DisputeSubmission,
+        evidence: Evidence = None,
+        evidence_analysis: str = None,
+        chat_records: list = None,
+    ) -> dict:
         """
         Resolves a dispute using AI analysis.
 
         Args:
             dispute: The dispute submission details.
             evidence: Optional evidence provided.
+            evidence_analysis: Result of analyze_evidence, if it was already run
+                (otherwise the evidence is analyzed here).
+            chat_records: Optional chat history records (db_async.get_split_chat_records),
+                fitted into the prompt token budget.
 
         Returns:
             A dictionary representing the resolution.  Includes:
@@ -44,17 +134,9 @@ class DisputeResolver:
         Additional Information: {dispute.additional_info or 'No additional information provided.'}
         """
         if evidence and evidence.file_type == "video":
-            try:
-                loop = asyncio.get_running_loop()
-                video_result = await loop.run_in_executor(None, analyze_video, evidence.file_url)
-                # Update evidence metadata with video analysis result if possible
-                if hasattr(evidence, "id") and evidence.id is not None:
-                    await loop.run_in_executor(None, update_evidence_metadata, evidence.id, {"analysis_result": video_result})
-                else:
-                    # If no id is available, update the metadata in-memory
-                    evidence.metadata["analysis_result"] = video_result
-            except Exception as e:
-                video_result = f"Video analysis error: {e}"
+            video_result = evidence_analysis
+            if video_result is None:
+                video_result = await self.analyze_evidence(evidence)
             prompt += f"""
             Analyse this video evidence: {evidence.file_url} and extract important details like bank account information to help next steps in verification that the user made the right transfer to the right account.
             Analyse the behaviours and actions of the individual in the video to detect any suspicious activity.
@@ -64,36 +146,34 @@ class DisputeResolver:
             Analyse this pdf evidence: {evidence.file_url} and extract important details like bank account information to help next steps in verification that the user made the right transfer to the right account.
             """
 
-        prompt += """
+        instructions = """
         Based on this information, determine whether the dispute should be:
 
         - Approved (in favor of the submitter)
         - Rejected (in favor of the other party)
         - Escalated (requires human review)
 
-        Provide a concise reason for your decision.
+        Provide a concise reason for your decision, then end with a line
+        "Confidence: <number between 0 and 1>".
         """
 
         try:
-            response = self.model.generate_content(prompt)
-            # In a real application, you would parse the response more carefully,
-            # potentially using a structured output format (e.g., JSON) from the LLM.
-            # Here, we'll do a simple text-based parsing.
-            text_response = response.text.lower()
-
-            if "approved" in text_response:
-                status = "approved"
-            elif "rejected" in text_response:
-                status = "rejected"
-            else:
-                status = "escalated"
+            if chat_records:
+                chat_section, _ = await self._chat_section(dispute, chat_records, prompt + instructions, "prompt.resolve")
+                prompt += "\n" + chat_section + "\n"
+            prompt += instructions
+            result = await self._decide(prompt, "prompt.resolve", parse_text_decision, dispute)
+            status = result["status"]
 
             return {
                 "status": status,
-                "reason": response.text,  # Full text for now
-                "requires_human_review": status == "escalated"
+                "reason": result["reason"],  # Full text for now
+                "requires_human_review": status == "escalated",
+                "model_tier": result["model_tier"],
             }
 
+        except LLMUnavailableError as e:
+            return _degraded_resolution(e)
         except Exception as e:
             print(f"Error during dispute resolution: {e}")
             return {
@@ -123,19 +203,67 @@ class DisputeResolver:
         {{"status": "approved", "reason": "Concise explanation", "requires_human_review": false}}.
         """
         try:
-            loop = asyncio.get_running_loop()
-            response = await loop.run_in_executor(None, self.model.generate_content, prompt)
-            result = json.loads(response.text)
+            response_text = await self.llm.generate(prompt)
+            result = json.loads(response_text)
             return result
+        except LLMUnavailableError as e:
+            return _degraded_resolution(e)
         except Exception as e:
             return {"status": "escalated", "reason": f"AI resolution failed: {e}", "requires_human_review": True}
 
-    async def finalize_resolution(self, dispute: DisputeSubmission, evidence: Evidence = None) -> dict:
+    async def resolve_from_chat_stream(self, chat_context: str):
+        """
+        Streaming variant of resolve_from_chat. Yields {"type": "delta", "text": ...}
+        events with the reply as the model writes it, then one {"type": "result", ...}
+        event with the status, reason and requires_human_review parsed from the
+        complete output.
+        """
+        prompt = f"""
+        You are an AI dispute resolution assistant. Given the following context from a dispute chat conversation,
+        analyze the conversation and reply to the user with a resolution suggestion and guidance on next steps.
+
+        Context:
+        {chat_context}
+
+        Write your reply to the user as plain text. Then, on a final line of its own, write
+        {DECISION_MARKER} {{"status": "approved", "requires_human_review": false}}
+        where status is "approved", "escalated" or "evidence_requested".
+        """
+        output = ""
+        emitted = 0
+        try:
+            async for chunk in self.llm.generate_stream(prompt):
+                output += chunk
+                if output.lstrip().startswith("{"):
+                    continue  # a bare JSON answer; its reason is sent with the result
+                marker_at = output.find(DECISION_MARKER)
+                # Hold back a possible partial marker at the end of the output.
+                safe_end = marker_at if marker_at >= 0 else max(len(output) - len(DECISION_MARKER) + 1, emitted)
+                if safe_end > emitted:
+                    yield {"type": "delta", "text": output[emitted:safe_end]}
+                    emitted = safe_end
+        except LLMUnavailableError as e:
+            yield {"type": "result", **_degraded_resolution(e)}
+            return
+        except Exception as e:
+            yield {"type": "result", "status": "escalated", "reason": f"AI resolution failed: {e}", "requires_human_review": True}
+            return
+
+        result = parse_streamed_decision(output)
+        if emitted == 0 and result["reason"]:
+            yield {"type": "delta", "text": result["reason"]}
+        elif output.find(DECISION_MARKER) < 0 and len(output) > emitted:
+            yield {"type": "delta", "text": output[emitted:]}
+        yield {"type": "result", **result}
+
+    async def finalize_resolution(self, dispute: DisputeSubmission, evidence: Evidence = None, chat_records: list = None) -> dict:
         """
         Finalizes the dispute resolution workflow by integrating all available information.
         This method gathers:
           - Dispute details.
-          - Pre-dispute and post-dispute chat histories fetched from the database.
+          - Pre-dispute and post-dispute chat histories (fetched from the database
+            unless the caller already loaded them and passes them as `chat_records`),
+            fitted into the prompt token budget.
           - Evidence metadata (if available).
 
         The AI model returns a final judgement in JSON format:
@@ -143,8 +271,10 @@ class DisputeResolver:
         
         If the confidence is below a predefined threshold, the dispute is escalated for human review.
         """
-        # Retrieve chat history using the helper function
-        pre_dispute_chat, post_dispute_chat = get_split_chat_history(dispute.id, dispute.created_at)
+        # Retrieve chat history using the helper function, unless it was passed in
+        if chat_records is None:
+            async with AsyncSessionLocal() as session:
+                chat_records = await get_split_chat_records(session, dispute.id, dispute.created_at)
         
         prompt = f"""
         You are the final dispute resolution AI. Consolidate all available data to reach a final decision.
@@ -154,22 +284,21 @@ class DisputeResolver:
         Dispute Type: {dispute.dispute_type}
         Amount: {dispute.amount} {dispute.currency}
         Additional Information: {dispute.additional_info or "None"}
-
-        Pre-Dispute Chat History:
-        {pre_dispute_chat}
-
-        Post-Dispute Chat History:
-        {post_dispute_chat}
         """
+        tail = ""
         if evidence:
-            prompt += f"\nEvidence Metadata: {json.dumps(evidence.metadata)}"
-        prompt += """
+            tail += f"\nEvidence Metadata: {json.dumps(evidence_metadata(evidence), default=str)}"
+        tail += """
         Based on the above information, please provide your final judgement in the format:
         {"status": "approved", "reason": "Explanation", "confidence": <number between 0 and 1>}
         """
         try:
-            response = self.model.generate_content(prompt)
-            result = json.loads(response.text)
+            chat_section, chat_stats = await self._chat_section(dispute, chat_records, prompt + tail, "prompt.finalize")
+            prompt += "\n" + chat_section + "\n" + tail
+            result = await self._decide(prompt, "prompt.finalize", json.loads, dispute)
+            if chat_stats["summary_degraded"]:
+                # Decided on the extractive fallback summary; not memoized, so a later call retries.
+                result["degraded"] = True
             # Define the confidence threshold below which human review is required.
             CONFIDENCE_THRESHOLD = 0.8
             if result.get("confidence", 0) < CONFIDENCE_THRESHOLD:
@@ -178,16 +307,44 @@ class DisputeResolver:
                 result["requires_human_review"] = True
             else:
                 if result.get("status") == "approved":
-                    await self._release_funds(dispute)
+                    await self._release_funds(dispute, dispute.id)
             return result
+        except LLMUnavailableError as e:
+            return {**_degraded_resolution(e), "failed": True}
         except Exception as e:
-            return {"status": "escalated", "reason": f"Final resolution failed: {e}", "requires_human_review": True}
+            return {"status": "escalated", "reason": f"Final resolution failed: {e}", "requires_human_review": True, "failed": True}
+
+    async def _chat_section(self, dispute, chat_records: list, fixed_prompt: str, name: str):
+        """Renders the chat history in whatever is left of PROMPT_TOKEN_BUDGET after the rest of the prompt."""
+        available = max(PROMPT_TOKEN_BUDGET - estimate_tokens(fixed_prompt), 0)
+        cache_key = str(getattr(dispute, "id", None) or dispute.transaction_id)
+        return await self.chat_budget.render(chat_records, available, dispute=dispute, cache_key=cache_key, name=name)
+
+    async def _decide(self, prompt: str, name: str, parse, dispute) -> dict:
+        # Records prompt size and latency per size bucket, to relate latency to prompt length.
+        tokens = observe_prompt(name, prompt)
+        started = time.perf_counter()
+        try:
+            return await self.cascade.generate(prompt, parse, dispute.dispute_type, dispute.amount)
+        finally:
+            observe_latency(name, tokens, (time.perf_counter() - started) * 1000)
 
-    async def _release_funds(self, dispute: DisputeSubmission):
+    async def _release_funds(self, dispute: DisputeSubmission, dispute_id: int) -> bool:
         # Placeholder for fund release logic.  This would interact with a
         # payment gateway or internal accounting system.
+        # The dispute is first moved to "resolved" atomically, so funds are released
+        # at most once however often it is processed or finalized. Without a
+        # persisted dispute to claim, nothing is released.
+        if dispute_id is None:
+            print(f"Not releasing funds for transaction {dispute.transaction_id}: no persisted dispute to claim.")
+            return False
+        async with unit_of_work() as session:
+            claimed = await claim_funds_release(session, dispute_id)
+        if not claimed:
+            print(f"Funds for transaction {dispute.transaction_id} were already released; skipping.")
+            return False
         print(f"Funds released for transaction {dispute.transaction_id}")
-        pass  # Replace with actual implementation
+        return True  # Replace with actual implementation
 
     async def _escalate_to_human(self, dispute: DisputeSubmission, reason: str):
         # Placeholder for escalating to a human agent.  This might involve
@@ -1,20 +1,38 @@
 # agents/fraud_detection.py
 import os
-import vertexai
-from vertexai.generative_models import GenerativeModel
-from dotenv import load_dotenv
+import json
+import metrics
 from models import ChatMessage
-from typing import List
+from typing import List, Optional
+from model_cascade import ModelCascade, parse_confidence
+from llm_resilience import LLMUnavailableError
+from agents.fraud_prevention import FraudDetector
+from db_async import AsyncSessionLocal, unit_of_work, get_conversation_fraud_state, save_conversation_fraud_state
+
+# "incremental" keeps a rolling per-conversation summary and only sends new messages;
+# "full" re-sends the whole conversation window on every analysis.
+FRAUD_ANALYSIS_MODE = os.getenv("FRAUD_ANALYSIS_MODE", "incremental")
+# In incremental mode, every Nth analysis of a conversation re-checks the full
+# history window instead of just the new messages (0 disables full re-checks).
+FRAUD_FULL_RECHECK_EVERY = int(os.getenv("FRAUD_FULL_RECHECK_EVERY", "10"))
+# Cap on the stored rolling summary, in characters.
+FRAUD_SUMMARY_MAX_CHARS = int(os.getenv("FRAUD_SUMMARY_MAX_CHARS", "2000"))
+
+
+def _format_messages(messages: List[ChatMessage]) -> str:
+    return "\n".join(
+        f"Sender: {msg.sender_id}, Receiver: {msg.receiver_id}, Message: {msg.message}" for msg in messages
+    )
 
-load_dotenv()
-PROJECT_ID = os.environ.get("PROJECT_ID")
-vertexai.init(project=PROJECT_ID, location="us-central1")
 
 class ChatFraudDetector:
     def __init__(self):
-        self.model = GenerativeModel("gemini-1.5-pro-002")
+        # The fast model screens conversations first; only uncertain ones reach the strong model.
+        self.cascade = ModelCascade("fraud", default_model="gemini-1.5-pro-002")
+        # Rules-only fallback for when the model is unavailable (shed, timed out or failing).
+        self.keyword_screen = FraudDetector()
 
-    def analyze_chat(self, messages: List[ChatMessage]) -> dict:
+    async def analyze_chat(self, messages: List[ChatMessage]) -> dict:
         """
         Analyzes a chat message for potential fraud, considering the history.
 
@@ -30,23 +48,156 @@ class ChatFraudDetector:
             return {"is_fraudulent": False, "reason": "No messages to analyze."}
 
         # Construct the prompt, including the conversation history.
-        prompt = "Analyze the following chat conversation for potential fraud:\n\n"
-        for msg in messages:
-            prompt += f"Sender: {msg.sender_id}, Receiver: {msg.receiver_id}, Message: {msg.message}\n"
+        prompt = (
+            "Analyze the following chat conversation for potential fraud:\n\n"
+            + _format_messages(messages)
+            + "\n\nBased on this conversation, is there any indication of fraudulent activity? Explain your reasoning."
+            + '\nEnd with a line "Confidence: <number between 0 and 1>".'
+        )
 
-        prompt += "\nBased on this conversation, is there any indication of fraudulent activity? Explain your reasoning."
-
-        try:
-            response = self.model.generate_content(prompt)
-            text_response = response.text.lower()
+        def parse(response_text: str) -> dict:
+            text_response = response_text.lower()
 
             if "yes" in text_response:  # Simple keyword check.  Improve in a real system.
                 is_fraudulent = True
             else:
                 is_fraudulent = False
 
-            return {"is_fraudulent": is_fraudulent, "reason": response.text}
+            return {"is_fraudulent": is_fraudulent, "reason": response_text, "confidence": parse_confidence(response_text)}
+
+        try:
+            result = await self.cascade.generate(prompt, parse)
+            return {"is_fraudulent": result["is_fraudulent"], "reason": result["reason"], "model_tier": result["model_tier"]}
 
+        except LLMUnavailableError as e:
+            return self._degraded_analysis([msg.message for msg in messages], e)
         except Exception as e:
             print(f"Error during fraud analysis: {e}")
             return {"is_fraudulent": False, "reason": f"AI analysis failed: {e}"}
+
+    async def analyze_conversation(self, conversation_key: Optional[str], messages: List[dict]) -> dict:
+        """
+        Analyzes a conversation window, incrementally when possible.
+
+        In incremental mode the stored rolling state of the conversation (summary,
+        risk score and the id of the last analyzed message) is loaded, and only
+        messages newer than that id are sent to the model together with the
+        compact state. Every FRAUD_FULL_RECHECK_EVERY analyses, or when there is
+        no state yet, the whole window is analyzed instead.
+
+        Args:
+            conversation_key: Key of the conversation (see db.conversation_key_for).
+            messages: Message dicts, oldest first. Persisted messages carry an "id".
+
+        Returns:
+            A dictionary containing is_fraudulent, reason, risk_score and mode
+            ("full", "incremental", "cached" when there was nothing new, or
+            "degraded" when the model was unavailable and only keywords were checked).
+        """
+        if FRAUD_ANALYSIS_MODE != "incremental" or not conversation_key:
+            result = await self.analyze_chat([ChatMessage(**msg) for msg in messages])
+            result["mode"] = "full"
+            return result
+        if not messages:
+            return {"is_fraudulent": False, "reason": "No messages to analyze.", "mode": "cached"}
+
+        async with AsyncSessionLocal() as session:
+            state = await get_conversation_fraud_state(session, conversation_key)
+
+        full_recheck = (
+            state is None
+            or (FRAUD_FULL_RECHECK_EVERY and state["analyses_since_full"] + 1 >= FRAUD_FULL_RECHECK_EVERY)
+        )
+        if full_recheck:
+            new_messages = messages
+        else:
+            last_id = state["last_message_id"] or 0
+            new_messages = [msg for msg in messages if msg.get("id") is None or msg["id"] > last_id]
+            if not new_messages:
+                return {
+                    "is_fraudulent": state["is_fraudulent"],
+                    "reason": state["reason"],
+                    "risk_score": state["risk_score"],
+                    "mode": "cached",
+                }
+
+        prompt = self._build_rolling_prompt(None if full_recheck else state, new_messages)
+        try:
+            analysis = await self.cascade.generate(prompt, lambda text: self._parse_rolling_response(text, state))
+        except LLMUnavailableError as e:
+            # The rolling state is left as is, so these messages are analyzed again next time.
+            return self._degraded_analysis([msg["message"] for msg in new_messages], e)
+        except Exception as e:
+            print(f"Error during fraud analysis: {e}")
+            return {"is_fraudulent": False, "reason": f"AI analysis failed: {e}", "mode": "failed"}
+
+        persisted_ids = [msg["id"] for msg in messages if msg.get("id") is not None]
+        last_message_id = max(persisted_ids) if persisted_ids else (state or {}).get("last_message_id")
+        async with unit_of_work() as session:
+            await save_conversation_fraud_state(session, conversation_key, {
+                "summary": analysis["summary"][:FRAUD_SUMMARY_MAX_CHARS],
+                "risk_score": analysis["risk_score"],
+                "is_fraudulent": analysis["is_fraudulent"],
+                "reason": analysis["reason"],
+                "last_message_id": last_message_id,
+                "analyses_since_full": 0 if full_recheck else state["analyses_since_full"] + 1,
+            })
+        return {
+            "is_fraudulent": analysis["is_fraudulent"],
+            "reason": analysis["reason"],
+            "risk_score": analysis["risk_score"],
+            "mode": "full" if full_recheck else "incremental",
+            "model_tier": analysis["model_tier"],
+        }
+
+    def _degraded_analysis(self, texts: List[str], error: Exception) -> dict:
+        """Keyword-only verdict used when the model was unavailable."""
+        metrics.incr("fraud.decided_by.rules_degraded")
+        alerts = [alert for _, message_alerts in self.keyword_screen.analyze_messages(texts) for alert in message_alerts]
+        return {
+            "is_fraudulent": bool(alerts),
+            "reason": f"Model unavailable ({error}); keyword screen only: " + ("; ".join(alerts) or "no suspicious keywords"),
+            "mode": "degraded",
+        }
+
+    @staticmethod
+    def _build_rolling_prompt(state: Optional[dict], new_messages: List[dict]) -> str:
+        parts = ["You are monitoring a P2P trading chat for potential fraud."]
+        if state:
+            parts.append(
+                f"Summary of the conversation so far:\n{state['summary'] or '(empty)'}\n"
+                f"Current risk score (0 to 1): {state['risk_score']}"
+            )
+            parts.append("New messages since the last review:")
+        else:
+            parts.append("Conversation:")
+        parts.append(_format_messages([ChatMessage(**msg) for msg in new_messages]))
+        parts.append(
+            "Update your assessment. Reply with a JSON object in the format:\n"
+            '{"is_fraudulent": false, "risk_score": <number between 0 and 1>, '
+            '"summary": "Short running summary of the conversation and any red flags", '
+            '"reason": "Explanation", "confidence": <number between 0 and 1>}'
+        )
+        return "\n\n".join(parts)
+
+    @staticmethod
+    def _parse_rolling_response(response_text: str, state: Optional[dict]) -> dict:
+        try:
+            result = json.loads(response_text)
+            return {
+                "is_fraudulent": bool(result.get("is_fraudulent", False)),
+                "risk_score": float(result.get("risk_score", 0.0)),
+                "summary": str(result.get("summary") or (state or {}).get("summary", "")),
+                "reason": str(result.get("reason", "")),
+                "confidence": float(result["confidence"]) if result.get("confidence") is not None else None,
+            }
+        except (ValueError, TypeError, AttributeError):
+            # Fall back to the same keyword heuristic as analyze_chat and keep the previous summary.
+            is_fraudulent = "yes" in response_text.lower()
+            return {
+                "is_fraudulent": is_fraudulent,
+                "risk_score": 1.0 if is_fraudulent else (state or {}).get("risk_score", 0.0),
+                "summary": (state or {}).get("summary", ""),
+                "reason": response_text,
+                "confidence": None,
+            }
@@ -1,11 +1,25 @@
+import os
 from typing import Tuple, List
 from models import ChatMessage
+from keyword_automaton import KeywordRuleSet
+
+# Built-in keywords, used when the rules file is missing.
+DEFAULT_SUSPICIOUS_KEYWORDS = ["urgent", "guarantee", "free money", "password", "bank details"]
+
+FRAUD_KEYWORDS_PATH = os.getenv(
+    "FRAUD_KEYWORDS_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rules", "fraud_keywords.txt"),
+)
 
 class FraudDetector:
     def __init__(self):
-        # Initialize any necessary resources, e.g., load a pre-trained model or rules.
-        # For this prototype, we'll use a simple keyword-based approach.
-        self.suspicious_keywords = ["urgent", "guarantee", "free money", "password", "bank details"]
+        # Keywords are compiled into a single Aho-Corasick automaton that is
+        # rebuilt whenever the rules file changes on disk.
+        self.rules = KeywordRuleSet(FRAUD_KEYWORDS_PATH, DEFAULT_SUSPICIOUS_KEYWORDS)
+
+    @property
+    def suspicious_keywords(self) -> List[str]:
+        return self.rules.keywords
 
     def analyze_message(self, message_text: str) -> Tuple[bool, List[str]]:
         """
@@ -19,16 +33,21 @@ class FraudDetector:
             is_suspicious: True if the message is deemed suspicious, False otherwise.
             alerts: A list of strings describing the detected suspicious patterns.
         """
-        alerts = []
-        is_suspicious = False
-        message_text_lower = message_text.lower()
+        return self._scan(self.rules.automaton, message_text)
 
-        for keyword in self.suspicious_keywords:
-            if keyword in message_text_lower:
-                alerts.append(f"Suspicious keyword detected: '{keyword}'")
-                is_suspicious = True
+    def analyze_messages(self, message_texts: List[str]) -> List[Tuple[bool, List[str]]]:
+        """
+        Analyzes a batch of chat messages with the same rule set snapshot.
+
+        Returns one (is_suspicious, alerts) tuple per message, in input order.
+        """
+        automaton = self.rules.automaton
+        return [self._scan(automaton, text) for text in message_texts]
 
-        return is_suspicious, alerts
+    @staticmethod
+    def _scan(automaton, message_text: str) -> Tuple[bool, List[str]]:
+        alerts = [f"Suspicious keyword detected: '{keyword}'" for keyword in automaton.search(message_text)]
+        return bool(alerts), alerts
 
     async def _check_fraud_history(self, dispute):
         # Placeholder for checking historical fraud data.  In a real system,
@@ -0,0 +1,97 @@
+# bench/chat_ingest.py
+"""
+Compares per-message commits with the group-commit chat write buffer.
+
+Messages arrive at a fixed rate (each queuing its background job, as /chat/send
+does) and are written to a throwaway SQLite database either with one
+transaction per message or through ChatWriteBuffer. Reports throughput,
+acknowledgement latency percentiles and the number of commits for both paths.
+
+Usage (from backend/):
+    python -m bench.chat_ingest --messages 2000 --rate 2000
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+
+def summarize(name: str, latencies, elapsed: float, commits: int) -> dict:
+    latencies = sorted(latencies)
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    return {
+        "path": name,
+        "messages": len(latencies),
+        "commits": commits,
+        "throughput_msgs_per_s": round(len(latencies) / elapsed, 1),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 2),
+        "p50_ms": round(pick(0.50), 2),
+        "p95_ms": round(pick(0.95), 2),
+        "p99_ms": round(pick(0.99), 2),
+    }
+
+
+async def drive(save, messages: int, rate: float):
+    latencies = []
+
+    async def one(i):
+        started = time.perf_counter()
+        await save({"sender_id": f"buyer{i % 50}", "receiver_id": f"seller{i % 7}", "message": f"message {i}"})
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    tasks = []
+    for i in range(messages):
+        tasks.append(asyncio.ensure_future(one(i)))
+        await asyncio.sleep(1 / rate)
+    await asyncio.gather(*tasks)
+    return latencies, time.perf_counter() - started
+
+
+async def run(messages: int, rate: float) -> list:
+    from db_async import unit_of_work, save_chat_message, dispose_engine
+    from job_queue import enqueue_job_async
+    from chat_ingest import ChatWriteBuffer
+    import metrics
+
+    async def save_direct(message_data: dict):
+        async with unit_of_work() as session:
+            await save_chat_message(session, message_data)
+            await enqueue_job_async(session, "process_chat_message", {"message": message_data})
+
+    latencies, elapsed = await drive(save_direct, messages, rate)
+    results = [summarize("commit per message", latencies, elapsed, messages)]
+
+    buffer = ChatWriteBuffer()
+    metrics.reset()
+    latencies, elapsed = await drive(
+        lambda message_data: buffer.save(message_data, ("process_chat_message", {"message": message_data})),
+        messages,
+        rate,
+    )
+    await buffer.close()
+    flushes = metrics.snapshot()["counters"].get("chat_ingest.flushes", 0)
+    results.append(summarize("group commit buffer", latencies, elapsed, flushes))
+    await dispose_engine()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=2000, help="arrival rate in messages per second")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        from db import init_db
+        init_db()
+        results = asyncio.run(run(args.messages, args.rate))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
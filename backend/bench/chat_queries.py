@@ -0,0 +1,165 @@
+# bench/chat_queries.py
+"""
+Chat history query latency before and after the chat indexes migration.
+
+Generates a SQLite database with --rows chat messages (a share of them bound
+to disputes), removes the indexes added by 0003_chat_history_indexes to get
+the pre-migration schema, and times the dispute and pair lookups. It then
+applies the migration and times the same lookups again. A second section
+compares commit-per-message insert throughput with SQLite's default pragmas
+and with the tuned ones from db.apply_sqlite_pragmas.
+
+Usage (from backend/):
+    python -m bench.chat_queries --rows 2000000 --queries 50
+"""
+import os
+import json
+import time
+import random
+import sqlite3
+import argparse
+import datetime
+import tempfile
+import statistics
+
+CHAT_INDEXES_MIGRATION = "0003_chat_history_indexes"
+
+
+def generate(path: str, rows: int, disputes: int, users: int, seed: int = 7):
+    from db import engine, init_db
+    init_db()
+    engine.dispose()
+
+    rng = random.Random(seed)
+    start = datetime.datetime(2025, 1, 1)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+
+    def batch(offset: int, size: int):
+        for i in range(offset, offset + size):
+            sender, receiver = f"user{rng.randrange(users)}", f"user{rng.randrange(users)}"
+            dispute_id = str(rng.randrange(disputes)) if rng.random() < 0.3 else None
+            if dispute_id:
+                key = f"dispute:{dispute_id}"
+            else:
+                first, second = sorted([sender, receiver])
+                key = f"pair:{first}:{second}"
+            created_at = start + datetime.timedelta(seconds=i * 5 + rng.randrange(5))
+            yield sender, receiver, f"message {i}", created_at.isoformat(sep=" "), dispute_id, 0, key
+
+    chunk = 100_000
+    for offset in range(0, rows, chunk):
+        conn.executemany(
+            "INSERT INTO chat_messages (sender_id, receiver_id, message, created_at, dispute_id, flagged, conversation_key)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            batch(offset, min(chunk, rows - offset)),
+        )
+        conn.commit()
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+
+
+def drop_chat_indexes(path: str):
+    conn = sqlite3.connect(path)
+    conn.execute("DROP INDEX IF EXISTS ix_chat_messages_dispute_created")
+    conn.execute("DROP INDEX IF EXISTS ix_chat_messages_pair_created")
+    conn.execute("DELETE FROM schema_migrations WHERE version = ?", (CHAT_INDEXES_MIGRATION,))
+    conn.commit()
+    conn.close()
+
+
+def time_queries(queries: int, disputes: int, users: int, seed: int = 11) -> dict:
+    from sqlalchemy import text
+    from db import engine, get_chat_history, get_split_chat_history, flag_conversation
+
+    rng = random.Random(seed)
+    dispute_ids = [str(rng.randrange(disputes)) for _ in range(queries)]
+    pairs = [(f"user{rng.randrange(users)}", f"user{rng.randrange(users)}") for _ in range(queries)]
+    pair_query = text(
+        "SELECT id, sender_id, receiver_id, message, created_at FROM chat_messages"
+        " WHERE (sender_id = :a AND receiver_id = :b) OR (sender_id = :b AND receiver_id = :a)"
+        " ORDER BY created_at"
+    )
+
+    def pair_history(a: str, b: str):
+        with engine.connect() as conn:
+            return conn.execute(pair_query, {"a": a, "b": b}).all()
+
+    cases = {
+        "get_chat_history": lambda i: get_chat_history(dispute_ids[i]),
+        "get_split_chat_history": lambda i: get_split_chat_history(dispute_ids[i], datetime.datetime(2025, 3, 1)),
+        "flag_conversation": lambda i: flag_conversation(dispute_ids[i]),
+        "pair_history": lambda i: pair_history(*pairs[i]),
+    }
+    results = {}
+    for name, run in cases.items():
+        samples = []
+        for i in range(queries):
+            started = time.perf_counter()
+            run(i)
+            samples.append((time.perf_counter() - started) * 1000)
+        results[name] = {"median_ms": round(statistics.median(samples), 3), "max_ms": round(max(samples), 3)}
+    return results
+
+
+def time_inserts(path: str, messages: int, tuned: bool) -> float:
+    from db import apply_sqlite_pragmas
+
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS t (id INTEGER PRIMARY KEY, body TEXT, created_at TEXT)")
+    if tuned:
+        apply_sqlite_pragmas(conn, None)
+    conn.commit()
+    started = time.perf_counter()
+    for i in range(messages):
+        conn.execute("INSERT INTO t (body, created_at) VALUES (?, ?)", (f"message {i}", datetime.datetime.utcnow().isoformat()))
+        conn.commit()
+    elapsed = time.perf_counter() - started
+    conn.close()
+    return round(messages / elapsed, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--disputes", type=int, default=20_000)
+    parser.add_argument("--users", type=int, default=5_000)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--inserts", type=int, default=2000, help="messages for the insert throughput comparison")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+        started = time.perf_counter()
+        generate(path, args.rows, args.disputes, args.users)
+        generated_s = round(time.perf_counter() - started, 1)
+
+        from db import engine
+        from migrations import run_migrations
+
+        drop_chat_indexes(path)
+        before = time_queries(args.queries, args.disputes, args.users)
+        started = time.perf_counter()
+        run_migrations(engine)
+        migration_s = round(time.perf_counter() - started, 1)
+        after = time_queries(args.queries, args.disputes, args.users)
+
+        inserts = {
+            "default_pragmas_msgs_per_s": time_inserts(os.path.join(tmp, "default.db"), args.inserts, tuned=False),
+            "tuned_pragmas_msgs_per_s": time_inserts(os.path.join(tmp, "tuned.db"), args.inserts, tuned=True),
+        }
+
+    print(json.dumps({
+        "rows": args.rows,
+        "generate_s": generated_s,
+        "migration_s": migration_s,
+        "queries": {name: {"before": before[name], "after": after[name]} for name in before},
+        "commit_per_message_inserts": inserts,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
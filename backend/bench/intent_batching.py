@@ -0,0 +1,96 @@
+# bench/intent_batching.py
+"""
+Compares one-model-call-per-message intent classification with the micro-batcher.
+
+Messages arrive at a fixed rate and are classified against a simulated model
+whose latency grows with the number of items in the request and whose
+concurrency is capped (as with a real quota). Reports throughput, latency
+percentiles and the number of model requests for both paths.
+
+Usage (from backend/):
+    python -m bench.intent_batching --messages 2000 --rate 500
+"""
+import re
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+from llm_client import LLMClient
+from intent_batcher import IntentBatcher, build_batch_prompt
+
+
+class SimulatedModel(LLMClient):
+    """Fake model: latency = base + per_item * items, at most `concurrency` requests at once."""
+
+    def __init__(self, base_ms: float, per_item_ms: float, concurrency: int):
+        super().__init__("simulated")
+        self.base = base_ms / 1000
+        self.per_item = per_item_ms / 1000
+        self.limit = asyncio.Semaphore(concurrency)
+        self.requests = 0
+
+    async def generate(self, contents, timeout=None) -> str:
+        ids = [int(i) for i in re.findall(r'"id": (\d+)', contents)] or [0]
+        async with self.limit:
+            self.requests += 1
+            await asyncio.sleep(self.base + self.per_item * len(ids))
+        return json.dumps([{"id": i, "flagged": False} for i in ids])
+
+
+def summarize(name: str, latencies, elapsed: float, requests: int) -> dict:
+    latencies = sorted(latencies)
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    return {
+        "path": name,
+        "messages": len(latencies),
+        "model_requests": requests,
+        "throughput_msgs_per_s": round(len(latencies) / elapsed, 1),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 2),
+        "p50_ms": round(pick(0.50), 2),
+        "p95_ms": round(pick(0.95), 2),
+        "p99_ms": round(pick(0.99), 2),
+    }
+
+
+async def drive(classify, messages: int, rate: float):
+    latencies = []
+
+    async def one(i):
+        started = time.perf_counter()
+        await classify(f"message {i}")
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    tasks = []
+    for i in range(messages):
+        tasks.append(asyncio.ensure_future(one(i)))
+        await asyncio.sleep(1 / rate)
+    await asyncio.gather(*tasks)
+    return latencies, time.perf_counter() - started
+
+
+async def main(args):
+    single = SimulatedModel(args.base_ms, args.per_item_ms, args.concurrency)
+    latencies, elapsed = await drive(lambda text: single.generate(build_batch_prompt([text])), args.messages, args.rate)
+    unbatched = summarize("one_call_per_message", latencies, elapsed, single.requests)
+
+    batched_model = SimulatedModel(args.base_ms, args.per_item_ms, args.concurrency)
+    batcher = IntentBatcher(batched_model, args.batch_size, args.batch_latency_ms)
+    latencies, elapsed = await drive(batcher.classify, args.messages, args.rate)
+    batched = summarize("micro_batched", latencies, elapsed, batched_model.requests)
+
+    print(json.dumps({"config": vars(args), "results": [unbatched, batched]}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=500, help="messages per second")
+    parser.add_argument("--base-ms", type=float, default=400, help="fixed model latency per request")
+    parser.add_argument("--per-item-ms", type=float, default=5, help="extra model latency per batched item")
+    parser.add_argument("--concurrency", type=int, default=16, help="max concurrent model requests")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--batch-latency-ms", type=float, default=25)
+    asyncio.run(main(parser.parse_args()))
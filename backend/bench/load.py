@@ -0,0 +1,403 @@
+# bench/load.py
+"""
+End-to-end load test of the API with fake model and storage backends.
+
+The FastAPI app from main.py is started in-process (lifespan included, with
+in-process job workers) against a throwaway SQLite database, local evidence
+storage and fake models, and driven through httpx's ASGI transport with a
+weighted mix of:
+
+    send      POST /chat/send
+    webhook   POST /chat/webhook
+    submit    POST /dispute/submit
+    upload    POST /dispute/upload-evidence
+    finalize  POST /dispute/{id}/finalize
+    dispute_chat  POST /chat/dispute/send  (not in the default mix)
+
+Model latency is drawn per call from a distribution ("fixed:50",
+"uniform:20:80", "lognormal:<median ms>:<sigma>" or
+"bimodal:<fast ms>:<slow ms>:<slow share>"), separately for the fast and the
+strong cascade model, and answers are drawn from the configured rates
+(intent flags, fraud, approvals, low-confidence answers, errors). Storage
+writes can be slowed down with --storage-latency-ms to stand in for GCS.
+
+Prints a JSON report (the app's own logging goes to stderr) with throughput, error counts and latency percentiles
+per endpoint, plus the commit it was run on. --output saves the report and
+--baseline adds the ratios against an earlier report, so runs on two commits
+can be compared.
+
+Usage (from backend/):
+    python -m bench.load --requests 2000 --concurrency 32
+    python -m bench.load --mix send=50,webhook=50 --llm-latency bimodal:40:800:0.05 --output after.json --baseline before.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import contextlib
+import tempfile
+import datetime
+import statistics
+import subprocess
+
+OPERATIONS = ["send", "webhook", "submit", "upload", "finalize", "dispute_chat"]
+DEFAULT_MIX = "send=35,webhook=30,submit=10,upload=10,finalize=15"
+
+CHAT_MESSAGES = [
+    "hi, is the order still available?",
+    "I have paid, please check and release",
+    "when will you release the coins?",
+    "is there another way to settle this",  # ambiguous for the intent prefilter
+    "add me on whatsapp and we can deal there",
+    "urgent!! send your bank details now",
+    "thanks, received",
+]
+DISPUTE_TYPES = ["buyer_not_paid", "seller_not_released", "buyer_underpaid", "buyer_overpaid"]
+
+
+def parse_distribution(spec: str, rng: random.Random):
+    """Returns a function drawing latencies (ms) from a distribution spec."""
+    kind, _, rest = spec.partition(":")
+    if not rest:
+        kind, rest = "fixed", spec
+    params = [float(value) for value in rest.split(":")]
+    if kind == "fixed":
+        return lambda: params[0]
+    if kind == "uniform":
+        return lambda: rng.uniform(params[0], params[1])
+    if kind == "lognormal":
+        median, sigma = params
+        return lambda: rng.lognormvariate(math.log(median), sigma)
+    if kind == "bimodal":
+        fast, slow, slow_share = params
+        return lambda: slow if rng.random() < slow_share else fast
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - set(OPERATIONS)
+    if unknown:
+        raise ValueError(f"Unknown operations in mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+class FakeResponder:
+    """Answers each prompt type in the format its caller parses, with the configured rates."""
+
+    def __init__(self, args, rng: random.Random):
+        self.args = args
+        self.rng = rng
+
+    def _confidence(self) -> float:
+        if self.rng.random() < self.args.low_confidence_rate:
+            return round(self.rng.uniform(0.3, 0.7), 2)
+        return round(self.rng.uniform(0.8, 0.99), 2)
+
+    def _status(self) -> str:
+        roll = self.rng.random()
+        if roll < self.args.approve_rate:
+            return "approved"
+        return "rejected" if roll < self.args.approve_rate + (1 - self.args.approve_rate) / 2 else "escalated"
+
+    def __call__(self, contents) -> str:
+        if self.rng.random() < self.args.error_rate:
+            raise RuntimeError("Fake model backend error")
+        if not isinstance(contents, str):
+            return "The video shows a bank transfer of the disputed amount to the seller's account. Nothing suspicious."
+        flagged = lambda: self.rng.random() < self.args.flag_rate
+        fraudulent = self.rng.random() < self.args.fraud_rate
+        if "Messages (JSON array)" in contents:
+            items = json.loads(contents.split("Messages (JSON array):", 1)[1].split("\n\n", 1)[0].strip())
+            return json.dumps([{"id": item["id"], "flagged": flagged(), "reason": "Fake."} for item in items])
+        if "chat intent detection" in contents:
+            return json.dumps({"flagged": flagged(), "reason": "Fake."})
+        if "monitoring a P2P trading chat" in contents:
+            return json.dumps({
+                "is_fraudulent": fraudulent,
+                "risk_score": 0.9 if fraudulent else 0.1,
+                "summary": "Buyer and seller discuss payment and release.",
+                "reason": "Fake.",
+                "confidence": self._confidence(),
+            })
+        if "for potential fraud" in contents:
+            return f"{'Yes' if fraudulent else 'No'}, fake analysis.\nConfidence: {self._confidence()}"
+        if "final dispute resolution AI" in contents:
+            return json.dumps({"status": self._status(), "reason": "Fake.", "confidence": self._confidence()})
+        if "dispute resolution expert" in contents:
+            return f"{self._status().capitalize()}: fake reasoning.\nConfidence: {self._confidence()}"
+        if "dispute resolution assistant" in contents:
+            return json.dumps({"status": "evidence_requested", "reason": "Please upload your receipt.", "requires_human_review": False})
+        if contents.startswith("Summarize"):
+            return "The parties agreed on the price; the buyer says the payment was sent."
+        return json.dumps({"flagged": False, "is_fraudulent": False, "status": "escalated", "reason": "Fake.", "confidence": 0.5})
+
+
+def install_fakes(args, rng: random.Random):
+    """Installs the fake models and storage; must run before main (and the agents) are imported."""
+    import llm_client
+    from model_cascade import CASCADE_FAST_MODEL, CASCADE_STRONG_MODEL
+
+    responder = FakeResponder(args, rng)
+    fast = parse_distribution(args.llm_latency, rng)
+    strong = parse_distribution(args.strong_latency or args.llm_latency, rng)
+    for model_name in {"gemini-2.0-flash-001", "gemini-1.5-pro-002", CASCADE_FAST_MODEL, CASCADE_STRONG_MODEL}:
+        latency = strong if model_name == CASCADE_STRONG_MODEL else fast
+        llm_client.set_llm_client(model_name, llm_client.FakeLLMClient(model_name, latency_ms=latency, response=responder))
+
+    if args.storage_latency_ms > 0:
+        from cloud_storage import LocalStorageBackend, set_storage_backend
+        from dispute import BUCKET_NAME
+
+        class SlowLocalStorageBackend(LocalStorageBackend):
+            # Object stores acknowledge a write on close; that is where the delay goes.
+            def open_writer(self, key: str):
+                writer = super().open_writer(key)
+                close = writer.close
+
+                def slow_close():
+                    time.sleep(args.storage_latency_ms / 1000)
+                    return close()
+
+                writer.close = slow_close
+                return writer
+
+        set_storage_backend(BUCKET_NAME, SlowLocalStorageBackend())
+
+
+class LoadRun:
+    def __init__(self, client, args, rng: random.Random):
+        self.client = client
+        self.args = args
+        self.rng = rng
+        self.dispute_ids = []
+        self.uploads = []
+        self.samples = {}  # operation -> list of (latency_s, ok)
+
+    def _chat_message(self) -> dict:
+        return {
+            "sender_id": f"buyer{self.rng.randrange(self.args.users)}",
+            "receiver_id": f"seller{self.rng.randrange(self.args.users)}",
+            "message": self.rng.choice(CHAT_MESSAGES),
+        }
+
+    def _dispute(self) -> dict:
+        return {
+            "transaction_id": f"tx{self.rng.randrange(10 ** 9)}",
+            "buyer_id": f"buyer{self.rng.randrange(self.args.users)}",
+            "seller_id": f"seller{self.rng.randrange(self.args.users)}",
+            "dispute_type": self.rng.choice(DISPUTE_TYPES),
+            "amount": round(self.rng.lognormvariate(math.log(200), 1.0), 2),
+            "currency": "USD",
+            "additional_info": "Payment sent but the coins were not released.",
+        }
+
+    async def send(self):
+        return await self.client.post("/chat/send", json=self._chat_message())
+
+    async def webhook(self):
+        return await self.client.post("/chat/webhook", json=self._chat_message())
+
+    async def submit(self):
+        response = await self.client.post("/dispute/submit", json=self._dispute())
+        if response.status_code == 200:
+            self.dispute_ids.append(response.json()["dispute_id"])
+        return response
+
+    async def upload(self):
+        if self.uploads and self.rng.random() < self.args.duplicate_upload_rate:
+            content = self.rng.choice(self.uploads)
+        else:
+            content = self.rng.randbytes(self.args.upload_kib * 1024)
+            self.uploads = (self.uploads + [content])[-20:]
+        return await self.client.post(
+            "/dispute/upload-evidence",
+            files={"file": ("receipt.pdf", content, "application/pdf")},
+            data={"file_type": "pdf", "transaction_id": f"tx{self.rng.randrange(10 ** 9)}"},
+        )
+
+    async def finalize(self):
+        return await self.client.post(f"/dispute/{self.rng.choice(self.dispute_ids)}/finalize")
+
+    async def dispute_chat(self):
+        message = self._chat_message()
+        return await self.client.post(f"/chat/dispute/send?dispute_id={self.rng.choice(self.dispute_ids)}", json=message)
+
+    async def setup(self):
+        """Creates the disputes (with some dispute chat) that finalize and dispute_chat pick from."""
+        for _ in range(self.args.disputes):
+            await self.submit()
+        for dispute_id in self.dispute_ids:
+            for _ in range(self.args.dispute_messages):
+                message = self._chat_message()
+                await self.client.post(f"/chat/dispute/send?dispute_id={dispute_id}", json=message)
+
+    async def one(self, operation: str, record: bool = True):
+        started = time.perf_counter()
+        try:
+            response = await getattr(self, operation)()
+            ok = response.status_code < 400
+        except Exception as e:
+            print(f"{operation} failed: {e}", file=sys.stderr)
+            ok = False
+        if record:
+            self.samples.setdefault(operation, []).append((time.perf_counter() - started, ok))
+
+    def _pick(self, mix: dict) -> str:
+        return self.rng.choices(list(mix), weights=list(mix.values()))[0]
+
+    async def closed_loop(self, mix: dict, requests: int, record: bool = True):
+        remaining = [requests]
+
+        async def worker():
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                await self.one(self._pick(mix), record)
+
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+
+    async def open_loop(self, mix: dict, requests: int, rate: float):
+        tasks = []
+        for _ in range(requests):
+            tasks.append(asyncio.ensure_future(self.one(self._pick(mix))))
+            await asyncio.sleep(1 / rate)
+        await asyncio.gather(*tasks)
+
+
+def summarize(samples: list, elapsed: float) -> dict:
+    latencies = sorted(latency for latency, _ in samples)
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for _, ok in samples if not ok),
+        "throughput_rps": round(len(samples) / elapsed, 1),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 2),
+        "p50_ms": round(pick(0.50), 2),
+        "p95_ms": round(pick(0.95), 2),
+        "p99_ms": round(pick(0.99), 2),
+        "max_ms": round(latencies[-1] * 1000, 2),
+    }
+
+
+def compare(report: dict, baseline: dict) -> dict:
+    """Ratios (this run / baseline) per endpoint; above 1 is slower for latencies."""
+    comparison = {}
+    for name, current in report["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(name)
+        if not before:
+            continue
+        comparison[name] = {
+            key: round(current[key] / before[key], 3) if before[key] else None
+            for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms")
+        }
+    return comparison
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args, mix: dict) -> dict:
+    import httpx
+    import main
+    import metrics
+
+    rng = random.Random(args.seed + 1)
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            load = LoadRun(client, args, rng)
+            await load.setup()
+            await load.closed_loop(mix, args.warmup, record=False)
+            metrics.reset()
+            started = time.perf_counter()
+            if args.rate:
+                await load.open_loop(mix, args.requests, args.rate)
+            else:
+                await load.closed_loop(mix, args.requests)
+            elapsed = time.perf_counter() - started
+            app_metrics = metrics.snapshot()
+
+    every = [sample for samples in load.samples.values() for sample in samples]
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "elapsed_s": round(elapsed, 2),
+        "total": summarize(every, elapsed),
+        "endpoints": {name: summarize(samples, elapsed) for name, samples in sorted(load.samples.items())},
+        "app_counters": {
+            name: value for name, value in sorted(app_metrics["counters"].items())
+            if name.startswith(("llm.", "cascade.", "intent.decided_by", "jobs.", "finalize."))
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000, help="measured requests")
+    parser.add_argument("--warmup", type=int, default=50, help="unmeasured requests before the run")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients (closed loop)")
+    parser.add_argument("--rate", type=float, default=0, help="requests per second (open loop instead of closed)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"operation weights (default {DEFAULT_MIX})")
+    parser.add_argument("--users", type=int, default=200, help="distinct buyers and sellers")
+    parser.add_argument("--disputes", type=int, default=20, help="disputes created before the run")
+    parser.add_argument("--dispute-messages", type=int, default=5, help="dispute chat messages per setup dispute")
+    parser.add_argument("--upload-kib", type=int, default=256, help="evidence file size")
+    parser.add_argument("--duplicate-upload-rate", type=float, default=0.2, help="share of re-uploaded files")
+    parser.add_argument("--llm-latency", default="lognormal:60:0.5", help="fast/default model latency distribution")
+    parser.add_argument("--strong-latency", default="lognormal:200:0.5", help="strong cascade model latency distribution")
+    parser.add_argument("--flag-rate", type=float, default=0.1, help="share of intent checks the model flags")
+    parser.add_argument("--fraud-rate", type=float, default=0.05, help="share of fraud scans answered as fraudulent")
+    parser.add_argument("--approve-rate", type=float, default=0.6, help="share of dispute decisions that approve")
+    parser.add_argument("--low-confidence-rate", type=float, default=0.2, help="share of answers below the cascade threshold")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of model calls that fail")
+    parser.add_argument("--storage-latency-ms", type=float, default=0, help="extra delay per stored evidence file")
+    parser.add_argument("--job-workers", type=int, default=2, help="in-process background job workers")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="also write the report to this file")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update({
+            "DATABASE_URL": f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+            "LLM_BACKEND": "fake",
+            "STORAGE_BACKEND": "local",
+            "LOCAL_STORAGE_DIR": os.path.join(tmp, "uploads"),
+            "JOB_WORKERS_IN_PROCESS": str(args.job_workers),
+            "WARMUP_ON_STARTUP": "0",
+        })
+        # The fake models have no provider quota to protect.
+        os.environ.setdefault("LLM_RATE_PER_SECOND", "0")
+        random.seed(args.seed)
+        # The app logs with print; keep stdout for the report.
+        with contextlib.redirect_stdout(sys.stderr):
+            install_fakes(args, random.Random(args.seed))
+            report = asyncio.run(run(args, mix))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["comparison"] = compare(report, json.load(f))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# bench/startup.py
+"""
+Measures API cold start and per-request allocation.
+
+Cold start: in fresh subprocesses, the time to `import main` and the time until
+the lifespan has finished starting up (database ready, orchestrator created).
+
+Per-request allocation: with tracemalloc, the bytes allocated while handling
+intent checks when a new DisputeOrchestrator is built per request (the old
+behaviour) versus when one app-scoped orchestrator is reused.
+
+Runs against the fake LLM backend and a throwaway SQLite database, so no cloud
+credentials are needed.
+
+Usage (from backend/):
+    python -m bench.startup --runs 5 --requests 200
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+
+COLD_START_SCRIPT = """
+import time, json, asyncio
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+async def start():
+    async with main.lifespan(main.app):
+        return time.perf_counter()
+
+ready = asyncio.run(start())
+print(json.dumps({"import_ms": (imported - started) * 1000, "startup_ms": (ready - started) * 1000}))
+"""
+
+
+def bench_env(db_path: str) -> dict:
+    env = dict(os.environ)
+    env.setdefault("LLM_BACKEND", "fake")
+    env.setdefault("STORAGE_BACKEND", "local")
+    env["DATABASE_URL"] = f"sqlite:///{db_path}"
+    env["JOB_WORKERS_IN_PROCESS"] = "0"
+    return env
+
+
+def measure_cold_start(runs: int, env: dict) -> dict:
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", COLD_START_SCRIPT], env=env, capture_output=True, text=True, check=True
+        )
+        samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return {
+        key: {
+            "mean_ms": round(statistics.mean(s[key] for s in samples), 1),
+            "min_ms": round(min(s[key] for s in samples), 1),
+        }
+        for key in ("import_ms", "startup_ms")
+    }
+
+
+async def measure_allocation(requests: int, per_request: bool) -> dict:
+    from db import init_db
+    from models import ChatMessage
+    from orchestrator import DisputeOrchestrator
+
+    init_db()
+    message = ChatMessage(sender_id="buyer", receiver_id="seller", message="can you send the item today?")
+    shared = DisputeOrchestrator()
+    # One untimed call so lazily created state (semaphores, batcher) is not counted.
+    await shared.process_chat_intent(message)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(requests):
+        orchestrator = DisputeOrchestrator() if per_request else shared
+        await orchestrator.process_chat_intent(message)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename") if stat.size_diff > 0)
+    return {
+        "path": "orchestrator per request" if per_request else "app-scoped orchestrator",
+        "requests": requests,
+        "retained_bytes_per_request": round(allocated / requests, 1),
+        "peak_traced_kib": round(peak / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="cold-start subprocess runs")
+    parser.add_argument("--requests", type=int, default=200, help="intent checks per allocation run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = bench_env(os.path.join(tmp, "bench.db"))
+        cold_start = measure_cold_start(args.runs, env)
+        os.environ.update(env)
+        os.environ["FAKE_LLM_LATENCY_MS"] = "0"
+        allocation = [
+            asyncio.run(measure_allocation(args.requests, per_request=True)),
+            asyncio.run(measure_allocation(args.requests, per_request=False)),
+        ]
+    print(json.dumps({"cold_start": cold_start, "allocation": allocation}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
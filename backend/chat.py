@@ -1,63 +1,82 @@
 # chat.py
-from fastapi import APIRouter, BackgroundTasks, HTTPException
-from models import ChatMessage
-from orchestrator import DisputeOrchestrator
-from db import save_chat_message, get_chat_history
+import json
 import asyncio
+from fastapi import APIRouter, HTTPException, Depends, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from models import ChatMessage, ChatMessageBatch
+from orchestrator import DisputeOrchestrator
+from dependencies import get_orchestrator
+from db import conversation_key_for
+from db_async import unit_of_work, save_chat_message, save_chat_messages
+from job_queue import enqueue_job_async, enqueue_jobs_async
+from chat_ingest import CHAT_WRITE_BUFFER, get_chat_write_buffer
+from llm_scheduler import llm_call_class
+from llm_resilience import llm_deadline, INTENT_DEADLINE_SECONDS, DISPUTE_CHAT_DEADLINE_SECONDS
+from pubsub import PUBSUB_HEARTBEAT_SECONDS, get_broker, publish_event, message_event, dispute_channel
 
 router = APIRouter()
 
 @router.post("/send")
-async def send_chat(message: ChatMessage, background_tasks: BackgroundTasks):
+async def send_chat(message: ChatMessage):
     """
     Endpoint for p2p chat.
     Buyer and seller messages are persisted and then processed for fraud and intent analysis.
     """
-    # Save the chat message to the database (wrapped in an executor)
-    loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, save_chat_message, message.dict())
-
-    orchestrator = DisputeOrchestrator()
-    # Process the chat message (fraud detection analysis)
-    background_tasks.add_task(orchestrator.process_chat_message, message)
-    return {"status": "message received"}
+    # Save the chat message and queue its processing (fraud detection analysis)
+    # on the background job queue in one transaction.
+    job = ("process_chat_message", {"message": message.dict()})
+    if CHAT_WRITE_BUFFER:
+        # Group-committed with other concurrent messages; returns after the commit.
+        saved = await get_chat_write_buffer().save(message.dict(), job)
+        await _publish_message(saved["row"])
+        return {"status": "message received", "job_id": saved["job_id"]}
+    async with unit_of_work() as session:
+        row = await save_chat_message(session, message.dict())
+        job_id = await enqueue_job_async(session, *job)
+    await _publish_message(row)
+    return {"status": "message received", "job_id": job_id}
 
 @router.post("/webhook")
-async def chat_webhook(message: ChatMessage, background_tasks: BackgroundTasks):
+async def chat_webhook(message: ChatMessage, orchestrator: DisputeOrchestrator = Depends(get_orchestrator)):
     """
-    Webhook endpoint that retrieves the full chat history,
-    appends the current message, and then analyzes:
-      - The complete conversation for fraudulent patterns,
+    Webhook endpoint that analyzes:
+      - The recent history of the sender/receiver conversation, plus the current
+        message, for fraudulent patterns (as a background job),
       - And the intent of the latest message for any off‑platform indications.
     """
-    loop = asyncio.get_running_loop()
-    # Retrieve the full chat history (for all messages or optionally by dispute_id)
-    history = await loop.run_in_executor(None, get_chat_history, None)
-    # Append the current message to the conversation history
-    history.append(message.dict())
-    
-    orchestrator = DisputeOrchestrator()
-    background_tasks.add_task(orchestrator.process_chat_for_fraud, history)
-    
+    # The job loads a bounded window of this conversation's history (last N messages / T minutes)
+    # and appends the current message to it.
+    conversation_key = conversation_key_for(message.sender_id, message.receiver_id)
+    async with unit_of_work() as session:
+        await enqueue_job_async(session, "process_chat_for_fraud", {
+            "conversation_key": conversation_key,
+            "message": message.dict(),
+        })
+
     # Check for off‑platform intent using the AI-powered method.
-    intent_result = await orchestrator.process_chat_intent(message)
+    with llm_call_class("intent"), llm_deadline(INTENT_DEADLINE_SECONDS):
+        intent_result = await orchestrator.process_chat_intent(message)
     if intent_result.get("flagged", False):
         return {"status": "halted", "reason": intent_result.get("reason", "Off-platform intent detected")}
     return {"status": "message received and processed"}
 
 @router.post("/intent-check")
-async def check_chat_intent(message: ChatMessage):
+async def check_chat_intent(message: ChatMessage, orchestrator: DisputeOrchestrator = Depends(get_orchestrator)):
     """
     An explicit endpoint to check the intent of a single message.
     """
-    orchestrator = DisputeOrchestrator()
-    result = await orchestrator.process_chat_intent(message)
+    with llm_call_class("intent"), llm_deadline(INTENT_DEADLINE_SECONDS):
+        result = await orchestrator.process_chat_intent(message)
     if result.get("flagged", False):
-        return {"status": "halted", "reason": result.get("reason", "Off-platform intent detected")}
-    return {"status": "ok"}
+        return {
+            "status": "halted",
+            "reason": result.get("reason", "Off-platform intent detected"),
+            "decided_by": result.get("decided_by"),
+        }
+    return {"status": "ok", "decided_by": result.get("decided_by")}
 
 @router.post("/dispute/send")
-async def send_dispute_chat(message: ChatMessage, dispute_id: str, background_tasks: BackgroundTasks):
+async def send_dispute_chat(message: ChatMessage, dispute_id: str):
     """
     Endpoint for exchanging messages during a dispute chat.
     In this context, messages might be persisted with an associated dispute_id
@@ -66,12 +85,200 @@ async def send_dispute_chat(message: ChatMessage, dispute_id: str, background_ta
     # Optionally, append dispute_id to message dict and persist it.
     enriched_message = message.model_dump()
     enriched_message["dispute_id"] = dispute_id
-    # Save the message using the DB helper
-    loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, save_chat_message, enriched_message)
-    orchestrator = DisputeOrchestrator()
-    background_tasks.add_task(orchestrator.process_dispute_chat_message, message)
-    # Optionally, you could persist dispute-related messages with a dispute_id:
-    # loop = asyncio.get_running_loop()
-    # await loop.run_in_executor(None, save_chat_message, {**message.dict(), "dispute_id": "<DISPUTE_ID>"})
-    return {"status": "message received for dispute chat"}
+    # Save the message and queue its processing in one transaction. The agent's
+    # reply is pushed to the dispute's channel (see /dispute/{dispute_id}/ws).
+    job = ("process_dispute_chat_message", {"message": message.model_dump(), "dispute_id": dispute_id})
+    if CHAT_WRITE_BUFFER:
+        saved = await get_chat_write_buffer().save(enriched_message, job)
+        await _publish_message(saved["row"])
+        return {"status": "message received for dispute chat", "job_id": saved["job_id"]}
+    async with unit_of_work() as session:
+        row = await save_chat_message(session, enriched_message)
+        job_id = await enqueue_job_async(session, *job)
+    await _publish_message(row)
+    return {"status": "message received for dispute chat", "job_id": job_id}
+
+@router.post("/dispute/stream")
+async def stream_dispute_chat(
+    message: ChatMessage,
+    dispute_id: str,
+    orchestrator: DisputeOrchestrator = Depends(get_orchestrator),
+):
+    """
+    Streaming variant of /dispute/send. The message is saved, then the agent's
+    reply is streamed back as Server-Sent Events while the model writes it:
+    "delta" events carry {"text": ...} chunks and a final "result" event carries
+    the parsed {"status", "reason", "requires_human_review"}. The complete reply
+    is also pushed to the dispute's channel as an "ai_reply" event.
+    """
+    enriched_message = message.model_dump()
+    enriched_message["dispute_id"] = dispute_id
+    if CHAT_WRITE_BUFFER:
+        row = (await get_chat_write_buffer().save(enriched_message))["row"]
+    else:
+        async with unit_of_work() as session:
+            row = await save_chat_message(session, enriched_message)
+    await _publish_message(row)
+
+    async def events():
+        # Runs after the endpoint has returned, so the call class is set here.
+        with llm_call_class("dispute_chat"), llm_deadline(DISPUTE_CHAT_DEADLINE_SECONDS):
+            async for event in orchestrator.stream_dispute_chat_message(message, dispute_id):
+                data = {key: value for key, value in event.items() if key != "type"}
+                yield f"event: {event['type']}\ndata: {json.dumps(data)}\n\n"
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Batch variants for upstream gateways that already batch traffic. Each takes
+# {"messages": [...]} and returns one result per message, in input order.
+
+@router.post("/send/batch")
+async def send_chat_batch(batch: ChatMessageBatch, orchestrator: DisputeOrchestrator = Depends(get_orchestrator)):
+    """
+    Persists a batch of p2p chat messages in one transaction, screens them with
+    the keyword rules right away and queues one background job that processes
+    the whole batch (fraud screening and intent analysis).
+    """
+    messages = [message.dict() for message in batch.messages]
+    screening = orchestrator.fraud_detector.analyze_messages([message.message for message in batch.messages])
+    async with unit_of_work() as session:
+        rows = await save_chat_messages(session, messages)
+        job_id = await enqueue_job_async(session, "process_chat_messages", {"messages": messages})
+    for row in rows:
+        await _publish_message(row)
+    return {
+        "status": "messages received",
+        "job_id": job_id,
+        "results": [
+            {"message_id": row.id, "suspicious": is_suspicious, "alerts": alerts}
+            for row, (is_suspicious, alerts) in zip(rows, screening)
+        ],
+    }
+
+@router.post("/webhook/batch")
+async def chat_webhook_batch(batch: ChatMessageBatch, orchestrator: DisputeOrchestrator = Depends(get_orchestrator)):
+    """
+    Batch variant of /webhook. One conversation fraud job is queued per
+    conversation in the batch (all in one transaction), and the intent of every
+    message is checked with the ambiguous ones sharing model requests.
+    """
+    by_conversation = {}
+    for message in batch.messages:
+        conversation_key = conversation_key_for(message.sender_id, message.receiver_id)
+        by_conversation.setdefault(conversation_key, []).append(message.dict())
+    async with unit_of_work() as session:
+        await enqueue_jobs_async(session, [
+            ("process_chat_for_fraud", {"conversation_key": conversation_key, "messages": messages})
+            for conversation_key, messages in by_conversation.items()
+        ])
+
+    screening = orchestrator.fraud_detector.analyze_messages([message.message for message in batch.messages])
+    with llm_call_class("intent"), llm_deadline(INTENT_DEADLINE_SECONDS):
+        intent_results = await orchestrator.process_chat_intents(batch.messages)
+    results = []
+    for (is_suspicious, alerts), intent_result in zip(screening, intent_results):
+        if intent_result.get("flagged", False):
+            result = {"status": "halted", "reason": intent_result.get("reason", "Off-platform intent detected")}
+        else:
+            result = {"status": "message received and processed"}
+        result.update({"suspicious": is_suspicious, "alerts": alerts})
+        results.append(result)
+    return {"results": results}
+
+@router.post("/intent-check/batch")
+async def check_chat_intent_batch(batch: ChatMessageBatch, orchestrator: DisputeOrchestrator = Depends(get_orchestrator)):
+    """
+    Checks the intent of a batch of messages.
+    """
+    with llm_call_class("intent"), llm_deadline(INTENT_DEADLINE_SECONDS):
+        intent_results = await orchestrator.process_chat_intents(batch.messages)
+    results = []
+    for result in intent_results:
+        if result.get("flagged", False):
+            results.append({
+                "status": "halted",
+                "reason": result.get("reason", "Off-platform intent detected"),
+                "decided_by": result.get("decided_by"),
+            })
+        else:
+            results.append({"status": "ok", "decided_by": result.get("decided_by")})
+    return {"results": results}
+
+# Push channels. Every conversation has one channel, named after its
+# conversation key; see pubsub.py for the event format. Clients can use either
+# a WebSocket or a Server-Sent Events stream; both only push, anything a
+# WebSocket client sends is ignored.
+
+async def _publish_message(row):
+    await publish_event(row.conversation_key, "message", message_event(row))
+
+async def _wait_for_disconnect(websocket: WebSocket):
+    try:
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+
+async def _push_websocket(websocket: WebSocket, channel: str):
+    await websocket.accept()
+    async with get_broker().subscribe(channel) as subscription:
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(websocket))
+        try:
+            while True:
+                next_event = asyncio.ensure_future(subscription.get(PUBSUB_HEARTBEAT_SECONDS))
+                await asyncio.wait({next_event, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    next_event.cancel()
+                    break
+                event = next_event.result() or {"type": "heartbeat", "channel": channel}
+                await websocket.send_json(event)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            disconnected.cancel()
+
+def _push_sse(channel: str) -> StreamingResponse:
+    async def events():
+        async with get_broker().subscribe(channel) as subscription:
+            yield ": connected\n\n"
+            while True:
+                event = await subscription.get(PUBSUB_HEARTBEAT_SECONDS)
+                if event is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield f"event: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+    # Starlette cancels the generator when the client disconnects.
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.websocket("/dispute/{dispute_id}/ws")
+async def dispute_chat_websocket(websocket: WebSocket, dispute_id: str):
+    """
+    Pushes the dispute chat's new messages, system warnings, agent replies and
+    resolution updates as they are saved.
+    """
+    await _push_websocket(websocket, dispute_channel(dispute_id))
+
+@router.get("/dispute/{dispute_id}/events")
+async def dispute_chat_events(dispute_id: str):
+    """Server-Sent Events variant of /dispute/{dispute_id}/ws."""
+    return _push_sse(dispute_channel(dispute_id))
+
+@router.websocket("/conversation/ws")
+async def conversation_websocket(websocket: WebSocket, user_id: str, peer_id: str):
+    """
+    Pushes new messages and system warnings of the p2p conversation between
+    user_id and peer_id as they are saved.
+    """
+    await _push_websocket(websocket, conversation_key_for(user_id, peer_id))
+
+@router.get("/conversation/events")
+async def conversation_events(user_id: str, peer_id: str):
+    """Server-Sent Events variant of /conversation/ws."""
+    return _push_sse(conversation_key_for(user_id, peer_id))
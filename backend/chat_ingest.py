@@ -0,0 +1,138 @@
+# chat_ingest.py
+"""
+Group-commit write-behind buffer for chat message ingestion.
+
+With one transaction per message, SQLite pays one fsync per message, which
+caps the ingest rate. When CHAT_WRITE_BUFFER=1, the chat endpoints hand their
+messages (and the background job each one queues) to a ChatWriteBuffer
+instead. The buffer collects them until CHAT_WRITE_BUFFER_MAX_SIZE are waiting
+or the oldest has waited CHAT_WRITE_BUFFER_MAX_DELAY_MS, then writes the whole
+group with one batched insert in a single transaction. Each caller awaits its
+own entry and is only acknowledged once that transaction has committed, so an
+acknowledged message is durable exactly as before.
+
+Flushes run one at a time; while one commits, the next group accumulates.
+
+If the group insert fails because of one bad entry (a constraint violation, a
+value the column cannot take), the group is split in half and each half is
+retried, down to single entries, so only the callers whose entries fail get
+the exception and everyone else in the group is still committed. Errors
+that mean the database itself is unavailable fail the whole group at once.
+"""
+import os
+import asyncio
+from typing import List, Optional, Tuple
+
+from sqlalchemy.exc import InterfaceError, OperationalError
+
+import metrics
+from db_async import unit_of_work, save_chat_messages
+from job_queue import enqueue_jobs_async
+
+CHAT_WRITE_BUFFER = os.getenv("CHAT_WRITE_BUFFER", "0") == "1"
+CHAT_WRITE_BUFFER_MAX_SIZE = int(os.getenv("CHAT_WRITE_BUFFER_MAX_SIZE", "256"))
+CHAT_WRITE_BUFFER_MAX_DELAY_MS = float(os.getenv("CHAT_WRITE_BUFFER_MAX_DELAY_MS", "10"))
+
+# (message_data, (job_kind, job_payload) or None, future)
+_Entry = Tuple[dict, Optional[Tuple[str, dict]], asyncio.Future]
+
+
+class ChatWriteBuffer:
+    def __init__(
+        self,
+        max_size: int = CHAT_WRITE_BUFFER_MAX_SIZE,
+        max_delay_ms: float = CHAT_WRITE_BUFFER_MAX_DELAY_MS,
+    ):
+        self.max_size = max_size
+        self.max_delay = max_delay_ms / 1000
+        self._pending: List[_Entry] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._tasks = set()  # keeps in-flight flush tasks referenced until they finish
+
+    async def save(self, message_data: dict, job: Optional[Tuple[str, dict]] = None) -> dict:
+        """
+        Queues `message_data` (and optionally a (kind, payload) job to enqueue
+        with it) for the next group commit. Returns {"message_id", "job_id",
+        "row"} (row: the saved ChatMessageDB) once the group has been committed;
+        raises if the commit failed.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((message_data, job, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._write(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _write(self, batch: List[_Entry]):
+        if self._flush_lock is None:
+            # Created lazily so the lock binds to the running event loop.
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            metrics.incr("chat_ingest.flushes")
+            metrics.observe("chat_ingest.batch_size", len(batch))
+            await self._write_group(batch)
+
+    async def _write_group(self, batch: List[_Entry]):
+        try:
+            async with unit_of_work() as session:
+                rows = await save_chat_messages(session, [message_data for message_data, _, _ in batch])
+                jobs = [job for _, job, _ in batch if job]
+                new_job_ids = iter(await enqueue_jobs_async(session, jobs) if jobs else [])
+                job_ids = [next(new_job_ids) if job else None for _, job, _ in batch]
+        except (OperationalError, InterfaceError) as e:
+            self._fail(batch, e)
+            return
+        except Exception as e:
+            if len(batch) == 1:
+                self._fail(batch, e)
+                return
+            # Find the bad entries by bisection; the rest of the group is still written.
+            metrics.incr("chat_ingest.group_split")
+            middle = len(batch) // 2
+            await self._write_group(batch[:middle])
+            await self._write_group(batch[middle:])
+            return
+        for (_, _, future), row, job_id in zip(batch, rows, job_ids):
+            if not future.done():
+                future.set_result({"message_id": row.id, "job_id": job_id, "row": row})
+
+    @staticmethod
+    def _fail(batch: List[_Entry], error: Exception):
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    async def close(self):
+        """Writes out anything still pending and waits for in-flight flushes."""
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+
+_buffer: Optional[ChatWriteBuffer] = None
+
+
+def get_chat_write_buffer() -> ChatWriteBuffer:
+    """Returns the process-wide chat write buffer."""
+    global _buffer
+    if _buffer is None:
+        _buffer = ChatWriteBuffer()
+    return _buffer
+
+
+async def close_chat_write_buffer():
+    if _buffer is not None:
+        await _buffer.close()
@@ -1,13 +1,237 @@
 # cloud_storage.py
-from google.cloud import storage
+"""
+Evidence storage backends and the streaming upload pipeline.
+
+STORAGE_BACKEND selects where uploads go:
+  - "gcs" (default): Google Cloud Storage, using one shared client per process.
+    Assumes that your GOOGLE_APPLICATION_CREDENTIALS is set.
+  - "local": a directory on the local filesystem (LOCAL_STORAGE_DIR), useful
+    for development and offline benchmarks.
+
+`stream_upload_deduplicated` reads an UploadFile in chunks on a dedicated
+thread pool, computing the SHA-256 and size as it goes, so large uploads never
+block the event loop or sit in memory in full, and stores it under a
+content-addressed key (derived from the SHA-256), so identical files are only
+stored once.
+"""
 import os
+import uuid
+import asyncio
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+import metrics
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "gcs")
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", "./uploads")
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+STORAGE_MAX_CONCURRENCY = int(os.getenv("STORAGE_MAX_CONCURRENCY", "8"))
+
+_io_executor = ThreadPoolExecutor(max_workers=STORAGE_MAX_CONCURRENCY, thread_name_prefix="storage")
+
+
+class StorageBackend:
+    """Interface implemented by the storage backends."""
+
+    def open_writer(self, key: str):
+        """Returns a writer with write(bytes), close() -> uri and abort() methods."""
+        raise NotImplementedError
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def uri_for(self, key: str) -> str:
+        raise NotImplementedError
+
+
+class _GCSWriter:
+    def __init__(self, blob, uri: str, chunk_size: int):
+        self._file = blob.open("wb", chunk_size=chunk_size)
+        self._uri = uri
+
+    def write(self, data: bytes):
+        self._file.write(data)
+
+    def close(self) -> str:
+        self._file.close()
+        return self._uri
+
+    def abort(self):
+        # Closing an unfinished resumable upload would commit it. Cancel the
+        # session instead (a DELETE on its URI), so it does not linger on the
+        # bucket; nothing was sent yet if less than one chunk was written.
+        upload_and_transport = getattr(self._file, "_upload_and_transport", None)
+        self._file = None
+        if not upload_and_transport:
+            return
+        upload, transport = upload_and_transport
+        if getattr(upload, "resumable_url", None):
+            try:
+                transport.delete(upload.resumable_url)
+            except Exception as e:
+                print(f"Could not cancel the upload session for {self._uri}: {e}")
+
+
+class GCSStorageBackend(StorageBackend):
+    """Google Cloud Storage backend. The client and bucket handle are created once and reused."""
+
+    _client = None
+    _client_lock = threading.Lock()
+
+    def __init__(self, bucket_name: str, chunk_size: int = UPLOAD_CHUNK_SIZE):
+        self.bucket_name = bucket_name
+        # Resumable uploads need a multiple of 256 KiB.
+        self.chunk_size = max(256 * 1024, chunk_size - chunk_size % (256 * 1024))
+        self._bucket = None
+
+    @classmethod
+    def get_client(cls):
+        if cls._client is None:
+            with cls._client_lock:
+                if cls._client is None:
+                    from google.cloud import storage
+                    cls._client = storage.Client()
+        return cls._client
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = self.get_client().bucket(self.bucket_name)
+        return self._bucket
+
+    def uri_for(self, key: str) -> str:
+        return f"gs://{self.bucket_name}/{key}"
+
+    def open_writer(self, key: str) -> _GCSWriter:
+        return _GCSWriter(self.bucket.blob(key), self.uri_for(key), self.chunk_size)
+
+    def exists(self, key: str) -> bool:
+        return self.bucket.blob(key).exists()
+
+
+class _LocalWriter:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._path = path
+        # Write to a temporary name so readers never see a partial file.
+        self._tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+        self._file = open(self._tmp_path, "wb")
+
+    def write(self, data: bytes):
+        self._file.write(data)
+
+    def close(self) -> str:
+        self._file.close()
+        os.replace(self._tmp_path, self._path)
+        return f"file://{self._path}"
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+class LocalStorageBackend(StorageBackend):
+    """Stores objects as files under `root_dir`."""
+
+    def __init__(self, root_dir: str = LOCAL_STORAGE_DIR):
+        self.root_dir = os.path.abspath(root_dir)
+
+    def _path(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root_dir, key))
+        if not path.startswith(self.root_dir + os.sep):
+            raise ValueError(f"Invalid storage key: {key}")
+        return path
+
+    def uri_for(self, key: str) -> str:
+        return f"file://{self._path(key)}"
+
+    def open_writer(self, key: str) -> _LocalWriter:
+        return _LocalWriter(self._path(key))
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+
+_backends: Dict[str, StorageBackend] = {}
+
+
+def get_storage_backend(bucket_name: str) -> StorageBackend:
+    """Returns the process-wide backend selected by STORAGE_BACKEND."""
+    backend = _backends.get(bucket_name)
+    if backend is None:
+        if STORAGE_BACKEND == "local":
+            backend = LocalStorageBackend(os.path.join(LOCAL_STORAGE_DIR, bucket_name))
+        else:
+            backend = GCSStorageBackend(bucket_name)
+        _backends[bucket_name] = backend
+    return backend
+
+
+def set_storage_backend(bucket_name: str, backend: StorageBackend):
+    """Overrides the backend used for `bucket_name` (e.g. to use local storage in benchmarks)."""
+    _backends[bucket_name] = backend
+
+
+def content_key(sha256: str, prefix: str = "evidence") -> str:
+    """Content-addressed storage key for an object with the given SHA-256."""
+    return f"{prefix}/{sha256[:2]}/{sha256}"
+
+
+def _copy_to_backend(source_file, backend: StorageBackend, key: str, chunk_size: int) -> str:
+    source_file.seek(0)
+    writer = backend.open_writer(key)
+    try:
+        while True:
+            chunk = source_file.read(chunk_size)
+            if not chunk:
+                break
+            writer.write(chunk)
+        return writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+
+
+async def stream_upload_deduplicated(
+    upload_file, backend: StorageBackend, prefix: str = "evidence", chunk_size: int = UPLOAD_CHUNK_SIZE
+) -> dict:
+    """
+    Streams a FastAPI UploadFile to a local spool file while hashing it, then
+    stores it under its content-addressed key unless an object with the same
+    content already exists.
+
+    Returns a dict with "uri", "size", "sha256" and "deduplicated" (True if the
+    content was already stored and the upload was skipped).
+    """
+    loop = asyncio.get_running_loop()
+    digest = hashlib.sha256()
+    size = 0
+    spool = await loop.run_in_executor(_io_executor, tempfile.TemporaryFile)
+
+    def write_chunk(chunk: bytes):
+        digest.update(chunk)
+        spool.write(chunk)
 
-# Assumes that your GOOGLE_APPLICATION_CREDENTIALS is set
-def upload_file_to_bucket(source_file, bucket_name, destination_blob_name):
-    """Uploads a file to the bucket."""
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
+    try:
+        while True:
+            chunk = await upload_file.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            await loop.run_in_executor(_io_executor, write_chunk, chunk)
+        sha256 = digest.hexdigest()
+        key = content_key(sha256, prefix)
+        deduplicated = await loop.run_in_executor(_io_executor, backend.exists, key)
+        if deduplicated:
+            uri = backend.uri_for(key)
+        else:
+            uri = await loop.run_in_executor(_io_executor, _copy_to_backend, spool, backend, key, chunk_size)
+    finally:
+        await loop.run_in_executor(_io_executor, spool.close)
+    metrics.incr("evidence.dedupe.hit" if deduplicated else "evidence.dedupe.miss")
+    return {"uri": uri, "size": size, "sha256": sha256, "deduplicated": deduplicated}
 
-    blob.upload_from_file(source_file)
-    return f"gs://{bucket_name}/{destination_blob_name}"
@@ -1,16 +1,47 @@
 import os
 import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Float, JSON, ForeignKey, Boolean
+from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Float, JSON, ForeignKey, Boolean, Index, and_, or_, func, event, select, case
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 
+from dispute_cache import invalidate_dispute
+
 # Use the DATABASE_URL environment variable if provided, otherwise default to a local SQLite DB
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./test.db")
 
+# Default bounds for conversation history windows (see conversation_window_query).
+CHAT_HISTORY_WINDOW = int(os.getenv("CHAT_HISTORY_WINDOW", "50"))
+CHAT_HISTORY_MINUTES = int(os.getenv("CHAT_HISTORY_MINUTES", "1440"))
+
+# SQLite connection tuning (see apply_sqlite_pragmas). Set SQLITE_TUNING=0 to use SQLite's defaults.
+SQLITE_TUNING = os.getenv("SQLITE_TUNING", "1") == "1"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_SIZE_KIB = int(os.getenv("SQLITE_CACHE_SIZE_KIB", "65536"))
+SQLITE_MMAP_SIZE_BYTES = int(os.getenv("SQLITE_MMAP_SIZE_BYTES", str(256 * 1024 * 1024)))
+
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
     connect_args={"check_same_thread": False} if "sqlite" in SQLALCHEMY_DATABASE_URL else {}
 )
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Tunes each new SQLite connection: WAL lets readers run alongside the writer,
+    synchronous=NORMAL skips the per-commit fsync of the WAL (still crash-safe),
+    and busy_timeout makes concurrent writers wait instead of failing.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KIB}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE_BYTES}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+if SQLITE_TUNING and SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
+    event.listen(engine, "connect", apply_sqlite_pragmas)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -18,6 +49,8 @@ Base = declarative_base()
 # Database model for chat messages. A column "dispute_id" has been added to
 # optionally bind messages to a dispute conversation.
 # The "flagged" column indicates if the conversation has been flagged for potential fraud or risky behavior.
+# "conversation_key" identifies the conversation a message belongs to (see conversation_key_for)
+# and, together with created_at, backs the windowed history lookups.
 class ChatMessageDB(Base):
     __tablename__ = "chat_messages"
     id = Column(Integer, primary_key=True, index=True)
@@ -27,6 +60,13 @@ class ChatMessageDB(Base):
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     dispute_id = Column(String, nullable=True)
     flagged = Column(Boolean, default=False)
+    conversation_key = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index("ix_chat_messages_conversation_created", "conversation_key", "created_at", "id"),
+        Index("ix_chat_messages_dispute_created", "dispute_id", "created_at"),
+        Index("ix_chat_messages_pair_created", "sender_id", "receiver_id", "created_at"),
+    )
 
 # Database model for dispute submissions. Evidence is stored as a one-to-one relationship.
 class DisputeSubmissionDB(Base):
@@ -52,12 +92,82 @@ class EvidenceDB(Base):
     upload_timestamp = Column(DateTime, default=datetime.datetime.utcnow)
     verification_status = Column(String, nullable=True)
     evidence_metadata = Column(JSON, default={}) 
-    dispute_id = Column(Integer, ForeignKey("disputes.id"))
+    content_hash = Column(String, nullable=True, index=True)
+    size = Column(Integer, nullable=True)
+    dispute_id = Column(Integer, ForeignKey("disputes.id"), index=True)
     dispute = relationship("DisputeSubmissionDB", back_populates="evidence")
 
-# Call this to create tables automatically on app start-up
+# Cached video analysis results, keyed by evidence content hash plus the model and
+# prompt version that produced them (see video_analysis.analyze_video).
+class VideoAnalysisCacheDB(Base):
+    __tablename__ = "video_analysis_cache"
+    id = Column(Integer, primary_key=True, index=True)
+    content_hash = Column(String, nullable=False)
+    model = Column(String, nullable=False)
+    prompt_version = Column(String, nullable=False)
+    result = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index("ux_video_analysis_cache_key", "content_hash", "model", "prompt_version", unique=True),
+    )
+
+# Rolling fraud-analysis state per conversation, used by ChatFraudDetector's
+# incremental mode so each analysis only needs to send the new messages.
+class ConversationFraudStateDB(Base):
+    __tablename__ = "conversation_fraud_state"
+    conversation_key = Column(String, primary_key=True)
+    summary = Column(Text, default="")
+    risk_score = Column(Float, default=0.0)
+    is_fraudulent = Column(Boolean, default=False)
+    reason = Column(Text, nullable=True)
+    last_message_id = Column(Integer, nullable=True)
+    analyses_since_full = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+# Durable background job, processed by the worker pool in job_queue.py.
+# status is one of "queued", "running", "succeeded" or "failed".
+class JobDB(Base):
+    __tablename__ = "jobs"
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)
+    payload = Column(JSON, default={})
+    status = Column(String, default="queued", nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    max_attempts = Column(Integer, default=5, nullable=False)
+    run_after = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    locked_by = Column(String, nullable=True)
+    locked_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    result = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_jobs_status_run_after", "status", "run_after", "id"),
+    )
+
+# Cross-process single-flight coordination (see singleflight.DatabaseSingleFlight):
+# a lock row elects the process that computes a key, and the result row
+# publishes what it computed to the others.
+class SingleFlightLockDB(Base):
+    __tablename__ = "singleflight_locks"
+    key = Column(String, primary_key=True)
+    owner = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+class SingleFlightResultDB(Base):
+    __tablename__ = "singleflight_results"
+    key = Column(String, primary_key=True)
+    result = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+# Call this to create tables automatically on app start-up, then bring existing
+# tables up to date (see migrations.py).
 def init_db():
+    from migrations import run_migrations
     Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
 
 # Dependency for FastAPI routes if needed
 def get_db():
@@ -67,10 +177,39 @@ def get_db():
     finally:
         db.close()
 
+def to_utc_naive(value):
+    """
+    Converts a timezone-aware datetime to naive UTC, the convention used by the
+    created_at columns. Naive values are returned unchanged.
+    """
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+def conversation_key_for(sender_id: str, receiver_id: str, dispute_id: str = None) -> str:
+    """
+    Returns the key of the conversation a message belongs to: the dispute if the
+    message is bound to one, otherwise the (unordered) sender/receiver pair.
+    """
+    if dispute_id:
+        return f"dispute:{dispute_id}"
+    first, second = sorted([sender_id, receiver_id])
+    return f"pair:{first}:{second}"
+
+# Builds a ChatMessageDB row from a message dict.
+# The conversation key is derived from the message if the caller did not provide one.
+def chat_message_row(message_data: dict) -> ChatMessageDB:
+    message_data = dict(message_data)
+    if not message_data.get("conversation_key"):
+        message_data["conversation_key"] = conversation_key_for(
+            message_data["sender_id"], message_data["receiver_id"], message_data.get("dispute_id")
+        )
+    return ChatMessageDB(**message_data)
+
 # Helper function to save a chat message to the database.
 def save_chat_message(message_data: dict):
     db = SessionLocal()
-    chat_message = ChatMessageDB(**message_data)
+    chat_message = chat_message_row(message_data)
     db.add(chat_message)
     db.commit()
     db.refresh(chat_message)
@@ -88,10 +227,60 @@ def get_chat_history(dispute_id: str = None):
     db.close()
     return messages
 
+def conversation_window_query(
+    conversation_key: str,
+    limit: int = CHAT_HISTORY_WINDOW,
+    since_minutes: int = CHAT_HISTORY_MINUTES,
+    before: tuple = None,
+):
+    """
+    The query behind db_async.get_conversation_window: the most recent
+    messages of a conversation, newest first.
+
+    At most `limit` messages from the last `since_minutes` minutes are selected
+    (pass None to disable either bound). For keyset pagination, pass the
+    (created_at, id) of the oldest message of the previous page as `before` to
+    get the page preceding it. The query is served by the
+    (conversation_key, created_at, id) index, so its cost does not depend on
+    the size of the table.
+    """
+    query = select(
+        ChatMessageDB.id,
+        ChatMessageDB.sender_id,
+        ChatMessageDB.receiver_id,
+        ChatMessageDB.message,
+        ChatMessageDB.created_at,
+        ChatMessageDB.dispute_id,
+    ).where(ChatMessageDB.conversation_key == conversation_key)
+    if since_minutes is not None:
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(minutes=since_minutes)
+        query = query.where(ChatMessageDB.created_at >= cutoff)
+    if before is not None:
+        before_created_at, before_id = before
+        query = query.where(or_(
+            ChatMessageDB.created_at < before_created_at,
+            and_(ChatMessageDB.created_at == before_created_at, ChatMessageDB.id < before_id),
+        ))
+    query = query.order_by(ChatMessageDB.created_at.desc(), ChatMessageDB.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+# Builds a DisputeSubmissionDB row (with its evidence row, if included) from a pydantic DisputeSubmission dict.
+def dispute_row(dispute_data: dict) -> DisputeSubmissionDB:
+    dispute_data = dict(dispute_data)
+    evidence_data = dispute_data.pop("evidence", None)
+    if dispute_data.get("created_at") is not None:
+        dispute_data["created_at"] = to_utc_naive(dispute_data["created_at"])
+    dispute = DisputeSubmissionDB(**dispute_data)
+    if evidence_data:
+        dispute.evidence = evidence_row(evidence_data)
+    return dispute
+
 # Helper function to save a dispute submission.
 def save_dispute(dispute_data: dict):
     db = SessionLocal()
-    dispute = DisputeSubmissionDB(**dispute_data)
+    dispute = dispute_row(dispute_data)
     db.add(dispute)
     db.commit()
     db.refresh(dispute)
@@ -99,26 +288,68 @@ def save_dispute(dispute_data: dict):
     return dispute
 
 # Helper function to save evidence.
+# Builds an EvidenceDB row from a pydantic Evidence dict.
+# The pydantic "metadata" field is stored in the "evidence_metadata" column.
+def evidence_row(evidence_data: dict) -> EvidenceDB:
+    evidence_data = dict(evidence_data)
+    if "metadata" in evidence_data:
+        evidence_data["evidence_metadata"] = evidence_data.pop("metadata")
+    if evidence_data.get("upload_timestamp") is not None:
+        evidence_data["upload_timestamp"] = to_utc_naive(evidence_data["upload_timestamp"])
+    return EvidenceDB(**evidence_data)
+
 def save_evidence(evidence_data: dict):
     db = SessionLocal()
-    evidence = EvidenceDB(**evidence_data)
+    evidence = evidence_row(evidence_data)
     db.add(evidence)
     db.commit()
     db.refresh(evidence)
     db.close()
+    invalidate_dispute(evidence.dispute_id)
     return evidence
 
-def update_evidence_metadata(evidence_id: int, metadata: dict):
+def get_content_hash_for_uri(file_url: str):
+    """
+    Returns the content hash recorded for evidence stored at `file_url`, or None.
+    """
+    db = SessionLocal()
+    try:
+        row = db.query(EvidenceDB.content_hash).filter(
+            EvidenceDB.file_url == file_url, EvidenceDB.content_hash.isnot(None)
+        ).first()
+        return row.content_hash if row else None
+    finally:
+        db.close()
+
+def get_cached_video_analysis(content_hash: str, model: str, prompt_version: str):
+    """
+    Returns the cached video analysis result for the given key, or None.
+    """
     db = SessionLocal()
-    evidence = db.query(EvidenceDB).filter(EvidenceDB.id == evidence_id).first()
-    if evidence:
-        current_metadata = evidence.metadata or {}
-        current_metadata.update(metadata)
-        evidence.metadata = current_metadata
+    try:
+        row = db.query(VideoAnalysisCacheDB.result).filter(
+            VideoAnalysisCacheDB.content_hash == content_hash,
+            VideoAnalysisCacheDB.model == model,
+            VideoAnalysisCacheDB.prompt_version == prompt_version,
+        ).first()
+        return row.result if row else None
+    finally:
+        db.close()
+
+def save_video_analysis(content_hash: str, model: str, prompt_version: str, result: str):
+    """
+    Stores a video analysis result. If another worker cached the same key first, its entry is kept.
+    """
+    db = SessionLocal()
+    try:
+        db.add(VideoAnalysisCacheDB(
+            content_hash=content_hash, model=model, prompt_version=prompt_version, result=result
+        ))
         db.commit()
-        db.refresh(evidence)
-    db.close()
-    return evidence
+    except IntegrityError:
+        db.rollback()
+    finally:
+        db.close()
 
 def flag_conversation(dispute_id: str):
     """
@@ -131,6 +362,73 @@ def flag_conversation(dispute_id: str):
     finally:
         db.close()
 
+CHAT_HISTORY_YIELD_PER = int(os.getenv("CHAT_HISTORY_YIELD_PER", "500"))
+
+def split_chat_history_query(
+    dispute_id: str,
+    dispute_created_at,
+    phase: str = None,
+    after: tuple = None,
+    limit: int = None,
+):
+    """
+    The query behind iter_split_chat_history (and its db_async counterpart):
+    the dispute's chat messages, oldest first, with the pre/post split
+    computed in SQL and only the needed columns selected.
+    """
+    dispute_created_at = to_utc_naive(dispute_created_at)
+    is_pre = ChatMessageDB.created_at < dispute_created_at
+    query = select(
+        ChatMessageDB.id,
+        ChatMessageDB.sender_id,
+        ChatMessageDB.message,
+        ChatMessageDB.created_at,
+        case((is_pre, "pre"), else_="post").label("phase"),
+    ).where(ChatMessageDB.dispute_id == str(dispute_id))
+    if phase == "pre":
+        query = query.where(is_pre)
+    elif phase == "post":
+        query = query.where(ChatMessageDB.created_at >= dispute_created_at)
+    if after is not None:
+        after_created_at, after_id = after
+        query = query.where(or_(
+            ChatMessageDB.created_at > after_created_at,
+            and_(ChatMessageDB.created_at == after_created_at, ChatMessageDB.id > after_id),
+        ))
+    query = query.order_by(ChatMessageDB.created_at.asc(), ChatMessageDB.id.asc())
+    if limit is not None:
+        query = query.limit(limit)
+    return query.execution_options(yield_per=CHAT_HISTORY_YIELD_PER)
+
+def iter_split_chat_history(
+    dispute_id: str,
+    dispute_created_at,
+    phase: str = None,
+    after: tuple = None,
+    limit: int = None,
+):
+    """
+    Yields the chat messages of a dispute, oldest first, as dicts with id,
+    sender_id, message, created_at and phase ("pre" for messages sent before
+    dispute_created_at, "post" otherwise).
+
+    The split is computed by the query, only the needed columns are selected
+    and rows are fetched in batches of CHAT_HISTORY_YIELD_PER, so memory use
+    does not grow with the length of the history. Pass phase="pre"/"post" to
+    get one side only, `after` = (created_at, id) of the last message of the
+    previous page to resume after it, and `limit` to cap the number of rows.
+    """
+    query = split_chat_history_query(dispute_id, dispute_created_at, phase, after, limit)
+    db = SessionLocal()
+    try:
+        for row in db.execute(query):
+            yield row._asdict()
+    finally:
+        db.close()
+
+def format_chat_record(record: dict) -> str:
+    return f"{record['sender_id']}: {record['message']} (at {record['created_at']})"
+
 def get_split_chat_history(dispute_id: str, dispute_created_at):
     """
     Retrieve all chat messages for the given dispute_id and split them into two groups:
@@ -139,16 +437,12 @@ def get_split_chat_history(dispute_id: str, dispute_created_at):
     
     Each message is formatted as "sender_id: message (at created_at)".
     """
-    db = SessionLocal()
-    messages = db.query(ChatMessageDB).filter(ChatMessageDB.dispute_id == dispute_id).order_by(ChatMessageDB.created_at.asc()).all()
-    db.close()
+    return join_split_chat_history(iter_split_chat_history(dispute_id, dispute_created_at))
 
+def join_split_chat_history(records) -> tuple:
+    """Formats records from iter_split_chat_history as (pre_chat, post_chat) strings."""
     pre_chat = []
     post_chat = []
-    for msg in messages:
-        formatted_msg = f"{msg.sender_id}: {msg.message} (at {msg.created_at})"
-        if msg.created_at < dispute_created_at:
-            pre_chat.append(formatted_msg)
-        else:
-            post_chat.append(formatted_msg)
+    for record in records:
+        (pre_chat if record["phase"] == "pre" else post_chat).append(format_chat_record(record))
     return "\n".join(pre_chat), "\n".join(post_chat)
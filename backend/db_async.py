@@ -0,0 +1,291 @@
+# db_async.py
+"""
+Native async data layer for the request path.
+
+Uses an async SQLAlchemy engine on the same database as db.py (aiosqlite for
+SQLite URLs, asyncpg for PostgreSQL), so endpoints no longer push blocking
+helpers onto the default thread pool. Sessions are handed out as units of
+work: everything done inside one `unit_of_work()` block is committed in a
+single transaction, or rolled back together if the block raises.
+
+    async with unit_of_work() as session:
+        await save_chat_message(session, first)
+        await save_chat_message(session, second)
+        await flag_conversation(session, dispute_id)
+
+The helpers take the session as their first argument and only flush; the
+unit of work commits. The ORM models are shared with db.py.
+"""
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional
+
+from sqlalchemy import event, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import joinedload
+
+from dispute_cache import invalidate_dispute_after_commit
+from db import (
+    SQLALCHEMY_DATABASE_URL,
+    SQLITE_TUNING,
+    CHAT_HISTORY_WINDOW,
+    CHAT_HISTORY_MINUTES,
+    apply_sqlite_pragmas,
+    ChatMessageDB,
+    ConversationFraudStateDB,
+    DisputeSubmissionDB,
+    EvidenceDB,
+    chat_message_row,
+    conversation_window_query,
+    dispute_row,
+    evidence_row,
+    split_chat_history_query,
+)
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30"))
+
+
+def async_database_url(url: str) -> str:
+    """Maps a sync database URL to the matching async driver."""
+    if url.startswith("sqlite:"):
+        return "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    if url.startswith("postgres://"):
+        return "postgresql+asyncpg://" + url[len("postgres://"):]
+    if url.startswith("postgresql:") or url.startswith("postgresql+psycopg2:"):
+        return "postgresql+asyncpg:" + url.split(":", 1)[1]
+    return url
+
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", async_database_url(SQLALCHEMY_DATABASE_URL))
+
+_pool_args = {}
+if ":memory:" not in ASYNC_DATABASE_URL:
+    _pool_args = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT_SECONDS,
+        "pool_pre_ping": True,
+    }
+
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **_pool_args)
+if SQLITE_TUNING and ASYNC_DATABASE_URL.startswith("sqlite"):
+    event.listen(async_engine.sync_engine, "connect", apply_sqlite_pragmas)
+# Objects stay usable after commit (e.g. to return their ids) without a reload.
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+
+@asynccontextmanager
+async def unit_of_work() -> AsyncIterator[AsyncSession]:
+    """Yields a session whose work is committed as one transaction on exit."""
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            yield session
+
+
+async def dispose_engine():
+    """Closes the pooled connections (called on application shutdown)."""
+    await async_engine.dispose()
+
+
+async def save_chat_message(session: AsyncSession, message_data: dict) -> ChatMessageDB:
+    """Adds a chat message, deriving its conversation key if the caller did not provide one."""
+    chat_message = chat_message_row(message_data)
+    session.add(chat_message)
+    await session.flush()
+    return chat_message
+
+
+async def save_chat_messages(session: AsyncSession, messages: List[dict]) -> List[ChatMessageDB]:
+    """Adds several chat messages with a single flush."""
+    rows = [chat_message_row(message_data) for message_data in messages]
+    session.add_all(rows)
+    await session.flush()
+    return rows
+
+
+async def get_chat_history(session: AsyncSession, dispute_id: str = None) -> List[ChatMessageDB]:
+    """Returns the chat messages of a dispute, or all messages if no dispute_id is given."""
+    query = select(ChatMessageDB)
+    if dispute_id:
+        query = query.where(ChatMessageDB.dispute_id == dispute_id)
+    result = await session.scalars(query)
+    return list(result)
+
+
+async def get_conversation_window(
+    session: AsyncSession,
+    conversation_key: str,
+    limit: int = CHAT_HISTORY_WINDOW,
+    since_minutes: int = CHAT_HISTORY_MINUTES,
+    before: tuple = None,
+) -> List[dict]:
+    """
+    Returns a bounded window of the most recent messages in a conversation,
+    oldest first, as plain dicts (see db.conversation_window_query for the bounds).
+    """
+    rows = (await session.execute(conversation_window_query(conversation_key, limit, since_minutes, before))).all()
+    return [row._asdict() for row in reversed(rows)]
+
+
+async def flag_conversation(session: AsyncSession, dispute_id: str):
+    """Marks all chat messages of a dispute as flagged."""
+    await session.execute(
+        update(ChatMessageDB)
+        .where(ChatMessageDB.dispute_id == dispute_id)
+        .values(flagged=True)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def save_dispute(session: AsyncSession, dispute_data: dict) -> DisputeSubmissionDB:
+    """Adds a dispute submission (and its evidence, if included)."""
+    dispute = dispute_row(dispute_data)
+    session.add(dispute)
+    await session.flush()
+    return dispute
+
+
+async def save_evidence(session: AsyncSession, evidence_data: dict) -> EvidenceDB:
+    """Adds an evidence record. The dispute's cached aggregate is invalidated on commit."""
+    evidence = evidence_row(evidence_data)
+    session.add(evidence)
+    await session.flush()
+    invalidate_dispute_after_commit(session, evidence.dispute_id)
+    return evidence
+
+
+async def update_evidence_metadata(session: AsyncSession, evidence_id: int, metadata: dict) -> Optional[EvidenceDB]:
+    """Merges `metadata` into an evidence record's metadata. The dispute's cached aggregate is invalidated on commit."""
+    evidence = await session.get(EvidenceDB, evidence_id)
+    if evidence is None:
+        return None
+    evidence.evidence_metadata = {**(evidence.evidence_metadata or {}), **metadata}
+    await session.flush()
+    invalidate_dispute_after_commit(session, evidence.dispute_id)
+    return evidence
+
+
+async def claim_funds_release(session: AsyncSession, dispute_id: int) -> bool:
+    """
+    Moves a dispute to the "resolved" status with a conditional UPDATE. Returns
+    True for the one caller that made the transition, False if the funds were
+    already released (the claim only holds once the unit of work commits).
+    """
+    updated = await session.execute(
+        update(DisputeSubmissionDB)
+        .where(DisputeSubmissionDB.id == dispute_id, DisputeSubmissionDB.status != "resolved")
+        .values(status="resolved")
+        .execution_options(synchronize_session=False)
+    )
+    invalidate_dispute_after_commit(session, dispute_id)
+    return updated.rowcount == 1
+
+
+async def get_conversation_fraud_state(session: AsyncSession, conversation_key: str) -> Optional[dict]:
+    """
+    Returns the stored rolling fraud-analysis state of a conversation as a dict,
+    or None if the conversation has not been analyzed yet.
+    """
+    state = await session.get(ConversationFraudStateDB, conversation_key)
+    if state is None:
+        return None
+    return {
+        "summary": state.summary or "",
+        "risk_score": state.risk_score or 0.0,
+        "is_fraudulent": bool(state.is_fraudulent),
+        "reason": state.reason,
+        "last_message_id": state.last_message_id,
+        "analyses_since_full": state.analyses_since_full or 0,
+    }
+
+
+async def save_conversation_fraud_state(session: AsyncSession, conversation_key: str, state_data: dict):
+    """Creates or updates the rolling fraud-analysis state of a conversation."""
+    state = await session.get(ConversationFraudStateDB, conversation_key)
+    if state is None:
+        state = ConversationFraudStateDB(conversation_key=conversation_key)
+        session.add(state)
+    for key, value in state_data.items():
+        setattr(state, key, value)
+    await session.flush()
+
+
+async def load_dispute_aggregate(session: AsyncSession, dispute_id: int) -> Optional[dict]:
+    """
+    Loads a dispute with its evidence (joined into the same query) and a
+    summary of both participants (their role and how many disputes each has
+    been part of). Returns None if the dispute does not exist.
+    """
+    dispute = await session.scalar(
+        select(DisputeSubmissionDB)
+        .options(joinedload(DisputeSubmissionDB.evidence))
+        .where(DisputeSubmissionDB.id == dispute_id)
+    )
+    if dispute is None:
+        return None
+    participants = {dispute.buyer_id: "buyer", dispute.seller_id: "seller"}
+    dispute_counts = dict((await session.execute(
+        select(DisputeSubmissionDB.buyer_id, func.count())
+        .where(DisputeSubmissionDB.buyer_id.in_(participants))
+        .group_by(DisputeSubmissionDB.buyer_id)
+    )).all())
+    for seller_id, count in (await session.execute(
+        select(DisputeSubmissionDB.seller_id, func.count())
+        .where(DisputeSubmissionDB.seller_id.in_(participants))
+        .group_by(DisputeSubmissionDB.seller_id)
+    )).all():
+        dispute_counts[seller_id] = dispute_counts.get(seller_id, 0) + count
+    return {
+        "dispute": dispute,
+        "evidence": dispute.evidence,
+        "participants": [
+            {
+                "user_id": user_id,
+                "role": role,
+                "dispute_count": dispute_counts.get(user_id, 0),
+            }
+            for user_id, role in participants.items()
+        ],
+    }
+
+
+async def get_dispute_watermark(session: AsyncSession, dispute_id: int) -> str:
+    """
+    Returns a string that changes whenever new chat messages or evidence are
+    recorded for the dispute: the id of its latest chat message plus the id,
+    content hash and verification status of its evidence.
+    """
+    last_message_id = await session.scalar(
+        select(func.max(ChatMessageDB.id)).where(ChatMessageDB.dispute_id == str(dispute_id))
+    )
+    evidence = (await session.execute(
+        select(EvidenceDB.id, EvidenceDB.content_hash, EvidenceDB.verification_status)
+        .where(EvidenceDB.dispute_id == dispute_id)
+        .order_by(EvidenceDB.id)
+    )).all()
+    evidence_mark = ",".join(f"{row.id}/{row.content_hash}/{row.verification_status}" for row in evidence)
+    return f"chat={last_message_id or 0};evidence={evidence_mark}"
+
+
+async def iter_split_chat_history(
+    session: AsyncSession,
+    dispute_id: str,
+    dispute_created_at,
+    phase: str = None,
+    after: tuple = None,
+    limit: int = None,
+) -> AsyncIterator[dict]:
+    """
+    Async counterpart of db.iter_split_chat_history: yields the dispute's chat
+    records, streamed from the database in batches of CHAT_HISTORY_YIELD_PER.
+    """
+    result = await session.stream(split_chat_history_query(dispute_id, dispute_created_at, phase, after, limit))
+    async for row in result:
+        yield row._asdict()
+
+
+async def get_split_chat_records(session: AsyncSession, dispute_id: str, dispute_created_at) -> list:
+    """All records of iter_split_chat_history as a list, for prompts that select among them."""
+    return [record async for record in iter_split_chat_history(session, dispute_id, dispute_created_at)]
@@ -0,0 +1,20 @@
+# dependencies.py
+"""
+FastAPI dependencies for the app-scoped services.
+
+The orchestrator (and the agents and model clients it holds) is created once
+in main.lifespan and stored on `app.state`; endpoints receive it through
+`Depends(...)` instead of building new instances per request.
+"""
+from fastapi import Request
+
+from orchestrator import DisputeOrchestrator
+from agents.dispute_resolution import DisputeResolver
+
+
+def get_orchestrator(request: Request) -> DisputeOrchestrator:
+    return request.app.state.orchestrator
+
+
+def get_dispute_resolver(request: Request) -> DisputeResolver:
+    return request.app.state.orchestrator.dispute_resolver
@@ -1,12 +1,11 @@
-from fastapi import APIRouter, BackgroundTasks, UploadFile, File, HTTPException, Form
+from fastapi import APIRouter, UploadFile, File, HTTPException, Form
 from models import DisputeSubmission, Evidence
-from orchestrator import DisputeOrchestrator
-from cloud_storage import upload_file_to_bucket
+from job_queue import enqueue_job_async
+from cloud_storage import get_storage_backend, stream_upload_deduplicated
 from dispute_manager import DisputeManager
-from db import save_evidence
+from db_async import unit_of_work, save_evidence
 import os
 from typing import Optional
-import asyncio
 
 router = APIRouter()
 
@@ -14,18 +13,23 @@ BUCKET_NAME = os.getenv("BUCKET_NAME", "deriv-dispute")
 dispute_manager = DisputeManager()
 
 @router.post("/submit")
-async def submit_dispute(dispute: DisputeSubmission, background_tasks: BackgroundTasks):
+async def submit_dispute(dispute: DisputeSubmission):
     """
     Endpoint to submit a dispute.
     The dispute details are saved to the database via the DisputeManager
     and then processed.
     """
-    dispute_record = await dispute_manager.create_dispute(dispute.dict())
-    
-    orchestrator = DisputeOrchestrator()
-    # Process the dispute in the background (AI analysis, verification, etc.)
-    background_tasks.add_task(orchestrator.process_dispute, dispute, dispute.evidence)
-    return {"status": "dispute submitted", "dispute_id": dispute_record.id}
+    async with unit_of_work() as session:
+        dispute_record = await dispute_manager.create_dispute(dispute.dict(), session)
+
+        # Process the dispute on the background job queue (AI analysis, verification, etc.).
+        # The job is committed together with the dispute.
+        job_id = await enqueue_job_async(session, "process_dispute", {
+            "dispute_id": dispute_record.id,
+            "dispute": dispute.model_dump(mode="json"),
+            "evidence": dispute.evidence.model_dump(mode="json") if dispute.evidence else None,
+        })
+    return {"status": "dispute submitted", "dispute_id": dispute_record.id, "job_id": job_id}
 
 @router.post("/upload-evidence")
 async def upload_evidence(
@@ -37,15 +41,18 @@ async def upload_evidence(
     Uploads evidence and returns an Evidence object.
     On success, stores the evidence details to the database.
     """
-    destination_blob_name = f"uploads/{transaction_id}/{file.filename}"
+    # Evidence is stored under its content hash, so re-uploads of the same file are stored once.
     try:
-        gcs_uri = upload_file_to_bucket(file.file, BUCKET_NAME, destination_blob_name)
+        stored = await stream_upload_deduplicated(file, get_storage_backend(BUCKET_NAME))
         evidence_obj = Evidence(
-            file_url=gcs_uri,
-            file_type=file_type  # Ensure this matches your ProofType enum
+            file_url=stored["uri"],
+            file_type=file_type,  # Ensure this matches your ProofType enum
+            metadata={"filename": file.filename, "transaction_id": transaction_id},
+            content_hash=stored["sha256"],
+            size=stored["size"],
         )
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, save_evidence, evidence_obj.dict())
+        async with unit_of_work() as session:
+            await save_evidence(session, evidence_obj.dict())
         return evidence_obj
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -53,11 +60,16 @@ async def upload_evidence(
 @router.post("/upload-video")
 async def upload_video(file: UploadFile = File(...)):
     """
-    Uploads a video file and returns the corresponding GCS URI.
+    Uploads a video file and returns the corresponding storage URI.
     """
-    destination_blob_name = f"uploads/videos/{file.filename}"
     try:
-        gcs_uri = upload_file_to_bucket(file.file, BUCKET_NAME, destination_blob_name)
-        return {"status": "success", "gcs_uri": gcs_uri}
+        stored = await stream_upload_deduplicated(file, get_storage_backend(BUCKET_NAME), prefix="videos")
+        return {
+            "status": "success",
+            "gcs_uri": stored["uri"],
+            "size": stored["size"],
+            "sha256": stored["sha256"],
+            "deduplicated": stored["deduplicated"],
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,106 @@
+# dispute_cache.py
+"""
+Read-through cache of dispute aggregates.
+
+A dispute aggregate (db_async.load_dispute_aggregate) is the dispute row with its
+evidence loaded in the same query, plus a participant summary. Disputes under
+active review are looked up over and over (finalize, chat history paging), so
+aggregates are kept in a small in-process LRU for DISPUTE_CACHE_TTL_SECONDS.
+
+The write helpers that change what an aggregate contains invalidate its entry
+once their transaction has committed: db.save_evidence,
+db_async.save_evidence, db_async.update_evidence_metadata and
+db_async.claim_funds_release (status change). Writes made by other processes are only picked up when
+the entry expires, so the TTL bounds how stale a cached aggregate can be.
+
+Cached rows are shared between requests and must be treated as read-only.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from sqlalchemy import event
+
+import metrics
+
+DISPUTE_CACHE_SIZE = int(os.getenv("DISPUTE_CACHE_SIZE", "1024"))
+DISPUTE_CACHE_TTL_SECONDS = float(os.getenv("DISPUTE_CACHE_TTL_SECONDS", "30"))
+
+
+class DisputeCache:
+    def __init__(self, max_size: int = DISPUTE_CACHE_SIZE, ttl_seconds: float = DISPUTE_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, aggregate)
+        # Bumped by every invalidation, so a load that raced with a write is not stored.
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def cached(self, dispute_id) -> Optional[dict]:
+        """Returns the cached aggregate, or None on a miss. Never touches the database."""
+        key = str(dispute_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            self._entries.move_to_end(key)
+        metrics.incr("dispute_cache.hit")
+        return entry[1]
+
+    async def get(self, dispute_id) -> Optional[dict]:
+        """Returns the cached aggregate, loading (and caching) it on a miss. None if the dispute does not exist."""
+        from db_async import AsyncSessionLocal, load_dispute_aggregate
+
+        aggregate = self.cached(dispute_id)
+        if aggregate is not None:
+            return aggregate
+        key = str(dispute_id)
+        with self._lock:
+            generation = self._generation
+        metrics.incr("dispute_cache.miss")
+
+        async with AsyncSessionLocal() as session:
+            aggregate = await load_dispute_aggregate(session, dispute_id)
+        if aggregate is None or self.max_size <= 0:
+            return aggregate
+        with self._lock:
+            if self._generation == generation:
+                self._entries[key] = (time.monotonic() + self.ttl, aggregate)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return aggregate
+
+    def invalidate(self, dispute_id):
+        if dispute_id is None:
+            return
+        key = str(dispute_id)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generation += 1
+        metrics.incr("dispute_cache.invalidations")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+
+dispute_cache = DisputeCache()
+
+
+async def get_dispute_aggregate(dispute_id: int) -> Optional[dict]:
+    """Returns the dispute's aggregate from the process-wide cache (see DisputeCache.get)."""
+    return await dispute_cache.get(dispute_id)
+
+
+def invalidate_dispute(dispute_id):
+    dispute_cache.invalidate(dispute_id)
+
+
+def invalidate_dispute_after_commit(session, dispute_id):
+    """Invalidates the dispute's entry once `session` (sync or async) commits."""
+    sync_session = getattr(session, "sync_session", session)
+    event.listen(sync_session, "after_commit", lambda _: dispute_cache.invalidate(dispute_id), once=True)
@@ -1,5 +1,4 @@
-import asyncio
-from db import save_dispute, get_chat_history, save_chat_message
+from db_async import unit_of_work, save_dispute, get_chat_history, save_chat_message
 from models import DisputeSubmission
 
 class DisputeManager:
@@ -7,20 +6,23 @@ class DisputeManager:
     A centralized manager for dispute lifecycle management.
     It creates disputes, retrieves dispute details and conversation history, and saves dispute chat messages.
     """
-    async def create_dispute(self, dispute_data: dict):
+    async def create_dispute(self, dispute_data: dict, session=None):
         """
-        Creates a new dispute record in the database.
+        Creates a new dispute record in the database, within the caller's unit
+        of work if a session is given.
         """
-        loop = asyncio.get_running_loop()
-        dispute = await loop.run_in_executor(None, save_dispute, dispute_data)
+        if session is not None:
+            return await save_dispute(session, dispute_data)
+        async with unit_of_work() as session:
+            dispute = await save_dispute(session, dispute_data)
         return dispute
 
     async def save_dispute_chat_message(self, message_data: dict):
         """
         Saves a dispute-related chat message using a provided dispute ID.
         """
-        loop = asyncio.get_running_loop()
-        saved_msg = await loop.run_in_executor(None, save_chat_message, message_data)
+        async with unit_of_work() as session:
+            saved_msg = await save_chat_message(session, message_data)
         return saved_msg
 
     async def get_dispute_conversation(self, dispute_id: str):
@@ -28,8 +30,8 @@ class DisputeManager:
         Retrieves the chat conversation for a specific dispute.
         This can be filtered by dispute_id.
         """
-        loop = asyncio.get_running_loop()
-        history = await loop.run_in_executor(None, get_chat_history, dispute_id)
+        async with unit_of_work() as session:
+            history = await get_chat_history(session, dispute_id)
         return history
 
     # You can add further methods such as updating dispute status or linking evidence if needed. 
\ No newline at end of file
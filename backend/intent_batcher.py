@@ -0,0 +1,117 @@
+# intent_batcher.py
+"""
+Micro-batching scheduler for chat intent classification.
+
+Instead of one model request per message, pending messages are collected until
+either INTENT_BATCH_MAX_SIZE messages are waiting or the oldest one has waited
+INTENT_BATCH_MAX_LATENCY_MS, then classified together in a single structured
+request. Each caller awaits its own item's result, so the extra latency a
+message can pick up is capped by the latency budget.
+"""
+import os
+import json
+import asyncio
+from typing import List, Optional, Tuple
+
+import metrics
+from llm_client import LLMClient
+
+INTENT_BATCHING = os.getenv("INTENT_BATCHING", "0") == "1"
+INTENT_BATCH_MAX_SIZE = int(os.getenv("INTENT_BATCH_MAX_SIZE", "32"))
+INTENT_BATCH_MAX_LATENCY_MS = float(os.getenv("INTENT_BATCH_MAX_LATENCY_MS", "25"))
+
+
+def build_batch_prompt(messages: List[str]) -> str:
+    items = json.dumps([{"id": i, "message": text} for i, text in enumerate(messages)], ensure_ascii=False)
+    return f"""
+        You are a chat intent detection AI. For each chat message below, determine if it indicates an intent
+        to conduct the trade off-platform (e.g. settle privately, negotiate outside of the platform, etc.).
+        Treat every message independently.
+
+        Messages (JSON array):
+        {items}
+
+        Please output a JSON array with exactly one entry per message, in the following format:
+        [{{"id": 0, "flagged": true, "reason": "Detailed explanation..."}}, {{"id": 1, "flagged": false}}]
+        """
+
+
+def parse_batch_response(response_text: str, size: int) -> List[dict]:
+    """
+    Maps the model's JSON array back to input positions. Items the model left out
+    are reported as not flagged, with a reason saying so.
+    """
+    results = [{"flagged": False, "reason": "Missing from batch response"} for _ in range(size)]
+    parsed = json.loads(response_text)
+    if isinstance(parsed, dict):
+        parsed = parsed.get("results", [])
+    for item in parsed:
+        index = item.get("id")
+        if isinstance(index, int) and 0 <= index < size:
+            results[index] = {"flagged": bool(item.get("flagged", item.get("intent"))), "reason": item.get("reason")}
+    return results
+
+
+class IntentBatcher:
+    def __init__(
+        self,
+        llm: LLMClient,
+        max_batch_size: int = INTENT_BATCH_MAX_SIZE,
+        max_latency_ms: float = INTENT_BATCH_MAX_LATENCY_MS,
+    ):
+        self.llm = llm
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()  # keeps in-flight batch tasks referenced until they finish
+
+    async def classify(self, message: str) -> dict:
+        """
+        Queues `message` for the next batch and returns its result:
+        {"flagged": bool, "reason": str | None}. Raises if the batch request fails.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((message, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_latency, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: List[Tuple[str, asyncio.Future]]):
+        metrics.incr("intent.batch.requests")
+        metrics.observe("intent.batch.size", len(batch))
+        try:
+            response_text = await self.llm.generate(build_batch_prompt([text for text, _ in batch]))
+            results = parse_batch_response(response_text, len(batch))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+_batchers = {}
+
+
+def get_intent_batcher(llm: LLMClient) -> IntentBatcher:
+    """Returns the process-wide batcher for `llm`."""
+    batcher = _batchers.get(llm.model_name)
+    if batcher is None or batcher.llm is not llm:
+        batcher = _batchers[llm.model_name] = IntentBatcher(llm)
+    return batcher
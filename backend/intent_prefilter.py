@@ -0,0 +1,252 @@
+# intent_prefilter.py
+"""
+Deterministic pre-classifier for off-platform intent.
+
+Runs before the LLM in DisputeOrchestrator.process_chat_intent. Each message is
+sorted into one of three buckets:
+
+- "positive":  an unmistakable attempt to move off-platform, backed by a
+               concrete contact: one of the open-ended example phrases ("My
+               Insta is...") followed by a handle or number, an invite to a
+               named messaging app, a messaging-app link, an e-mail address
+               or a phone number introduced as one. Decided locally.
+- "negative":  a short acknowledgement or greeting ("ok thanks", "hi",
+               "received") made up only of BENIGN_WORDS. Decided locally.
+- "ambiguous": everything else, including offers to settle privately, in
+               person or over another payment channel, and the other example
+               phrases ("This platform is kinda slow", "Check my Instagram"),
+               which read the same as ordinary complaints and questions. Only
+               these are sent to the model, which judges intent rather than
+               keywords.
+
+The phrase matchers are compiled from PLATFORM_SWITCH_EXAMPLES, the same list
+text_detection.build_prompt shows to the model.
+"""
+import re
+from typing import List
+
+PLATFORM_SWITCH_EXAMPLES = [
+    "Let's continue on WhatsApp",
+    "Do you have Insta?",
+    "We can talk on Telegram",
+    "Let's move to Messenger",
+    "Switch to Signal",
+    "Continue on WeChat",
+    "Talk on Viber",
+    "Hit me up on WhatsApp",
+    "My Insta is...",
+    "Text me on Telegram",
+    "DM me on Messenger",
+    "Let's chat on Signal",
+    "Add me on WeChat",
+    "My Viber is...",
+    "WhatsApp me!",
+    "Let's use Insta instead",
+    "I'm on Telegram now",
+    "Slide into my DMs on Insta",
+    "Hit me up on my WhatsApp",
+    "My Snapchat is...",
+    "Let's chat on Snap",
+    "What's your Insta?",
+    "Let's connect on TikTok",
+    "My TikTok is...",
+    "I'm bouta head to Insta",
+    "Bet, hmu on WhatsApp",
+    "Let's take this convo to Insta",
+    "This platform is kinda slow",
+    "I prefer chatting on WhatsApp",
+    "Is there a way to continue this on Telegram?",
+    "WhatsApp is easier for me",
+    "I find this platform less convenient",
+    "Let's chat on WhatsApp Business",
+    "My number is...",
+    "Call me on...",
+    "Let's connect on Facebook",
+    "Check my Instagram",
+    "My Telegram is...",
+    "Let's use Telegram instead",
+    "I'm on Imo now",
+    "Let's chat on Imo",
+    "My Imo is...",
+    "Let's use 2go",
+    "My 2go is...",
+]
+
+# Messaging apps named in the examples, plus their common short forms.
+OFF_PLATFORM_CHANNELS = [
+    "whatsapp", "whats app", "wa", "insta", "instagram", "ig", "telegram", "tele", "tg",
+    "messenger", "signal", "wechat", "viber", "snapchat", "snap", "tiktok", "facebook",
+    "fb", "imo", "2go", "discord", "skype",
+]
+# Short forms that are also ordinary words ("signal me when...", "my tele is
+# broken"); they only count after an explicit "on"/"via" invite.
+AMBIGUOUS_CHANNELS = {"wa", "ig", "tele", "tg", "signal", "snap", "fb", "imo"}
+
+# Words that suggest a message may be about contact details or another channel
+# without being conclusive on their own; reported as matches for model review.
+AMBIGUOUS_CUES = [
+    "platform", "app", "number", "phone", "contact", "call", "email", "e-mail", "outside",
+    "off", "directly", "direct", "private", "privately", "personal", "dm", "dms", "pm",
+    "inbox", "reach", "elsewhere", "another", "somewhere", "link", "handle", "id",
+    "username", "add me", "text me", "hmu", "slow", "convenient", "easier",
+]
+
+# Messages made up only of these words (and at most BENIGN_MAX_WORDS of them)
+# are acknowledgements or greetings, and are not sent to the model.
+BENIGN_WORDS = {
+    "hi", "hello", "hey", "yo", "good", "morning", "afternoon", "evening", "night",
+    "ok", "okay", "k", "kk", "okie", "alright", "sure", "yes", "yeah", "yep", "no", "nope",
+    "thanks", "thank", "you", "thx", "ty", "tq", "much", "very", "noted", "received",
+    "got", "it", "done", "great", "cool", "nice", "fine", "np", "welcome", "bye", "cheers",
+    "sir", "bro", "boss", "please", "pls", "wait", "moment", "sec", "a", "the", "and",
+}
+BENIGN_MAX_WORDS = 6
+
+_CONTACT_VERBS = (
+    r"hit\s+me\s+up|hmu|text|dm|pm|add|call|message|msg|chat|talk|continue|move|switch|"
+    r"connect|reach|contact|find|head|go|take\s+this"
+)
+# Phrases that introduce a phone number when directly followed by one.
+_PHONE_CUES = (
+    r"(?:my|our|the)\W+(?:number|no\.?|phone|hp|contact)|number|phone|hp|whats\s?app|wa|"
+    r"(?:call|text|sms|reach|contact|whatsapp|wa)\W+(?:me|us)"
+)
+# Words that make the number after a cue an id rather than a phone number
+# ("order number 0123 456 7890", "transaction no 012-345 6789").
+_ID_WORDS = (
+    r"order|transaction|txn|trx|trade|ref|reference|invoice|receipt|tracking|account|acc|"
+    r"booking|ticket|case|payment|id"
+)
+
+
+def _alternation(names) -> str:
+    names = sorted(names, key=len, reverse=True)
+    return "|".join(re.escape(name).replace(r"\ ", r"\s*") for name in names)
+
+
+_CHANNELS = _alternation(OFF_PLATFORM_CHANNELS)
+_NAMED_CHANNELS = _alternation(set(OFF_PLATFORM_CHANNELS) - AMBIGUOUS_CHANNELS)
+
+# Something a contact can actually be reached by: a messaging link, an e-mail
+# address, an @handle, a phone number, a handle-shaped token (letters mixed
+# with digits, or joined by "_" or "." with at least one letter) or a named
+# messaging app.
+_PHONE_NUMBER = r"\+?\(?\d[\d\s\-.()]{6,}\d"
+_CONTACT_TOKEN = (
+    r"(?:(?:wa\.me|t\.me|m\.me)/\S+|[\w.+-]+@[\w-]+\.[\w.-]+|@[A-Za-z0-9_.]{3,30}|"
+    + _PHONE_NUMBER
+    + r"|(?=\w*[A-Za-z])(?=\w*\d)[A-Za-z0-9]{4,30}\b"
+    + r"|(?=[\w.]*[A-Za-z])[A-Za-z0-9]+(?:[_.][A-Za-z0-9]+)+"
+    + rf"|(?:{_NAMED_CHANNELS})\b)"
+)
+
+
+def _is_open_ended(example: str) -> bool:
+    return example.rstrip("!?").endswith("...")
+
+
+def _example_to_pattern(example: str) -> str:
+    # "My Insta is..." -> r"\bmy\W+insta\W+is\b"; the "..." stands for the
+    # contact details, which OPEN_EXAMPLE_RE requires after the phrase.
+    words = re.findall(r"[\w']+", example.lower().replace("’", "'"))
+    return r"\b" + r"\W+".join(re.escape(word) for word in words) + r"\b"
+
+
+OPEN_EXAMPLE_RE = re.compile(
+    "|".join(_example_to_pattern(e) + r"\W+" + _CONTACT_TOKEN for e in PLATFORM_SWITCH_EXAMPLES if _is_open_ended(e)),
+    re.IGNORECASE,
+)
+# The other examples carry no contact and are only reported as matches for model review.
+EXAMPLE_PHRASE_RE = re.compile(
+    "|".join(_example_to_pattern(e) for e in PLATFORM_SWITCH_EXAMPLES if not _is_open_ended(e)),
+    re.IGNORECASE,
+)
+CHANNEL_INVITE_RE = re.compile(
+    rf"\b(?:{_CONTACT_VERBS})\b(?:\W+\w+){{0,3}}?\W+(?:on|via|through|in|to|at)\W+(?:my\W+)?(?:{_CHANNELS})\b"
+    rf"|\b(?:my|your|ur|ya)\W+(?:{_CHANNELS})\W+(?:is|id|handle|name|number|no)\W+" + _CONTACT_TOKEN
+    + rf"|\b(?:{_NAMED_CHANNELS})\W+me\b",
+    re.IGNORECASE,
+)
+CHANNEL_RE = re.compile(rf"\b(?:{_CHANNELS})\b", re.IGNORECASE)
+MESSAGING_URL_RE = re.compile(
+    r"\b(?:wa\.me|api\.whatsapp\.com|chat\.whatsapp\.com|t\.me|telegram\.me|m\.me|"
+    r"(?:www\.)?(?:instagram|facebook|tiktok|snapchat|wechat|viber)\.com)/\S*",
+    re.IGNORECASE,
+)
+URL_RE = re.compile(r"\bhttps?://\S+|\bwww\.\S+", re.IGNORECASE)
+EMAIL_RE = re.compile(r"\b[\w.+-]+@[\w-]+\.[\w.-]+\b")
+HANDLE_RE = re.compile(r"(?<![\w@])@[A-Za-z0-9_.]{3,30}\b")
+# Digit runs, plain or formatted ("+60 12-345 6789", "(012) 345 6789"), could
+# just as well be order or transaction ids, so they only count as a phone
+# number right after a phone cue ("my number is 0123456789", "wa me
+# 60123456789"), and not when the cue belongs to an id ("order number ...").
+BARE_DIGITS_RE = re.compile(r"(?<!\w)\d{8,15}(?!\w)")
+CUED_PHONE_RE = re.compile(
+    rf"\b(?:{_PHONE_CUES})\W+?(?:(?:is|at|on)\W+)?(\+?\d{{8,15}}|\+?\(?\d[\d\s\-.()]{{7,}}\d)(?![\w.])",
+    re.IGNORECASE,
+)
+ID_CUE_RE = re.compile(rf"\b(?:{_ID_WORDS})\W*(?:\w+\W+)?$", re.IGNORECASE)
+AMBIGUOUS_CUE_RE = re.compile(
+    r"\b(?:" + "|".join(re.escape(cue).replace(r"\ ", r"\s+") for cue in AMBIGUOUS_CUES) + r")\b",
+    re.IGNORECASE,
+)
+WORD_RE = re.compile(r"[^\W_]+")
+
+
+def _cued_phone(text: str):
+    for found in CUED_PHONE_RE.finditer(text):
+        if not ID_CUE_RE.search(text[max(found.start() - 24, 0):found.start()]):
+            return found
+    return None
+
+
+def prefilter_intent(text: str) -> dict:
+    """
+    Classifies `text` without calling the model.
+
+    Returns a dict with:
+      - decision: "positive", "negative" or "ambiguous"
+      - reason: short explanation of which rule fired
+      - matches: the matched fragments (empty for "negative"; for "ambiguous",
+        any cues found, which may be none)
+    """
+    matches: List[str] = []
+
+    for pattern, reason in (
+        (OPEN_EXAMPLE_RE, "Known off-platform phrase"),
+        (CHANNEL_INVITE_RE, "Invitation to continue on another messaging app"),
+        (MESSAGING_URL_RE, "Link to another messaging app"),
+        (EMAIL_RE, "E-mail address shared"),
+    ):
+        found = pattern.search(text)
+        if found:
+            return {"decision": "positive", "reason": reason, "matches": [found.group(0)]}
+
+    cued_phone = _cued_phone(text)
+    if cued_phone:
+        return {"decision": "positive", "reason": "Phone number shared", "matches": [cued_phone.group(1)]}
+
+    handle = HANDLE_RE.search(text)
+    channel = CHANNEL_RE.search(text)
+    if handle and channel:
+        return {
+            "decision": "positive",
+            "reason": "Messaging handle shared",
+            "matches": [handle.group(0), channel.group(0)],
+        }
+
+    words = WORD_RE.findall(text.lower())
+    if len(words) <= BENIGN_MAX_WORDS and all(word in BENIGN_WORDS for word in words):
+        return {"decision": "negative", "reason": "Acknowledgement or greeting", "matches": []}
+
+    for found in (
+        EXAMPLE_PHRASE_RE.search(text),
+        channel,
+        handle,
+        BARE_DIGITS_RE.search(text),
+        URL_RE.search(text),
+        AMBIGUOUS_CUE_RE.search(text),
+    ):
+        if found:
+            matches.append(found.group(0))
+    return {"decision": "ambiguous", "reason": "Needs model review", "matches": matches}
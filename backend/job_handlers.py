@@ -0,0 +1,78 @@
+# job_handlers.py
+"""
+Handlers for the background jobs enqueued by the chat and dispute endpoints.
+
+Importing this module registers the handlers with job_queue; both the API
+process (for in-process workers) and worker.py import it. Each handler sets
+the llm_scheduler call class its model calls are prioritized by.
+"""
+from typing import Optional
+
+from job_queue import job_handler
+from llm_scheduler import llm_call_class
+from llm_resilience import llm_deadline, DISPUTE_CHAT_DEADLINE_SECONDS
+from model_cascade import CASCADE_HIGH_VALUE_AMOUNT
+from models import ChatMessage, DisputeSubmission, Evidence
+from orchestrator import DisputeOrchestrator
+from db_async import AsyncSessionLocal, get_conversation_window
+
+_orchestrator: Optional[DisputeOrchestrator] = None
+
+
+def _get_orchestrator() -> DisputeOrchestrator:
+    global _orchestrator
+    if _orchestrator is None:
+        _orchestrator = DisputeOrchestrator()
+    return _orchestrator
+
+
+def set_orchestrator(orchestrator: DisputeOrchestrator):
+    """Shares the API's app-scoped orchestrator with the in-process job handlers."""
+    global _orchestrator
+    _orchestrator = orchestrator
+
+
+@job_handler("process_dispute")
+async def process_dispute(payload: dict) -> dict:
+    dispute = DisputeSubmission(**payload["dispute"])
+    evidence = Evidence(**payload["evidence"]) if payload.get("evidence") else None
+    # High-value disputes are scheduled with finalization priority.
+    priority = 0 if dispute.amount >= CASCADE_HIGH_VALUE_AMOUNT else None
+    with llm_call_class("dispute", priority):
+        return await _get_orchestrator().process_dispute(dispute, evidence, payload.get("dispute_id"))
+
+
+@job_handler("process_chat_message")
+async def process_chat_message(payload: dict) -> dict:
+    with llm_call_class("chat_scan"):
+        return await _get_orchestrator().process_chat_message(ChatMessage(**payload["message"]))
+
+
+@job_handler("process_chat_messages")
+async def process_chat_messages(payload: dict) -> dict:
+    messages = [ChatMessage(**message) for message in payload["messages"]]
+    with llm_call_class("chat_scan"):
+        return {"results": await _get_orchestrator().process_chat_messages(messages)}
+
+
+@job_handler("process_chat_for_fraud")
+async def process_chat_for_fraud(payload: dict) -> dict:
+    """
+    Analyzes the conversation window of `conversation_key`, plus the triggering
+    message(s) if they were not persisted.
+    """
+    async with AsyncSessionLocal() as session:
+        history = await get_conversation_window(session, payload["conversation_key"])
+    if payload.get("message"):
+        history.append(payload["message"])
+    history.extend(payload.get("messages", []))
+    with llm_call_class("chat_scan"):
+        return await _get_orchestrator().process_chat_for_fraud(history, payload["conversation_key"])
+
+
+@job_handler("process_dispute_chat_message")
+async def process_dispute_chat_message(payload: dict) -> dict:
+    with llm_call_class("dispute_chat"), llm_deadline(DISPUTE_CHAT_DEADLINE_SECONDS):
+        return await _get_orchestrator().process_dispute_chat_message(
+            ChatMessage(**payload["message"]), payload.get("dispute_id")
+        )
@@ -0,0 +1,375 @@
+# job_queue.py
+"""
+Durable background job queue stored in the application database.
+
+Jobs are rows in the "jobs" table (see db.JobDB), so they survive restarts and
+work on SQLite as well as on server databases. Workers claim jobs with a
+conditional UPDATE, which is safe with several workers in one process or in
+separate processes (see worker.py). Failed jobs are retried with exponential
+backoff until max_attempts is reached. Workers renew the lease of a running
+job every JOB_LEASE_RENEW_SECONDS, so long jobs are not picked up twice; jobs
+whose worker died mid-run are put back in the queue once their lease expires,
+or marked "failed" if that was their last attempt. Completing, failing and
+releasing a job are conditional on the worker still holding it, so a worker
+that lost its lease cannot overwrite the state of the job's new owner.
+
+Handlers are registered per job kind with @job_handler("kind") and receive the
+job payload dict (see job_handlers.py).
+"""
+import os
+import json
+import uuid
+import socket
+import asyncio
+import datetime
+import traceback
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import update
+
+import metrics
+from db import SessionLocal, JobDB
+
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "2"))
+JOB_RETRY_MAX_SECONDS = float(os.getenv("JOB_RETRY_MAX_SECONDS", "300"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "600"))
+JOB_LEASE_RENEW_SECONDS = float(os.getenv("JOB_LEASE_RENEW_SECONDS", str(JOB_LEASE_SECONDS / 4)))
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "0.5"))
+
+JobHandler = Callable[[dict], Awaitable[Optional[dict]]]
+JOB_HANDLERS: Dict[str, JobHandler] = {}
+
+
+def job_handler(kind: str):
+    """Registers the decorated coroutine as the handler for jobs of `kind`."""
+    def register(func: JobHandler) -> JobHandler:
+        JOB_HANDLERS[kind] = func
+        return func
+    return register
+
+
+def _job_to_dict(job: JobDB) -> dict:
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "run_after": str(job.run_after) if job.run_after else None,
+        "last_error": job.last_error,
+        "result": job.result,
+        "created_at": str(job.created_at) if job.created_at else None,
+        "updated_at": str(job.updated_at) if job.updated_at else None,
+    }
+
+
+def _job_row(kind: str, payload: dict, max_attempts: int) -> JobDB:
+    return JobDB(
+        kind=kind,
+        payload=json.loads(json.dumps(payload, default=str)),
+        max_attempts=max_attempts,
+        run_after=datetime.datetime.utcnow(),
+    )
+
+
+def enqueue_job(kind: str, payload: dict, max_attempts: int = JOB_MAX_ATTEMPTS) -> int:
+    """
+    Adds a job to the queue and returns its id. The payload must be
+    JSON-serializable; datetimes and similar values are stored as strings.
+    """
+    db = SessionLocal()
+    try:
+        job = _job_row(kind, payload, max_attempts)
+        db.add(job)
+        db.commit()
+        metrics.incr(f"jobs.enqueued.{kind}")
+        return job.id
+    finally:
+        db.close()
+
+
+async def enqueue_job_async(session, kind: str, payload: dict, max_attempts: int = JOB_MAX_ATTEMPTS) -> int:
+    """
+    Adds a job within the caller's db_async unit of work and returns its id.
+    The job only becomes visible to workers when that transaction commits, so
+    it is enqueued if and only if the related writes are.
+    """
+    job = _job_row(kind, payload, max_attempts)
+    session.add(job)
+    await session.flush()
+    metrics.incr(f"jobs.enqueued.{kind}")
+    return job.id
+
+
+async def enqueue_jobs_async(session, jobs: List[Tuple[str, dict]], max_attempts: int = JOB_MAX_ATTEMPTS) -> List[int]:
+    """Adds several (kind, payload) jobs within the caller's unit of work with a single flush."""
+    rows = [_job_row(kind, payload, max_attempts) for kind, payload in jobs]
+    session.add_all(rows)
+    await session.flush()
+    for kind, _ in jobs:
+        metrics.incr(f"jobs.enqueued.{kind}")
+    return [job.id for job in rows]
+
+
+def get_job(job_id: int) -> Optional[dict]:
+    db = SessionLocal()
+    try:
+        job = db.get(JobDB, job_id)
+        return _job_to_dict(job) if job else None
+    finally:
+        db.close()
+
+
+def claim_next_job(worker_id: str) -> Optional[dict]:
+    """
+    Atomically claims the oldest runnable job for `worker_id`. Returns a dict
+    with id, kind, payload and attempts, or None if nothing is runnable.
+    """
+    db = SessionLocal()
+    try:
+        now = datetime.datetime.utcnow()
+        for _ in range(5):
+            candidate = (
+                db.query(JobDB.id)
+                .filter(JobDB.status == "queued", JobDB.run_after <= now)
+                .order_by(JobDB.run_after, JobDB.id)
+                .first()
+            )
+            if candidate is None:
+                return None
+            claimed = db.execute(
+                update(JobDB)
+                .where(JobDB.id == candidate.id, JobDB.status == "queued")
+                .values(
+                    status="running",
+                    locked_by=worker_id,
+                    locked_at=now,
+                    attempts=JobDB.attempts + 1,
+                    updated_at=now,
+                )
+            )
+            db.commit()
+            if claimed.rowcount == 1:
+                job = db.get(JobDB, candidate.id)
+                return {"id": job.id, "kind": job.kind, "payload": job.payload, "attempts": job.attempts}
+            # Another worker got there first; try the next candidate.
+        return None
+    finally:
+        db.close()
+
+
+def complete_job(job_id: int, worker_id: str, result: Optional[dict] = None) -> bool:
+    """
+    Marks a job run by `worker_id` as succeeded. Returns False (and changes
+    nothing) if the worker no longer holds the job, e.g. because its lease
+    expired and the job was handed to another worker.
+    """
+    db = SessionLocal()
+    try:
+        completed = db.execute(
+            update(JobDB)
+            .where(JobDB.id == job_id, JobDB.status == "running", JobDB.locked_by == worker_id)
+            .values(status="succeeded", result=json.loads(json.dumps(result, default=str)), locked_by=None)
+        )
+        db.commit()
+        return completed.rowcount == 1
+    finally:
+        db.close()
+
+
+def fail_job(job_id: int, worker_id: str, error: str) -> bool:
+    """
+    Records a failed attempt of a job run by `worker_id`. The job is re-queued
+    with exponential backoff, or marked "failed" once it has used up its
+    attempts. Returns False (and changes nothing) if the worker no longer holds the job.
+    """
+    db = SessionLocal()
+    try:
+        job = db.get(JobDB, job_id)
+        if job is None or job.status != "running" or job.locked_by != worker_id:
+            return False
+        exhausted = job.attempts >= job.max_attempts
+        delay = min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** (job.attempts - 1))
+        # Conditional on the lease, in case the job changed hands since it was read.
+        failed = db.execute(
+            update(JobDB)
+            .where(JobDB.id == job_id, JobDB.status == "running", JobDB.locked_by == worker_id)
+            .values(
+                status="failed" if exhausted else "queued",
+                last_error=error,
+                locked_by=None,
+                run_after=job.run_after if exhausted else datetime.datetime.utcnow() + datetime.timedelta(seconds=delay),
+            )
+        )
+        db.commit()
+        if failed.rowcount != 1:
+            return False
+        metrics.incr(f"jobs.{'failed' if exhausted else 'retried'}.{job.kind}")
+        return True
+    finally:
+        db.close()
+
+
+def release_job(job_id: int, worker_id: str) -> bool:
+    """
+    Returns a job claimed by `worker_id` to the queue without counting the
+    attempt (used on shutdown). Returns False if the worker no longer holds it.
+    """
+    db = SessionLocal()
+    try:
+        released = db.execute(
+            update(JobDB)
+            .where(JobDB.id == job_id, JobDB.status == "running", JobDB.locked_by == worker_id)
+            .values(status="queued", locked_by=None, attempts=JobDB.attempts - 1)
+        )
+        db.commit()
+        return released.rowcount == 1
+    finally:
+        db.close()
+
+
+def renew_lease(job_id: int, worker_id: str) -> bool:
+    """Extends the lease `worker_id` holds on a running job. Returns False if the lease was lost."""
+    db = SessionLocal()
+    try:
+        now = datetime.datetime.utcnow()
+        renewed = db.execute(
+            update(JobDB)
+            .where(JobDB.id == job_id, JobDB.status == "running", JobDB.locked_by == worker_id)
+            .values(locked_at=now, updated_at=now)
+        )
+        db.commit()
+        return renewed.rowcount == 1
+    finally:
+        db.close()
+
+
+def requeue_stale_jobs(lease_seconds: float = JOB_LEASE_SECONDS) -> int:
+    """
+    Puts "running" jobs whose lease has expired (e.g. the worker crashed) back
+    in the queue, or marks them "failed" if they have used up their attempts,
+    so a job that keeps killing its worker is not retried forever. Returns the
+    number of jobs requeued.
+    """
+    db = SessionLocal()
+    try:
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=lease_seconds)
+        stale = db.query(JobDB).filter(JobDB.status == "running", JobDB.locked_at < cutoff).all()
+        requeued = 0
+        for job in stale:
+            exhausted = job.attempts >= job.max_attempts
+            updated = db.execute(
+                update(JobDB)
+                .where(JobDB.id == job.id, JobDB.status == "running", JobDB.locked_at < cutoff)
+                .values(
+                    status="failed" if exhausted else "queued",
+                    locked_by=None,
+                    last_error="Lease expired on the last attempt" if exhausted else "Lease expired",
+                )
+            )
+            if updated.rowcount != 1:
+                continue  # renewed or finished in the meantime
+            if exhausted:
+                metrics.incr(f"jobs.failed.{job.kind}")
+            else:
+                requeued += 1
+                metrics.incr(f"jobs.requeued.{job.kind}")
+        db.commit()
+        return requeued
+    finally:
+        db.close()
+
+
+class JobWorkerPool:
+    """
+    Runs `concurrency` worker coroutines that poll the queue and execute jobs.
+    Database calls go through the default executor so the event loop stays free.
+    """
+
+    def __init__(self, concurrency: int, poll_interval: float = JOB_POLL_INTERVAL_SECONDS):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.worker_prefix = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._tasks = []
+        self._stopping = False
+
+    def start(self):
+        self._stopping = False
+        self._tasks = [
+            asyncio.ensure_future(self._run(f"{self.worker_prefix}:{i}")) for i in range(self.concurrency)
+        ]
+        self._tasks.append(asyncio.ensure_future(self._reap_stale_jobs()))
+
+    async def stop(self):
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _reap_stale_jobs(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            try:
+                await loop.run_in_executor(None, requeue_stale_jobs)
+            except Exception as e:
+                print(f"Could not requeue stale jobs: {e}")
+            await asyncio.sleep(max(JOB_LEASE_SECONDS / 4, self.poll_interval))
+
+    async def _run(self, worker_id: str):
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            try:
+                job = await loop.run_in_executor(None, claim_next_job, worker_id)
+            except Exception as e:
+                print(f"Worker {worker_id} could not claim a job: {e}")
+                job = None
+            if job is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            await self._execute(job, worker_id)
+
+    async def _renew_lease(self, job: dict, worker_id: str):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(JOB_LEASE_RENEW_SECONDS)
+            try:
+                if not await loop.run_in_executor(None, renew_lease, job["id"], worker_id):
+                    print(f"Worker {worker_id} lost the lease on job {job['id']} ({job['kind']})")
+                    return
+            except Exception as e:
+                print(f"Worker {worker_id} could not renew the lease on job {job['id']}: {e}")
+
+    async def _execute(self, job: dict, worker_id: str):
+        loop = asyncio.get_running_loop()
+        handler = JOB_HANDLERS.get(job["kind"])
+        started = loop.time()
+        heartbeat = asyncio.ensure_future(self._renew_lease(job, worker_id))
+        try:
+            if handler is None:
+                raise LookupError(f"No handler registered for job kind '{job['kind']}'")
+            result = await handler(job["payload"])
+        except asyncio.CancelledError:
+            # The pool is shutting down: hand the job back so another worker picks it up.
+            await loop.run_in_executor(None, release_job, job["id"], worker_id)
+            raise
+        except Exception as e:
+            print(f"Job {job['id']} ({job['kind']}) failed on attempt {job['attempts']}: {e}")
+            if not await loop.run_in_executor(None, fail_job, job["id"], worker_id, traceback.format_exc(limit=5)):
+                self._lost_lease(job, worker_id)
+            return
+        finally:
+            heartbeat.cancel()
+        metrics.observe(f"jobs.duration_s.{job['kind']}", loop.time() - started)
+        if not await loop.run_in_executor(None, complete_job, job["id"], worker_id, result):
+            self._lost_lease(job, worker_id)
+            return
+        metrics.incr(f"jobs.succeeded.{job['kind']}")
+
+    @staticmethod
+    def _lost_lease(job: dict, worker_id: str):
+        # The lease expired and the job was requeued (and possibly claimed by
+        # another worker); its current owner's outcome is kept.
+        metrics.incr(f"jobs.lost_lease.{job['kind']}")
+        print(f"Worker {worker_id} no longer holds job {job['id']} ({job['kind']}); its outcome was discarded")
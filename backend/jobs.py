@@ -0,0 +1,18 @@
+# jobs.py
+from fastapi import APIRouter, HTTPException
+from job_queue import get_job
+import asyncio
+
+router = APIRouter()
+
+@router.get("/{job_id}")
+async def get_job_status(job_id: int):
+    """
+    Returns the status of a background job (queued, running, succeeded or failed),
+    its attempt count, last error and result.
+    """
+    loop = asyncio.get_running_loop()
+    job = await loop.run_in_executor(None, get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
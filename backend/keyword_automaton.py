@@ -0,0 +1,210 @@
+# keyword_automaton.py
+"""
+Aho-Corasick multi-pattern matcher used by FraudDetector.
+
+All patterns are compiled into a single automaton, so scanning a message costs
+one pass over its characters regardless of how many keywords are loaded.
+
+Both patterns and scanned text go through `normalize`, which folds Unicode
+compatibility forms and case, strips accents, undoes common leetspeak
+substitutions inside words ("p@ssw0rd" -> "password", "b4nk" -> "bank"; plain
+numbers such as amounts and ids are left alone) and collapses
+punctuation/whitespace runs into a single space.
+
+Keywords only match whole words: "urgent" does not fire on "insurgent".
+Scripts written without spaces (Chinese, Japanese, Thai) have no word
+boundaries to check, so keyword edges in those scripts match anywhere.
+
+KeywordRuleSet wraps an automaton built from a rules file and rebuilds it when
+the file changes on disk, so keyword lists can be updated without a restart.
+The check and rebuild run on a background thread, so scans (which run on the
+event loop) never wait for them.
+"""
+import os
+import re
+import time
+import threading
+import unicodedata
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+
+LEETSPEAK = str.maketrans({
+    "@": "a", "4": "a", "0": "o", "1": "i", "!": "i", "3": "e",
+    "5": "s", "$": "s", "7": "t", "+": "t", "8": "b", "|": "l",
+})
+
+
+_TOKEN_EDGES = re.compile(r"^(\W*)(.*?)(\W*)$", re.DOTALL)
+
+
+def _unleet(token: str) -> str:
+    # Only tokens with letters in them are obfuscated words; "1500" stays a number.
+    # Leading/trailing symbols are punctuation ("urgent!!"), not substitutions.
+    head, core, tail = _TOKEN_EDGES.match(token).groups()
+    if not any(ch.isalpha() for ch in core):
+        return token
+    return head + core.translate(LEETSPEAK) + tail
+
+
+def normalize(text: str) -> str:
+    """Canonical form used for both keywords and scanned text."""
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = " ".join(_unleet(token) for token in text.split())
+    out = []
+    pending_space = False
+    for ch in text:
+        if ch.isalnum():
+            if pending_space and out:
+                out.append(" ")
+            out.append(ch)
+            pending_space = False
+        else:
+            pending_space = True
+    return "".join(out)
+
+
+def _unspaced(ch: str) -> bool:
+    """True for characters of scripts that do not separate words with spaces."""
+    return (
+        "\u3040" <= ch <= "\u30ff"  # Hiragana, Katakana
+        or "\u3400" <= ch <= "\u4dbf"  # CJK extension A
+        or "\u4e00" <= ch <= "\u9fff"  # CJK unified ideographs
+        or "\u0e00" <= ch <= "\u0e7f"  # Thai
+    )
+
+
+def _bounded(normalized: str) -> str:
+    # Scanned text is padded with spaces, so a keyword padded the same way only
+    # matches at word boundaries.
+    head = "" if _unspaced(normalized[0]) else " "
+    tail = "" if _unspaced(normalized[-1]) else " "
+    return head + normalized + tail
+
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton over normalized keywords, matching whole words."""
+
+    def __init__(self, keywords: Iterable[str]):
+        self.keywords: List[str] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[int]] = [[]]
+
+        for keyword in keywords:
+            normalized = normalize(keyword)
+            if not normalized:
+                continue
+            self.keywords.append(keyword)
+            self._add(_bounded(normalized), len(self.keywords) - 1)
+        self._build_failure_links()
+
+    def _add(self, pattern: str, index: int):
+        state = 0
+        for ch in pattern:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append(index)
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(ch, 0)
+                if self._fail[next_state] == next_state:
+                    self._fail[next_state] = 0
+                self._output[next_state].extend(self._output[self._fail[next_state]])
+
+    def search(self, text: str) -> List[str]:
+        """Returns the keywords found in `text`, in rule-file order and without duplicates."""
+        goto, fail, output = self._goto, self._fail, self._output
+        found = set()
+        state = 0
+        for ch in f" {normalize(text)} ":
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                found.update(output[state])
+        return [self.keywords[i] for i in sorted(found)]
+
+
+def load_keywords(path: str) -> List[str]:
+    """Reads one keyword per line; blank lines and lines starting with '#' are ignored."""
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+class KeywordRuleSet:
+    """
+    Holds the current automaton for a rules file and hot-reloads it.
+
+    Reading `automaton` only returns the current automaton. At most every
+    `check_interval` seconds it also starts a background thread that checks
+    the file's modification time and, if it changed, builds a new automaton
+    and swaps it in with a single assignment; until then scans keep using the
+    previous one. If the file is missing or unreadable, `default_keywords` (or
+    the last good rule set) stay in effect.
+    """
+
+    def __init__(self, path: Optional[str], default_keywords: Iterable[str], check_interval: float = 5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._automaton = KeywordAutomaton(default_keywords)
+        self._mtime: Optional[float] = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self.reload_if_changed(force=True)
+
+    @property
+    def keywords(self) -> List[str]:
+        return self.automaton.keywords
+
+    @property
+    def automaton(self) -> KeywordAutomaton:
+        # The lock is held by the reload thread, so at most one check runs at a time.
+        if self.path and time.monotonic() >= self._next_check and self._lock.acquire(blocking=False):
+            self._next_check = time.monotonic() + self.check_interval
+            threading.Thread(target=self._reload_in_background, name="keyword-rules-reload", daemon=True).start()
+        return self._automaton
+
+    def _reload_in_background(self):
+        try:
+            self._reload()
+        except Exception as e:
+            print(f"Could not reload fraud keyword rules from {self.path}: {e}")
+        finally:
+            self._lock.release()
+
+    def reload_if_changed(self, force: bool = False) -> bool:
+        """Rebuilds the automaton now (blocking) if the rules file changed. Returns True if it was reloaded."""
+        with self._lock:
+            self._next_check = time.monotonic() + self.check_interval
+            return self._reload(force)
+
+    def _reload(self, force: bool = False) -> bool:
+        if not self.path:
+            return False
+        try:
+            mtime = os.path.getmtime(self.path)
+            if not force and mtime == self._mtime:
+                return False
+            automaton = KeywordAutomaton(load_keywords(self.path))
+        except OSError as e:
+            if self._mtime is not None:
+                print(f"Could not reload fraud keyword rules from {self.path}: {e}")
+            return False
+        self._automaton = automaton
+        self._mtime = mtime
+        return True
@@ -0,0 +1,311 @@
+# llm_client.py
+"""
+Shared asynchronous LLM client used by every agent.
+
+The Vertex AI SDK is synchronous, so calls are pushed onto a dedicated, bounded
+thread pool instead of running on the event loop (or on the default executor,
+where they would compete with the database helpers). Every call is wrapped in
+a per-call timeout. Calls wait for a slot from llm_scheduler first, which
+applies the rate limits, concurrency caps and priorities, and run behind the
+deadlines, circuit breakers and hedging of llm_resilience.
+
+Subclasses implement a single request (`_attempt`, `_stream`); the public
+`generate` and `generate_stream` wrap those with the above.
+
+`generate_stream` yields the response in chunks as the model produces them,
+for callers that show partial output.
+
+Set LLM_BACKEND=fake to swap in a local fake backend that answers after a
+configurable delay without touching the network, which makes offline load
+testing possible.
+"""
+import os
+import json
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Union
+
+from llm_scheduler import get_llm_scheduler, current_call_class
+from llm_resilience import LLMTimeoutError, deadline_timeout, timeout_error, resilient_call, resilient_stream
+
+LLM_BACKEND = os.getenv("LLM_BACKEND", "vertex")
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "30"))
+FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", "50"))
+FAKE_LLM_JITTER_MS = float(os.getenv("FAKE_LLM_JITTER_MS", "0"))
+# Streaming fake: delay before the first chunk and chunk size; the remaining
+# chunks are spread over the rest of the response latency.
+FAKE_LLM_FIRST_TOKEN_MS = float(os.getenv("FAKE_LLM_FIRST_TOKEN_MS", "10"))
+FAKE_LLM_STREAM_CHUNK_CHARS = int(os.getenv("FAKE_LLM_STREAM_CHUNK_CHARS", "16"))
+
+# A single pool shared by all clients caps the number of in-flight SDK calls
+# (and therefore open connections) for the whole process.
+_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="llm")
+
+
+class LLMClient:
+    """
+    Base class for model clients. Subclasses implement `_generate_sync` (for
+    blocking SDKs) or override `_attempt` directly (for native async backends).
+    """
+
+    def __init__(self, model_name: str, timeout: float = LLM_TIMEOUT_SECONDS):
+        self.model_name = model_name
+        self.timeout = timeout
+
+    async def generate(self, contents: Any, timeout: Optional[float] = None) -> str:
+        """
+        Sends `contents` (a prompt string or a list of SDK parts) to the model
+        and returns the response text.
+
+        Raises LLMTimeoutError if the call takes longer than `timeout` seconds
+        (defaults to the client timeout), LLMDeadlineExceededError if it runs
+        past the llm_resilience deadline first, llm_scheduler.LLMOverloadedError if it is shed or rejected
+        for exceeding the quota, and LLMCircuitOpenError while the model is
+        failing. All three are LLMUnavailableErrors.
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        deadline_timeout(timeout)  # fails fast if the deadline has already passed
+        scheduler = get_llm_scheduler()
+        return await resilient_call(
+            self.model_name,
+            lambda: self._attempt(contents, timeout),
+            call_class=current_call_class()[0],
+            # Hedged duplicates are only sent while nothing is queued for a slot.
+            can_hedge=lambda: scheduler.depth == 0,
+        )
+
+    async def _attempt(self, contents: Any, limit: float) -> str:
+        """
+        Makes one request to the model, holding a scheduler slot. `limit` is
+        the call's own timeout; the current deadline may cut it shorter.
+        """
+        loop = asyncio.get_running_loop()
+        async with get_llm_scheduler().slot():
+            timeout = deadline_timeout(limit)
+            try:
+                return await asyncio.wait_for(
+                    loop.run_in_executor(_executor, self._generate_sync, contents),
+                    timeout=timeout,
+                )
+            except asyncio.TimeoutError:
+                raise timeout_error(f"{self.model_name} call", timeout, limit)
+
+    def _generate_sync(self, contents: Any) -> str:
+        raise NotImplementedError
+
+    async def generate_stream(self, contents: Any, timeout: Optional[float] = None) -> AsyncIterator[str]:
+        """
+        Like `generate`, but yields the response text in chunks as they are
+        produced. `timeout` bounds the whole stream. Streams are not hedged.
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        deadline_timeout(timeout)
+        stream = self._stream(contents, timeout)
+        async for chunk in resilient_stream(self.model_name, stream, call_class=current_call_class()[0]):
+            yield chunk
+
+    async def _stream(self, contents: Any, limit: float) -> AsyncIterator[str]:
+        # Backends without streaming support yield the complete response as a single chunk.
+        yield await self._attempt(contents, limit)
+
+    def warm_up(self):
+        """Performs any one-off client setup ahead of the first request (blocking)."""
+
+    def video_part(self, uri: str, mime_type: str = "video/mp4") -> Any:
+        """Returns a content part referencing the video stored at `uri`."""
+        return {"uri": uri, "mime_type": mime_type}
+
+
+_vertex_lock = threading.Lock()
+_vertex_initialized = False
+
+
+def _ensure_vertex_initialized():
+    """Imports and initializes the Vertex AI SDK once per process, on first use."""
+    global _vertex_initialized
+    if _vertex_initialized:
+        return
+    with _vertex_lock:
+        if not _vertex_initialized:
+            import vertexai
+            from dotenv import load_dotenv
+            load_dotenv()
+            vertexai.init(project=os.environ.get("PROJECT_ID"), location=os.getenv("VERTEX_LOCATION", "us-central1"))
+            _vertex_initialized = True
+
+
+class VertexLLMClient(LLMClient):
+    """
+    Client backed by a Vertex AI GenerativeModel. The SDK is imported and the
+    model created lazily on the first call (or on warm_up).
+    """
+
+    def __init__(self, model_name: str, timeout: float = LLM_TIMEOUT_SECONDS):
+        super().__init__(model_name, timeout)
+        self._model = None
+        self._model_lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    _ensure_vertex_initialized()
+                    from vertexai.generative_models import GenerativeModel
+                    self._model = GenerativeModel(self.model_name)
+        return self._model
+
+    def warm_up(self):
+        self.model
+
+    def video_part(self, uri: str, mime_type: str = "video/mp4"):
+        _ensure_vertex_initialized()
+        from vertexai.generative_models import Part
+        return Part.from_uri(uri, mime_type=mime_type)
+
+    def _generate_sync(self, contents: Any) -> str:
+        response = self.model.generate_content(contents)
+        return response.text
+
+    async def _stream(self, contents: Any, limit: float) -> AsyncIterator[str]:
+        # The SDK's streaming iterator blocks, so it runs on the model thread pool
+        # and hands chunks back to the event loop through a queue.
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+        finished = object()
+
+        def produce():
+            try:
+                for response in self.model.generate_content(contents, stream=True):
+                    if stop.is_set():
+                        break
+                    try:
+                        text = response.text
+                    except ValueError:
+                        continue  # e.g. a chunk carrying only safety or usage metadata
+                    loop.call_soon_threadsafe(queue.put_nowait, text)
+                loop.call_soon_threadsafe(queue.put_nowait, finished)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+
+        async with get_llm_scheduler().slot():
+            timeout = deadline_timeout(limit)
+            deadline = loop.time() + timeout
+            loop.run_in_executor(_executor, produce)
+            try:
+                while True:
+                    try:
+                        item = await asyncio.wait_for(queue.get(), timeout=max(deadline - loop.time(), 0))
+                    except asyncio.TimeoutError:
+                        raise timeout_error(f"{self.model_name} stream", timeout, limit)
+                    if item is finished:
+                        return
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+            finally:
+                # Stops the producer if the consumer gave up early.
+                stop.set()
+
+
+# Default fake answer: valid JSON that every caller can parse.
+DEFAULT_FAKE_RESPONSE = json.dumps({
+    "flagged": False,
+    "is_fraudulent": False,
+    "status": "escalated",
+    "reason": "Fake LLM response.",
+    "confidence": 0.5,
+    "requires_human_review": True,
+})
+
+
+class FakeLLMClient(LLMClient):
+    """
+    Offline stand-in for a real model. Responds after `latency_ms` (plus up to
+    `jitter_ms` of random extra delay) with either a fixed string or the result
+    of `response(contents)`. `latency_ms` may also be a callable returning a
+    fresh latency per call, to model a latency distribution.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "fake",
+        timeout: float = LLM_TIMEOUT_SECONDS,
+        latency_ms: Union[float, Callable[[], float]] = FAKE_LLM_LATENCY_MS,
+        jitter_ms: float = FAKE_LLM_JITTER_MS,
+        response: Union[str, Callable[[Any], str]] = DEFAULT_FAKE_RESPONSE,
+    ):
+        super().__init__(model_name, timeout)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.response = response
+        self.calls = 0
+
+    def _delay(self) -> float:
+        latency_ms = self.latency_ms() if callable(self.latency_ms) else self.latency_ms
+        return (latency_ms + random.uniform(0, self.jitter_ms)) / 1000
+
+    async def _attempt(self, contents: Any, limit: float) -> str:
+        delay = self._delay()
+        async with get_llm_scheduler().slot():
+            timeout = deadline_timeout(limit)
+            self.calls += 1
+            try:
+                await asyncio.wait_for(asyncio.sleep(delay), timeout=timeout)
+            except asyncio.TimeoutError:
+                raise timeout_error(f"{self.model_name} call", timeout, limit)
+        if callable(self.response):
+            return self.response(contents)
+        return self.response
+
+    async def _stream(self, contents: Any, limit: float) -> AsyncIterator[str]:
+        text = self.response(contents) if callable(self.response) else self.response
+        chunks = [text[i:i + FAKE_LLM_STREAM_CHUNK_CHARS] for i in range(0, len(text), FAKE_LLM_STREAM_CHUNK_CHARS)] or [""]
+        total = self._delay()
+        first = min(FAKE_LLM_FIRST_TOKEN_MS / 1000, total)
+        gap = (total - first) / max(len(chunks) - 1, 1)
+        elapsed = 0.0
+        async with get_llm_scheduler().slot():
+            timeout = deadline_timeout(limit)
+            self.calls += 1
+            for index, chunk in enumerate(chunks):
+                delay = first if index == 0 else gap
+                if elapsed + delay > timeout:
+                    await asyncio.sleep(max(timeout - elapsed, 0))
+                    raise timeout_error(f"{self.model_name} stream", timeout, limit)
+                await asyncio.sleep(delay)
+                elapsed += delay
+                yield chunk
+
+
+_clients: Dict[str, LLMClient] = {}
+
+
+def get_llm_client(model_name: str) -> LLMClient:
+    """
+    Returns the process-wide client for `model_name`, creating it on first use.
+    The backend is selected by the LLM_BACKEND environment variable.
+    """
+    client = _clients.get(model_name)
+    if client is None:
+        if LLM_BACKEND == "fake":
+            client = FakeLLMClient(model_name)
+        else:
+            client = VertexLLMClient(model_name)
+        _clients[model_name] = client
+    return client
+
+
+def set_llm_client(model_name: str, client: LLMClient):
+    """Overrides the client used for `model_name` (e.g. to inject a fake in load tests)."""
+    _clients[model_name] = client
+
+
+def warm_up_clients():
+    """Sets up every client created so far ahead of the first request (blocking)."""
+    for client in list(_clients.values()):
+        client.warm_up()
@@ -0,0 +1,283 @@
+# llm_resilience.py
+"""
+Deadlines, circuit breaking and hedging for model calls.
+
+llm_client runs every call through this module:
+
+  - Deadlines: `llm_deadline(seconds)` bounds all model calls made inside the
+    block, including the time spent queued in llm_scheduler, so an endpoint
+    can promise a response time (INTENT_DEADLINE_SECONDS for the intent
+    checks of /chat/webhook and /chat/intent-check,
+    DISPUTE_CHAT_DEADLINE_SECONDS for dispute chat replies and
+    FINALIZE_DEADLINE_SECONDS for finalization). Nested deadlines keep the
+    earlier one.
+  - Circuit breaker: one per model and call class, so one endpoint's failures
+    cannot cut off another. After LLM_BREAKER_FAILURES consecutive failures
+    (the client's own timeouts or backend errors) calls fail fast with
+    LLMCircuitOpenError for LLM_BREAKER_RESET_SECONDS. Then a single probe
+    call is let through, which closes the breaker again if it succeeds. A
+    call cut short by the caller's deadline (LLMDeadlineExceededError) counts
+    only if it had been sent to the model: a backend that hangs past the short
+    intent deadline must still open the breaker, while calls whose deadline
+    ran out before they got a slot say nothing about the model's health.
+  - Hedging: for the call classes in LLM_HEDGE_CLASSES, a call still running
+    after the model's LLM_HEDGE_PERCENTILE latency gets a duplicate request;
+    the first answer wins and the other is abandoned. Only idempotent,
+    side-effect free prompts (intent checks, dispute chat replies) are hedged,
+    and never while calls are queued. Disabled with LLM_HEDGE_PERCENTILE=0.
+
+All three raise subclasses of LLMUnavailableError, which callers answer with
+their deterministic fallback (the intent prefilter's verdict, the keyword
+fraud screen, or an escalation to a human). Breaker state changes, fast
+failures, deadline expiries and hedges are recorded in `metrics`.
+"""
+import os
+import time
+import asyncio
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional
+
+import metrics
+
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+# Latency percentile (0-1) after which a duplicate request is sent; 0 disables hedging.
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+LLM_HEDGE_CLASSES = set(filter(None, os.getenv("LLM_HEDGE_CLASSES", "intent,dispute_chat").split(",")))
+# Successful calls a model needs before its latency percentile is trusted for hedging.
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
+
+# Per-endpoint deadlines for all model calls made while serving one request.
+INTENT_DEADLINE_SECONDS = float(os.getenv("INTENT_DEADLINE_SECONDS", "4"))
+DISPUTE_CHAT_DEADLINE_SECONDS = float(os.getenv("DISPUTE_CHAT_DEADLINE_SECONDS", "20"))
+FINALIZE_DEADLINE_SECONDS = float(os.getenv("FINALIZE_DEADLINE_SECONDS", "60"))
+
+
+class LLMUnavailableError(Exception):
+    """Base class for errors meaning no model answer can be had right now."""
+
+
+class LLMTimeoutError(LLMUnavailableError):
+    """Raised when a model call does not finish within its timeout or deadline."""
+
+
+class LLMDeadlineExceededError(LLMTimeoutError):
+    """
+    Raised when a model call runs out of the caller's deadline rather than its
+    own timeout. `in_flight` tells whether the request had been sent.
+    """
+
+    def __init__(self, message: str, in_flight: bool = False):
+        super().__init__(message)
+        self.in_flight = in_flight
+
+
+class LLMCircuitOpenError(LLMUnavailableError):
+    """Raised without calling the model while its circuit breaker is open."""
+
+
+def counts_as_failure(error: BaseException) -> bool:
+    # Timeouts and backend errors mean the model is unhealthy; calls rejected
+    # locally (shed, quota, open breaker), calls whose deadline ran out before
+    # they were sent and cancellations say nothing about it.
+    if isinstance(error, LLMDeadlineExceededError):
+        return error.in_flight
+    if isinstance(error, LLMTimeoutError):
+        return True
+    return isinstance(error, Exception) and not isinstance(error, LLMUnavailableError)
+
+
+_deadline: contextvars.ContextVar = contextvars.ContextVar("llm_deadline", default=None)
+
+
+@contextmanager
+def llm_deadline(seconds: float):
+    """Model calls made inside the block must finish within `seconds` from now."""
+    deadline = time.monotonic() + seconds
+    enclosing = _deadline.get()
+    if enclosing is not None:
+        deadline = min(deadline, enclosing)
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        try:
+            _deadline.reset(token)
+        except ValueError:
+            # An async generator closed from another context; restore by value instead.
+            _deadline.set(enclosing)
+
+
+def remaining_time() -> Optional[float]:
+    """Seconds left until the current deadline, or None without one."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def deadline_timeout(timeout: float) -> float:
+    """Caps a call timeout at the current deadline; raises if it has already passed."""
+    remaining = remaining_time()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        metrics.incr("llm.deadline_exceeded")
+        raise LLMDeadlineExceededError("Deadline exceeded before the model call was made")
+    return min(timeout, remaining)
+
+
+def timeout_error(description: str, timeout: float, limit: float) -> LLMTimeoutError:
+    """
+    The error for `description` (e.g. "gemini call") not finishing within
+    `timeout` seconds, where `limit` is the call's own timeout before
+    deadline_timeout capped it. Only used for calls that were sent.
+    """
+    if timeout < limit:
+        metrics.incr("llm.deadline_exceeded")
+        return LLMDeadlineExceededError(f"{description} ran out of its deadline after {timeout:.2f}s", in_flight=True)
+    return LLMTimeoutError(f"{description} timed out after {timeout:.2f}s")
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = LLM_BREAKER_FAILURES,
+        reset_seconds: float = LLM_BREAKER_RESET_SECONDS,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"  # "open" or "half_open"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._latencies: deque = deque(maxlen=LLM_LATENCY_WINDOW)
+
+    def before_call(self):
+        """Raises LLMCircuitOpenError if the call must not be made."""
+        if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_seconds:
+            self.state = "half_open"
+        if self.state == "open" or (self.state == "half_open" and self._probe_in_flight):
+            metrics.incr(f"llm.breaker.{self.name}.rejected")
+            raise LLMCircuitOpenError(f"{self.name} is failing; circuit breaker open")
+        if self.state == "half_open":
+            self._probe_in_flight = True
+
+    def record_success(self, latency: Optional[float] = None):
+        if latency is not None:
+            self._latencies.append(latency)
+        self.failures = 0
+        self._probe_in_flight = False
+        if self.state != "closed":
+            self.state = "closed"
+            metrics.incr(f"llm.breaker.{self.name}.closed")
+            print(f"Circuit breaker for {self.name} closed")
+
+    def record_error(self, error: BaseException):
+        self._probe_in_flight = False
+        if not counts_as_failure(error):
+            return
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self.state = "open"
+            self._opened_at = time.monotonic()
+            metrics.incr(f"llm.breaker.{self.name}.opened")
+            print(f"Circuit breaker for {self.name} opened after {self.failures} failures: {error}")
+
+    def hedge_delay(self) -> Optional[float]:
+        """The latency after which a call to this model is hedged, or None."""
+        if LLM_HEDGE_PERCENTILE <= 0 or len(self._latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        values = sorted(self._latencies)
+        return values[min(len(values) - 1, int(LLM_HEDGE_PERCENTILE * len(values)))]
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(model_name: str, call_class: str = "default") -> CircuitBreaker:
+    name = f"{model_name}/{call_class}"
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = _breakers[name] = CircuitBreaker(name)
+    return breaker
+
+
+def breaker_states() -> Dict[str, str]:
+    return {name: breaker.state for name, breaker in _breakers.items()}
+
+
+async def resilient_call(
+    model_name: str,
+    attempt: Callable[[], Awaitable[str]],
+    call_class: str = "default",
+    can_hedge: Callable[[], bool] = lambda: True,
+) -> str:
+    """
+    Runs `attempt()` (one model request) behind the circuit breaker of the
+    model and `call_class`, hedging it when `call_class` allows and
+    `can_hedge()` says there is spare capacity.
+    """
+    breaker = get_breaker(model_name, call_class)
+    breaker.before_call()
+    try:
+        result = await _hedged(breaker, attempt, call_class, can_hedge)
+    except BaseException as e:
+        breaker.record_error(e)
+        raise
+    return result
+
+
+async def _timed(breaker: CircuitBreaker, attempt: Callable[[], Awaitable[str]]) -> str:
+    started = time.monotonic()
+    result = await attempt()
+    breaker.record_success(time.monotonic() - started)
+    return result
+
+
+async def _hedged(breaker: CircuitBreaker, attempt, call_class: str, can_hedge) -> str:
+    delay = breaker.hedge_delay() if call_class in LLM_HEDGE_CLASSES else None
+    if delay is None:
+        return await _timed(breaker, attempt)
+
+    first = asyncio.ensure_future(_timed(breaker, attempt))
+    pending = {first}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done and can_hedge():
+            metrics.incr(f"llm.hedge.sent.{call_class}")
+            pending.add(asyncio.ensure_future(_timed(breaker, attempt)))
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not first:
+                        metrics.incr(f"llm.hedge.won.{call_class}")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def resilient_stream(model_name: str, stream: AsyncIterator[str], call_class: str = "default") -> AsyncIterator[str]:
+    """Passes `stream` through the circuit breaker of the model and `call_class` (streams are not hedged)."""
+    breaker = get_breaker(model_name, call_class)
+    breaker.before_call()
+    try:
+        async for chunk in stream:
+            yield chunk
+    except GeneratorExit:
+        breaker.record_error(GeneratorExit())  # consumer stopped early; not a failure
+        raise
+    except BaseException as e:
+        breaker.record_error(e)
+        raise
+    finally:
+        await stream.aclose()
+    breaker.record_success()
@@ -0,0 +1,306 @@
+# llm_scheduler.py
+"""
+Admission control and priority scheduling for model calls.
+
+Every model call made through llm_client waits for a slot from the process-wide
+`LLMScheduler` before it is sent. A slot is granted when:
+
+  - the token bucket has a token (LLM_RATE_PER_SECOND, bursts of up to
+    LLM_RATE_BURST), so the process stays under the provider quota;
+  - fewer than LLM_MAX_CONCURRENCY calls are in flight overall; and
+  - the call's class is below its own concurrency cap.
+
+Waiting calls are served in priority order (lower number first, FIFO within a
+priority), so a burst of background chat scans cannot starve finalization.
+The class of a call is taken from the caller's context, set with
+`llm_call_class(name)` around the work it belongs to:
+
+  finalize (0), dispute (1), dispute_chat (1), intent (2), video (2),
+  chat_scan (3), default (2)
+
+Priorities and caps can be overridden with LLM_CLASS_LIMITS, e.g.
+'{"chat_scan": {"priority": 3, "concurrency": 2}}'. Nested classes keep the
+more urgent priority, so e.g. video analysis run for a high-value dispute is
+not demoted.
+
+Backpressure: once LLM_QUEUE_MAX_DEPTH calls are waiting, calls with priority
+LLM_SHED_PRIORITY or lower are rejected straight away with LLMOverloadedError,
+as are calls that wait longer than LLM_QUEUE_TIMEOUT_SECONDS (or past their
+llm_resilience deadline). Callers treat
+that error as a signal to answer from rules only (degraded mode). A quota
+error from the provider pauses the bucket for LLM_QUOTA_BACKOFF_SECONDS and
+is raised as LLMQuotaError, which callers handle the same way.
+
+Queue depth, wait time per class, sheds and quota errors are recorded in
+`metrics`; `stats()` is included in /metrics. Limits are per process, so with
+dedicated workers (worker.py) the provider quota is shared between processes.
+"""
+import os
+import json
+import time
+import heapq
+import asyncio
+import itertools
+import contextvars
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Optional, Tuple
+
+import metrics
+from llm_resilience import LLMUnavailableError, remaining_time
+
+LLM_RATE_PER_SECOND = float(os.getenv("LLM_RATE_PER_SECOND", "10"))
+LLM_RATE_BURST = float(os.getenv("LLM_RATE_BURST", "20"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_QUEUE_MAX_DEPTH = int(os.getenv("LLM_QUEUE_MAX_DEPTH", "64"))
+# Calls of this priority or lower (i.e. with a number >= this) are shed when the queue is full.
+LLM_SHED_PRIORITY = int(os.getenv("LLM_SHED_PRIORITY", "2"))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "10"))
+LLM_QUOTA_BACKOFF_SECONDS = float(os.getenv("LLM_QUOTA_BACKOFF_SECONDS", "5"))
+
+DEFAULT_CLASS_LIMITS: Dict[str, dict] = {
+    "finalize": {"priority": 0, "concurrency": 8},
+    "dispute": {"priority": 1, "concurrency": 8},
+    "dispute_chat": {"priority": 1, "concurrency": 4},
+    "intent": {"priority": 2, "concurrency": 8},
+    "video": {"priority": 2, "concurrency": 2},
+    "chat_scan": {"priority": 3, "concurrency": 4},
+    "default": {"priority": 2, "concurrency": 8},
+}
+LLM_CLASS_LIMITS: Dict[str, dict] = {
+    name: {**DEFAULT_CLASS_LIMITS.get(name, DEFAULT_CLASS_LIMITS["default"]), **limits}
+    for name, limits in json.loads(os.getenv("LLM_CLASS_LIMITS", "{}")).items()
+}
+CLASS_LIMITS = {**DEFAULT_CLASS_LIMITS, **LLM_CLASS_LIMITS}
+
+
+class LLMOverloadedError(LLMUnavailableError):
+    """Raised when a model call is shed or waits too long for a slot."""
+
+
+class LLMQuotaError(LLMOverloadedError):
+    """Raised when the provider rejects a model call for exceeding its quota."""
+
+
+def is_quota_error(error: Exception) -> bool:
+    # google.api_core raises ResourceExhausted (HTTP 429) for quota errors.
+    return type(error).__name__ in ("ResourceExhausted", "TooManyRequests") or getattr(error, "code", None) == 429
+
+
+_call_class: contextvars.ContextVar = contextvars.ContextVar("llm_call_class", default=None)
+
+
+def _class_limits(name: str) -> dict:
+    return CLASS_LIMITS.get(name, CLASS_LIMITS["default"])
+
+
+def current_call_class() -> Tuple[str, int]:
+    """Returns the (class, priority) that model calls made here are scheduled with."""
+    current = _call_class.get()
+    if current is None:
+        return "default", _class_limits("default")["priority"]
+    return current
+
+
+@contextmanager
+def llm_call_class(name: str, priority: Optional[int] = None):
+    """
+    Schedules the model calls made inside the block as class `name`, with the
+    class priority unless `priority` is given.
+    """
+    if priority is None:
+        priority = _class_limits(name)["priority"]
+    enclosing = _call_class.get()
+    if enclosing is not None:
+        priority = min(priority, enclosing[1])
+    token = _call_class.set((name, priority))
+    try:
+        yield
+    finally:
+        try:
+            _call_class.reset(token)
+        except ValueError:
+            # An async generator closed from another context; restore by value instead.
+            _call_class.set(enclosing)
+
+
+class _Waiter:
+    __slots__ = ("call_class", "future", "enqueued_at")
+
+    def __init__(self, call_class: str, future: asyncio.Future):
+        self.call_class = call_class
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class LLMScheduler:
+    def __init__(
+        self,
+        rate_per_second: float = LLM_RATE_PER_SECOND,
+        burst: float = LLM_RATE_BURST,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        max_queue_depth: int = LLM_QUEUE_MAX_DEPTH,
+        shed_priority: int = LLM_SHED_PRIORITY,
+        queue_timeout: float = LLM_QUEUE_TIMEOUT_SECONDS,
+    ):
+        # rate_per_second <= 0 disables rate limiting.
+        self.rate = rate_per_second
+        self.burst = max(burst, 1.0)
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.shed_priority = shed_priority
+        self.queue_timeout = queue_timeout
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._in_flight = 0
+        self._class_in_flight: Dict[str, int] = {}
+        self._queue: list = []  # heap of (priority, seq, waiter)
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_loop = None
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    @property
+    def degraded(self) -> bool:
+        return self.depth >= self.max_queue_depth or time.monotonic() < self._paused_until
+
+    @asynccontextmanager
+    async def slot(self):
+        """Holds a slot for one model call of the current call class."""
+        call_class, priority = current_call_class()
+        await self.acquire(call_class, priority)
+        try:
+            yield
+        except Exception as e:
+            if is_quota_error(e):
+                self.report_quota_exceeded()
+                raise LLMQuotaError(f"Model quota exceeded: {e}") from e
+            raise
+        finally:
+            self.release(call_class)
+
+    async def acquire(self, call_class: str, priority: int):
+        metrics.observe("llm.queue.depth", self.depth)
+        if self.depth >= self.max_queue_depth and priority >= self.shed_priority:
+            metrics.incr(f"llm.shed.{call_class}")
+            raise LLMOverloadedError(f"Model call queue is full ({self.depth} waiting); {call_class} call shed")
+
+        waiter = _Waiter(call_class, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queue, (priority, next(self._seq), waiter))
+        self._dispatch()
+        remaining = remaining_time()
+        timeout = self.queue_timeout if remaining is None else max(min(self.queue_timeout, remaining), 0)
+        try:
+            await asyncio.wait_for(waiter.future, timeout=timeout)
+        except BaseException as e:
+            # Give the slot back if it was granted just as the wait ended.
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release(call_class)
+            else:
+                self._discard(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                metrics.incr(f"llm.queue.timeout.{call_class}")
+                raise LLMOverloadedError(
+                    f"{call_class} call waited {timeout:.2f}s for a model slot without getting one"
+                ) from None
+            raise
+        metrics.incr(f"llm.admitted.{call_class}")
+        metrics.observe(f"llm.queue.wait_ms.{call_class}", (time.monotonic() - waiter.enqueued_at) * 1000)
+
+    def release(self, call_class: str):
+        self._in_flight -= 1
+        self._class_in_flight[call_class] -= 1
+        self._dispatch()
+
+    def report_quota_exceeded(self):
+        """Stops granting slots for LLM_QUOTA_BACKOFF_SECONDS after a provider quota error."""
+        metrics.incr("llm.quota_exceeded")
+        self._tokens = 0.0
+        self._paused_until = max(self._paused_until, time.monotonic() + LLM_QUOTA_BACKOFF_SECONDS)
+        print(f"Model quota exceeded; pausing model calls for {LLM_QUOTA_BACKOFF_SECONDS}s")
+
+    def stats(self) -> dict:
+        queued: Dict[str, int] = {}
+        for _, _, waiter in self._queue:
+            if not waiter.future.done():
+                queued[waiter.call_class] = queued.get(waiter.call_class, 0) + 1
+        return {
+            "queued": queued,
+            "in_flight": {name: count for name, count in self._class_in_flight.items() if count},
+            "tokens": round(self._tokens, 2),
+            "degraded": self.degraded,
+        }
+
+    def _discard(self, waiter: _Waiter):
+        waiter.future.cancel()
+        self._queue = [entry for entry in self._queue if entry[2] is not waiter]
+        heapq.heapify(self._queue)
+
+    def _refill(self):
+        now = time.monotonic()
+        if now < self._paused_until:
+            self._refilled_at = now
+            return
+        self._tokens = min(self.burst, self._tokens + (now - max(self._refilled_at, self._paused_until)) * self.rate)
+        self._refilled_at = now
+
+    def _dispatch(self):
+        """Grants slots to the most urgent waiters that fit the current limits."""
+        if self.rate > 0:
+            self._refill()
+        paused = time.monotonic() < self._paused_until
+        deferred = []
+        blocked = False
+        while self._queue and self._in_flight < self.max_concurrency:
+            if paused or (self.rate > 0 and self._tokens < 1):
+                blocked = True
+                break
+            entry = heapq.heappop(self._queue)
+            waiter = entry[2]
+            if waiter.future.done():
+                continue  # timed out or cancelled
+            in_flight = self._class_in_flight.get(waiter.call_class, 0)
+            if in_flight >= _class_limits(waiter.call_class)["concurrency"]:
+                deferred.append(entry)
+                continue
+            if self.rate > 0:
+                self._tokens -= 1
+            self._in_flight += 1
+            self._class_in_flight[waiter.call_class] = in_flight + 1
+            waiter.future.set_result(None)
+        for entry in deferred:
+            heapq.heappush(self._queue, entry)
+        if blocked:
+            self._schedule_wakeup()
+
+    def _schedule_wakeup(self):
+        # Runs the dispatcher again once the next token is due (or the quota pause ends).
+        loop = asyncio.get_running_loop()
+        if self._timer is not None and self._timer_loop is loop:
+            return
+        delay = max(self._paused_until - time.monotonic(), 0)
+        if self.rate > 0:
+            delay += max(1 - self._tokens, 0) / self.rate
+
+        def fire():
+            self._timer = None
+            self._dispatch()
+
+        self._timer = loop.call_later(delay, fire)
+        self._timer_loop = loop
+
+
+_scheduler = LLMScheduler()
+
+
+def get_llm_scheduler() -> LLMScheduler:
+    return _scheduler
+
+
+def set_llm_scheduler(scheduler: LLMScheduler):
+    """Replaces the process-wide scheduler (e.g. with other limits in load tests)."""
+    global _scheduler
+    _scheduler = scheduler
@@ -1,12 +1,69 @@
 # main.py
+import os
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
 from chat import router as chat_router
 from dispute import router as dispute_router
-from db import init_db  # Import the init_db function
+from routes.disputes import router as dispute_review_router
+from jobs import router as jobs_router
+from db import init_db, SessionLocal  # Import the init_db function
+from db_async import dispose_engine
+from chat_ingest import close_chat_write_buffer
+from job_queue import JobWorkerPool
+from orchestrator import DisputeOrchestrator
+from llm_client import warm_up_clients
+import job_handlers  # registers the background job handlers
+import metrics
+from llm_scheduler import get_llm_scheduler
+from llm_resilience import breaker_states
 from fastapi.middleware.cors import CORSMiddleware
 
+# Number of background job workers to run inside the API process. Set to 0 when
+# running dedicated worker processes (see worker.py).
+JOB_WORKERS_IN_PROCESS = int(os.getenv("JOB_WORKERS_IN_PROCESS", "2"))
 
-app = FastAPI()
+
+# Set to 0 to skip creating the model clients at startup; they are then set
+# up on first use and /ready reports ready as soon as the database is up.
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "1") == "1"
+
+
+async def _run_warm_up(app: FastAPI):
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, warm_up_clients)
+    except Exception as e:
+        print(f"Warm-up failed, model clients will be set up on first use: {e}")
+    app.state.warm = True
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Initialize the database (creates tables if they don't exist)
+    init_db()
+    # One orchestrator (and set of agents and model clients) for the whole app.
+    app.state.orchestrator = DisputeOrchestrator()
+    job_handlers.set_orchestrator(app.state.orchestrator)
+    app.state.warm = not WARMUP_ON_STARTUP
+    warm_up_task = asyncio.create_task(_run_warm_up(app)) if WARMUP_ON_STARTUP else None
+
+    worker_pool = None
+    if JOB_WORKERS_IN_PROCESS > 0:
+        worker_pool = JobWorkerPool(JOB_WORKERS_IN_PROCESS)
+        worker_pool.start()
+    yield
+    await close_chat_write_buffer()
+    if worker_pool is not None:
+        await worker_pool.stop()
+    if warm_up_task is not None:
+        warm_up_task.cancel()
+    await dispose_engine()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = ["http://localhost:5173"]
 
@@ -18,11 +75,51 @@ app.add_middleware(
   allow_headers=["*"],
 )
 
-# Initialize the database (creates tables if they don't exist)
-init_db()
-
 app.include_router(chat_router, prefix="/chat")
 app.include_router(dispute_router, prefix="/dispute")
+app.include_router(dispute_review_router, prefix="/dispute")
+app.include_router(jobs_router, prefix="/jobs")
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Returns in-process counters and latency summaries, e.g. how many intent
+    checks were settled by the rule-based pre-classifier versus the LLM, plus
+    the current model call queues (llm_scheduler) and circuit breaker states
+    (llm_resilience).
+    """
+    return {
+        **metrics.snapshot(),
+        "llm_scheduler": get_llm_scheduler().stats(),
+        "llm_breakers": breaker_states(),
+    }
+
+@app.get("/live")
+async def live():
+    """Liveness probe: the process is up and serving requests."""
+    return {"status": "ok"}
+
+def _ping_db():
+    db = SessionLocal()
+    try:
+        db.execute(text("SELECT 1"))
+    finally:
+        db.close()
+
+@app.get("/ready")
+async def ready():
+    """
+    Readiness probe: returns 503 until the model clients are warmed up and
+    while the database is unreachable.
+    """
+    if not getattr(app.state, "warm", False):
+        return JSONResponse(status_code=503, content={"status": "warming up"})
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, _ping_db)
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"status": "database unavailable", "detail": str(e)})
+    return {"status": "ready"}
 
 if __name__ == "__main__":
     import uvicorn
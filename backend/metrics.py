@@ -0,0 +1,65 @@
+# metrics.py
+"""
+Minimal in-process metrics registry.
+
+Counters are plain monotonically increasing integers. Observations (latencies,
+sizes, ...) keep a total count/sum plus a bounded window of recent values from
+which percentiles are computed. `snapshot()` returns everything as a JSON-ready
+dict and is served by the /metrics endpoint.
+"""
+import threading
+from collections import defaultdict, deque
+from typing import Dict
+
+OBSERVATION_WINDOW = 2048
+
+_lock = threading.Lock()
+_counters: Dict[str, int] = defaultdict(int)
+_observations: Dict[str, deque] = defaultdict(lambda: deque(maxlen=OBSERVATION_WINDOW))
+_totals: Dict[str, list] = defaultdict(lambda: [0, 0.0, 0.0])  # count, sum, max
+
+
+def incr(name: str, amount: int = 1):
+    with _lock:
+        _counters[name] += amount
+
+
+def observe(name: str, value: float):
+    with _lock:
+        _observations[name].append(value)
+        totals = _totals[name]
+        totals[0] += 1
+        totals[1] += value
+        totals[2] = max(totals[2], value)
+
+
+def _percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def snapshot() -> dict:
+    with _lock:
+        counters = dict(_counters)
+        observations = {}
+        for name, window in _observations.items():
+            values = sorted(window)
+            count, total, maximum = _totals[name]
+            observations[name] = {
+                "count": count,
+                "mean": total / count if count else 0.0,
+                "p50": _percentile(values, 0.50),
+                "p95": _percentile(values, 0.95),
+                "p99": _percentile(values, 0.99),
+                "max": maximum,
+            }
+    return {"counters": counters, "observations": observations}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _observations.clear()
+        _totals.clear()
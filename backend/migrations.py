@@ -0,0 +1,96 @@
+# migrations.py
+"""
+Minimal schema migrations for existing databases.
+
+`Base.metadata.create_all` creates missing tables (with their indexes) but
+never changes a table that already exists, so columns and indexes added to
+existing models never reach older databases. Each migration below brings an
+older schema up to date and is recorded in the "schema_migrations" table, so
+it runs once per database. Migrations are written to be harmless on a database
+created from the current models, where most of what they add already exists.
+
+db.init_db runs create_all and then `run_migrations`. To change the schema,
+update the model in db.py and append a migration here; never edit or reorder
+migrations that have already shipped.
+"""
+import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+
+def _columns(conn: Connection, table: str) -> set:
+    return {column["name"] for column in inspect(conn).get_columns(table)}
+
+
+def _add_column(conn: Connection, table: str, column: str, ddl_type: str):
+    if column not in _columns(conn, table):
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+
+
+def _create_index(conn: Connection, name: str, table: str, columns: List[str]):
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+
+
+def _chat_conversation_key(conn: Connection):
+    _add_column(conn, "chat_messages", "conversation_key", "VARCHAR")
+    # Same keys as db.conversation_key_for.
+    conn.execute(text("""
+        UPDATE chat_messages
+        SET conversation_key = CASE
+            WHEN dispute_id IS NOT NULL AND dispute_id != '' THEN 'dispute:' || dispute_id
+            WHEN sender_id < receiver_id THEN 'pair:' || sender_id || ':' || receiver_id
+            ELSE 'pair:' || receiver_id || ':' || sender_id
+        END
+        WHERE conversation_key IS NULL
+    """))
+    _create_index(conn, "ix_chat_messages_conversation_created", "chat_messages", ["conversation_key", "created_at", "id"])
+
+
+def _evidence_dedupe_columns(conn: Connection):
+    _add_column(conn, "evidences", "content_hash", "VARCHAR")
+    _add_column(conn, "evidences", "size", "INTEGER")
+    _create_index(conn, "ix_evidences_content_hash", "evidences", ["content_hash"])
+
+
+def _chat_history_indexes(conn: Connection):
+    # get_chat_history, flag_conversation and get_split_chat_history filter by
+    # dispute and order by time; pair lookups filter by sender and receiver.
+    _create_index(conn, "ix_chat_messages_dispute_created", "chat_messages", ["dispute_id", "created_at"])
+    _create_index(conn, "ix_chat_messages_pair_created", "chat_messages", ["sender_id", "receiver_id", "created_at"])
+
+
+def _evidence_dispute_index(conn: Connection):
+    _create_index(conn, "ix_evidences_dispute_id", "evidences", ["dispute_id"])
+
+
+MIGRATIONS: List[Tuple[str, Callable[[Connection], None]]] = [
+    ("0001_chat_conversation_key", _chat_conversation_key),
+    ("0002_evidence_dedupe_columns", _evidence_dedupe_columns),
+    ("0003_chat_history_indexes", _chat_history_indexes),
+    ("0004_evidence_dispute_index", _evidence_dispute_index),
+]
+
+
+def run_migrations(engine: Engine) -> List[str]:
+    """Applies pending migrations, each in its own transaction. Returns the versions applied."""
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations (version VARCHAR PRIMARY KEY, applied_at TIMESTAMP)"
+        ))
+        applied = {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+    newly_applied = []
+    for version, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.begin() as conn:
+            migrate(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, applied_at) VALUES (:version, :applied_at)"),
+                {"version": version, "applied_at": datetime.datetime.utcnow()},
+            )
+        print(f"Applied schema migration {version}")
+        newly_applied.append(version)
+    return newly_applied
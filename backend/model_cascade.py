@@ -0,0 +1,152 @@
+# model_cascade.py
+"""
+Tiered model cascade: a fast model answers first, a stronger one only when needed.
+
+`ModelCascade.generate(prompt, parse, dispute_type, amount)` sends the prompt
+to the fast tier (CASCADE_FAST_MODEL) and parses the answer, which must carry
+a confidence between 0 and 1. The strong tier (CASCADE_STRONG_MODEL) is only
+called when:
+
+  - the fast answer's confidence is below the threshold for the dispute type
+    (CASCADE_CONFIDENCE_THRESHOLDS, falling back to CASCADE_CONFIDENCE_THRESHOLD),
+    or has none, cannot be parsed, or the fast call fails; or
+  - the case is high-value (amount >= CASCADE_HIGH_VALUE_AMOUNT), in which case
+    the fast tier is skipped altogether.
+
+Per cascade and tier, the calls, answers (hit rate = answered / calls),
+latency, estimated cost (CASCADE_MODEL_COSTS, from estimated token counts)
+and the fast tier's confidence per dispute type are recorded in `metrics`.
+When the strong tier overrides a fast answer, agreement between the two is
+counted per dispute type; that data is what the thresholds are tuned from.
+
+With MODEL_CASCADE=0 every call goes to the cascade's default model only,
+which is what each agent used before the cascade existed.
+
+Deterministic rules run before the cascade where they exist
+(intent_prefilter for intent checks), so they are not a tier here. A call
+shed by llm_scheduler is raised rather than escalated, since sending it to
+the strong tier would only add load.
+"""
+import os
+import re
+import json
+import time
+from typing import Any, Callable, Dict, Optional
+
+import metrics
+from llm_client import get_llm_client
+from llm_scheduler import LLMOverloadedError
+from prompt_budget import estimate_tokens
+
+MODEL_CASCADE = os.getenv("MODEL_CASCADE", "1") == "1"
+CASCADE_FAST_MODEL = os.getenv("CASCADE_FAST_MODEL", "gemini-2.0-flash-001")
+CASCADE_STRONG_MODEL = os.getenv("CASCADE_STRONG_MODEL", "gemini-1.5-pro-002")
+CASCADE_CONFIDENCE_THRESHOLD = float(os.getenv("CASCADE_CONFIDENCE_THRESHOLD", "0.75"))
+# Per dispute type overrides, e.g. '{"buyer_overpaid": 0.6, "seller_not_released": 0.85}'.
+CASCADE_CONFIDENCE_THRESHOLDS: Dict[str, float] = json.loads(os.getenv("CASCADE_CONFIDENCE_THRESHOLDS", "{}"))
+# Disputes of at least this amount go straight to the strong tier (amounts are not currency-converted).
+CASCADE_HIGH_VALUE_AMOUNT = float(os.getenv("CASCADE_HIGH_VALUE_AMOUNT", "1000"))
+# USD per 1k (input, output) tokens, used for the cost estimates.
+CASCADE_MODEL_COSTS: Dict[str, list] = json.loads(os.getenv("CASCADE_MODEL_COSTS", json.dumps({
+    "gemini-2.0-flash-001": [0.0001, 0.0004],
+    "gemini-1.5-pro-002": [0.00125, 0.005],
+})))
+
+_CONFIDENCE_PATTERN = re.compile(r"confidence\W{0,3}\s*([01](?:\.\d+)?)", re.IGNORECASE)
+
+
+def parse_confidence(text: str) -> Optional[float]:
+    """Extracts a "Confidence: 0.x" value from free-text model output, or None."""
+    match = _CONFIDENCE_PATTERN.search(text)
+    if match is None:
+        return None
+    return min(max(float(match.group(1)), 0.0), 1.0)
+
+
+def confidence_threshold(dispute_type: Optional[str]) -> float:
+    return float(CASCADE_CONFIDENCE_THRESHOLDS.get(dispute_type or "", CASCADE_CONFIDENCE_THRESHOLD))
+
+
+class ModelCascade:
+    def __init__(
+        self,
+        name: str,
+        default_model: str,
+        fast_model: str = CASCADE_FAST_MODEL,
+        strong_model: str = CASCADE_STRONG_MODEL,
+        enabled: bool = MODEL_CASCADE,
+    ):
+        self.name = name
+        if enabled:
+            self.tiers = [("fast", fast_model), ("strong", strong_model)]
+        else:
+            self.tiers = [("default", default_model)]
+        for _, model_name in self.tiers:
+            get_llm_client(model_name)  # created up front so warm_up_clients covers them
+
+    async def generate(
+        self,
+        prompt: Any,
+        parse: Callable[[str], dict],
+        dispute_type: Optional[str] = None,
+        amount: Optional[float] = None,
+    ) -> dict:
+        """
+        Returns parse(response) from the tier that answered, plus "model_tier"
+        and "model". `parse` must return a dict whose "confidence" is a number
+        between 0 and 1 or None. Errors of the last tier are raised.
+        """
+        dispute_type = str(getattr(dispute_type, "value", dispute_type) or "unknown")
+        tiers = self.tiers
+        if len(tiers) > 1 and amount is not None and amount >= CASCADE_HIGH_VALUE_AMOUNT:
+            metrics.incr(f"cascade.{self.name}.high_value")
+            tiers = tiers[-1:]
+
+        threshold = confidence_threshold(dispute_type)
+        fast_result = None
+        for index, (tier, model_name) in enumerate(tiers):
+            last = index == len(tiers) - 1
+            try:
+                result = await self._call(tier, model_name, prompt, parse, last)
+            except LLMOverloadedError:
+                metrics.incr(f"cascade.{self.name}.{tier}.shed")
+                raise
+            except Exception as e:
+                if last:
+                    raise
+                metrics.incr(f"cascade.{self.name}.{tier}.failed")
+                print(f"{self.name} cascade: {tier} tier failed, escalating: {e}")
+                continue
+
+            confidence = result.get("confidence")
+            if confidence is not None:
+                metrics.observe(f"cascade.{self.name}.{tier}.confidence.{dispute_type}", float(confidence))
+            if fast_result is not None:
+                agreed = fast_result.get("status", fast_result.get("is_fraudulent")) == result.get(
+                    "status", result.get("is_fraudulent")
+                )
+                metrics.incr(f"cascade.{self.name}.{'agreed' if agreed else 'overridden'}.{dispute_type}")
+            if last or (confidence is not None and float(confidence) >= threshold):
+                metrics.incr(f"cascade.{self.name}.{tier}.answered")
+                metrics.incr(f"cascade.{self.name}.answered_by.{tier}.{dispute_type}")
+                return {**result, "model_tier": tier, "model": model_name}
+            metrics.incr(f"cascade.{self.name}.{tier}.escalated")
+            fast_result = result
+
+    async def _call(self, tier: str, model_name: str, prompt: Any, parse: Callable[[str], dict], last: bool) -> dict:
+        prefix = f"cascade.{self.name}.{tier}"
+        metrics.incr(f"{prefix}.calls")
+        started = time.perf_counter()
+        response_text = await get_llm_client(model_name).generate(prompt)
+        metrics.observe(f"{prefix}.latency_ms", (time.perf_counter() - started) * 1000)
+        input_cost, output_cost = CASCADE_MODEL_COSTS.get(model_name, (0.0, 0.0))
+        input_tokens = estimate_tokens(prompt) if isinstance(prompt, str) else 0
+        cost = (input_tokens * input_cost + estimate_tokens(response_text) * output_cost) / 1000
+        metrics.observe(f"{prefix}.cost_usd", cost)
+        try:
+            return parse(response_text)
+        except Exception:
+            if last:
+                raise
+            # An unparseable fast answer counts as having no confidence.
+            return {"confidence": None, "unparsed": response_text}
@@ -6,14 +6,15 @@ from zoneinfo import ZoneInfo
 import pytz
 
 kuala_lumpur=pytz.timezone('Asia/Kuala_Lumpur')
-now = datetime.now(ZoneInfo("Asia/Kuala_Lumpur"))
-print(now)
 
 class ChatMessage(BaseModel):
     sender_id: str
     receiver_id: str
     message: str
 
+class ChatMessageBatch(BaseModel):
+    messages: List[ChatMessage] = Field(..., min_length=1, max_length=500)
+
 class DisputeType(str, Enum):
     BUYER_NOT_PAID = "buyer_not_paid"
     SELLER_NOT_RELEASED = "seller_not_released"
@@ -30,6 +31,8 @@ class Evidence(BaseModel):
     upload_timestamp: datetime = Field(default_factory=lambda: datetime.now(ZoneInfo("Asia/Kuala_Lumpur")))
     verification_status: Optional[str] = None
     metadata: dict = Field(default_factory=dict)
+    content_hash: Optional[str] = None
+    size: Optional[int] = None
 
 
 class DisputeSubmission(BaseModel):
@@ -4,8 +4,16 @@ from models import ChatMessage, DisputeSubmission, Evidence
 from agents.fraud_prevention import FraudDetector
 from agents.dispute_resolution import DisputeResolver
 from agents.fraud_detection import ChatFraudDetector
-from db import save_chat_message, flag_conversation
+from db import conversation_key_for
+from db_async import AsyncSessionLocal, unit_of_work, save_chat_messages, flag_conversation, get_conversation_window, get_split_chat_records
+from pipeline import Stage, run_stages
+from pubsub import publish_event, message_event, dispute_channel
+from intent_prefilter import prefilter_intent
+from llm_resilience import LLMUnavailableError
+from intent_batcher import INTENT_BATCHING, INTENT_BATCH_MAX_SIZE, get_intent_batcher, build_batch_prompt, parse_batch_response
+import metrics
 import json
+import time
 import asyncio
 
 
@@ -37,40 +45,143 @@ class DisputeOrchestrator:
         
         return {"status": "clean"}
 
-    async def process_chat_for_fraud(self, messages: List[dict]) -> Dict[str, Any]:
+    async def process_chat_messages(self, messages: List[ChatMessage]) -> List[Dict[str, Any]]:
+        """
+        Batch variant of process_chat_message: screens all messages with one rule
+        set snapshot, then checks the clean ones for leaving intent together.
+        Returns one result per message, in input order.
+        """
+        screening = self.fraud_detector.analyze_messages([message.message for message in messages])
+        results: List[Dict[str, Any]] = [None] * len(messages)
+        clean = []
+        for index, (message, (is_suspicious, alerts)) in enumerate(zip(messages, screening)):
+            if is_suspicious:
+                await self._handle_fraud_alerts(message, alerts)
+                results[index] = {"status": "blocked", "reason": "Suspicious activity detected", "alerts": alerts}
+            else:
+                clean.append(index)
+
+        intent_results = await self.process_chat_intents([messages[index] for index in clean])
+        for index, intent_result in zip(clean, intent_results):
+            if intent_result.get("flagged"):
+                results[index] = {"status": "warning", "reason": intent_result.get("reason")}
+            else:
+                results[index] = {"status": "clean"}
+        return results
+
+    async def process_chat_for_fraud(self, messages: List[dict], conversation_key: str = None) -> Dict[str, Any]:
         """
         Processes a list of chat messages for fraud detection.
+        When a conversation key is given, the analysis is incremental: only messages
+        newer than the conversation's stored rolling state are sent to the model.
         """
-        # Convert list of dicts to list of ChatMessage objects
-        chat_messages = [ChatMessage(**msg) for msg in messages]
-        analysis_result = self.chat_fraud_detector.analyze_chat(chat_messages)
+        analysis_result = await self.chat_fraud_detector.analyze_conversation(conversation_key, messages)
         return analysis_result
 
-    async def process_dispute(self, dispute: DisputeSubmission, evidence: Evidence = None) -> Dict[str, Any]:
-        # First check for any historical fraud alerts
-        fraud_history = await self.fraud_detector._check_fraud_history(dispute) # type: ignore
-        if fraud_history["has_alerts"]:
-            return {
+    async def process_dispute(self, dispute: DisputeSubmission, evidence: Evidence = None, dispute_id: int = None) -> Dict[str, Any]:
+        """
+        Runs the dispute analysis as a stage graph (see pipeline.py). The fraud history
+        check, evidence analysis, chat history fetch and chat fraud scan are independent
+        and run concurrently; the resolution prompt waits for the inputs it uses, which
+        are loaded once and passed along. Per-stage timings are returned under
+        "stage_timings_ms".
+        """
+        async def fraud_history(results):
+            return await self.fraud_detector._check_fraud_history(dispute) # type: ignore
+
+        async def evidence_analysis(results):
+            return await self.dispute_resolver.analyze_evidence(evidence)
+
+        async def chat_history(results):
+            if dispute_id is None:
+                return None
+            async with AsyncSessionLocal() as session:
+                return await get_split_chat_records(session, dispute_id, dispute.created_at)
+
+        async def chat_fraud_scan(results):
+            if dispute_id is None:
+                return None
+            conversation_key = conversation_key_for(dispute.buyer_id, dispute.seller_id, str(dispute_id))
+            async with AsyncSessionLocal() as session:
+                window = await get_conversation_window(session, conversation_key)
+            return await self.chat_fraud_detector.analyze_conversation(conversation_key, window)
+
+        async def resolution(results):
+            # Skip the resolution prompt entirely if there are historical fraud alerts.
+            if results["fraud_history"]["has_alerts"]:
+                return {
+                    "status": "escalated",
+                    "reason": "Previous fraud alerts found",
+                    "requires_human_review": True
+                }
+            return await self.dispute_resolver.resolve(
+                dispute,
+                evidence,
+                evidence_analysis=results["evidence_analysis"],
+                chat_records=results["chat_history"],
+            )
+
+        results, timings = await run_stages([
+            Stage("fraud_history", fraud_history),
+            Stage("evidence_analysis", evidence_analysis),
+            Stage("chat_history", chat_history),
+            Stage("chat_fraud_scan", chat_fraud_scan),
+            Stage("resolution", resolution, requires=("fraud_history", "evidence_analysis", "chat_history")),
+        ], metric_prefix="dispute")
+
+        resolution = dict(results["resolution"])
+        chat_scan = results["chat_fraud_scan"]
+        if chat_scan and chat_scan.get("is_fraudulent") and resolution["status"] == "approved":
+            # Never release funds on a conversation the fraud scan flagged.
+            resolution.update({
                 "status": "escalated",
-                "reason": "Previous fraud alerts found",
-                "requires_human_review": True
-            }
+                "reason": f"Chat fraud scan flagged the conversation: {chat_scan.get('reason')}",
+                "requires_human_review": True,
+            })
 
-        # Process the dispute resolution
-        resolution = await self.dispute_resolver.resolve(dispute, evidence)
-        
         if resolution["status"] == "approved":
-            await self.dispute_resolver._release_funds(dispute) # type: ignore
+            await self.dispute_resolver._release_funds(dispute, dispute_id) # type: ignore
         elif resolution["status"] == "escalated":
             await self.dispute_resolver._escalate_to_human(dispute, resolution["reason"]) # type: ignore
-            
+
+        resolution["chat_fraud_scan"] = chat_scan
+        resolution["stage_timings_ms"] = timings
+        if dispute_id is not None:
+            await publish_event(dispute_channel(dispute_id), "resolution", {
+                "dispute_id": str(dispute_id),
+                "status": resolution["status"],
+                "reason": resolution.get("reason"),
+                "requires_human_review": resolution.get("requires_human_review", False),
+            })
         return resolution
 
     async def process_chat_intent(self, message: ChatMessage) -> Dict[str, Any]:
         """
-        Uses the AI model to analyze whether the chat message expresses an intent
-        to leave the platform. Expected JSON output: {"intent": true/false}.
+        Determines whether the chat message expresses an intent to leave the platform.
+
+        Clear-cut messages are settled by the local rule-based pre-classifier; only
+        ambiguous ones are sent to the AI model. The result's "decided_by" field
+        records which tier made the call ("rules" or "llm", or "rules_degraded"
+        when the model was unavailable: shed under load, past the endpoint's
+        deadline or failing).
         """
+        prefilter = self._prefilter_intent(message)
+        if prefilter["decision"] == "positive":
+            metrics.incr("intent.decided_by.rules")
+            await self._handle_leaving_intent(message)
+            return {
+                "flagged": True,
+                "reason": f"{prefilter['reason']}; system warnings have been sent.",
+                "decided_by": "rules",
+            }
+        if prefilter["decision"] == "negative":
+            metrics.incr("intent.decided_by.rules")
+            return {"flagged": False, "decided_by": "rules"}
+
+        metrics.incr("intent.decided_by.llm")
+        if INTENT_BATCHING:
+            return await self._classify_intent_batched(message)
+
         prompt = f"""
         You are a chat intent detection AI. Analyze the following chat message and determine if it indicates an intent
         to conduct the trade off-platform (e.g. settle privately, negotiate outside of the platform, etc.).
@@ -82,64 +193,211 @@ class DisputeOrchestrator:
         or: {{"flagged": false}}.
         """
         try:
-            loop = asyncio.get_running_loop()
-            response = await loop.run_in_executor(None, self.dispute_resolver.model.generate_content, prompt)
-            result = json.loads(response.text)
-            if result.get("intent"):
+            response_text = await self.dispute_resolver.llm.generate(prompt)
+            result = json.loads(response_text)
+            if result.get("flagged", result.get("intent")):
+                await self._handle_leaving_intent(message)
+                return {
+                    "flagged": True,
+                    "reason": "Leaving platform intent detected; system warnings have been sent.",
+                    "decided_by": "llm",
+                }
+            return {"flagged": False, "decided_by": "llm"}
+        except LLMUnavailableError as e:
+            return self._degraded_intent(e)
+        except Exception as e:
+            return {"flagged": False, "reason": f"Intent analysis failed: {e}", "decided_by": "llm"}
+
+    async def process_chat_intents(self, messages: List[ChatMessage]) -> List[Dict[str, Any]]:
+        """
+        Batch variant of process_chat_intent. Messages the pre-classifier cannot
+        settle are sent to the model together, INTENT_BATCH_MAX_SIZE per request,
+        and the warnings for every flagged message are written in one transaction.
+        Returns one result per message, in input order.
+        """
+        results: List[Dict[str, Any]] = [None] * len(messages)
+        ambiguous = []
+        for index, message in enumerate(messages):
+            prefilter = self._prefilter_intent(message)
+            if prefilter["decision"] == "positive":
+                metrics.incr("intent.decided_by.rules")
+                results[index] = {
+                    "flagged": True,
+                    "reason": f"{prefilter['reason']}; system warnings have been sent.",
+                    "decided_by": "rules",
+                }
+            elif prefilter["decision"] == "negative":
+                metrics.incr("intent.decided_by.rules")
+                results[index] = {"flagged": False, "decided_by": "rules"}
+            else:
+                metrics.incr("intent.decided_by.llm")
+                ambiguous.append(index)
+
+        async def classify_chunk(indexes: List[int]):
+            try:
+                response_text = await self.dispute_resolver.llm.generate(
+                    build_batch_prompt([messages[index].message for index in indexes])
+                )
+                parsed = parse_batch_response(response_text, len(indexes))
+            except LLMUnavailableError as e:
+                for index in indexes:
+                    results[index] = self._degraded_intent(e)
+                return
+            except Exception as e:
+                for index in indexes:
+                    results[index] = {"flagged": False, "reason": f"Intent analysis failed: {e}", "decided_by": "llm"}
+                return
+            for index, result in zip(indexes, parsed):
+                if result.get("flagged"):
+                    results[index] = {
+                        "flagged": True,
+                        "reason": "Leaving platform intent detected; system warnings have been sent.",
+                        "decided_by": "llm",
+                    }
+                else:
+                    results[index] = {"flagged": False, "decided_by": "llm"}
+
+        await asyncio.gather(*(
+            classify_chunk(ambiguous[start:start + INTENT_BATCH_MAX_SIZE])
+            for start in range(0, len(ambiguous), INTENT_BATCH_MAX_SIZE)
+        ))
+
+        flagged = [message for message, result in zip(messages, results) if result.get("flagged")]
+        if flagged:
+            await self._handle_leaving_intents(flagged)
+        return results
+
+    def _prefilter_intent(self, message: ChatMessage) -> Dict[str, Any]:
+        started = time.perf_counter()
+        prefilter = prefilter_intent(message.message)
+        metrics.observe("intent.prefilter_us", (time.perf_counter() - started) * 1e6)
+        metrics.incr(f"intent.prefilter.{prefilter['decision']}")
+        return prefilter
+
+    def _degraded_intent(self, error: Exception) -> Dict[str, Any]:
+        """
+        Result for an ambiguous message when the model was unavailable (see
+        llm_scheduler and llm_resilience): the rules alone did not find an
+        intent to leave, so the message is not flagged.
+        """
+        metrics.incr("intent.decided_by.rules_degraded")
+        return {"flagged": False, "reason": f"Model unavailable, decided by rules only: {error}", "decided_by": "rules_degraded"}
+
+    async def _classify_intent_batched(self, message: ChatMessage) -> Dict[str, Any]:
+        """
+        LLM tier of process_chat_intent when micro-batching is enabled: the message
+        shares one structured model request with other messages arriving within
+        the batching latency budget.
+        """
+        try:
+            result = await get_intent_batcher(self.dispute_resolver.llm).classify(message.message)
+            if result.get("flagged"):
                 await self._handle_leaving_intent(message)
-                return {"flagged": True, "reason": "Leaving platform intent detected; system warnings have been sent."}
-            return {"flagged": False}
+                return {
+                    "flagged": True,
+                    "reason": "Leaving platform intent detected; system warnings have been sent.",
+                    "decided_by": "llm",
+                }
+            return {"flagged": False, "decided_by": "llm"}
+        except LLMUnavailableError as e:
+            return self._degraded_intent(e)
         except Exception as e:
-            return {"flagged": False, "reason": f"Intent analysis failed: {e}"}
+            return {"flagged": False, "reason": f"Intent analysis failed: {e}", "decided_by": "llm"}
 
     async def _handle_leaving_intent(self, message: ChatMessage):
         """
         Sends a system message warning both parties that leaving the platform is risky.
         Also flags the conversation for fraud review.
         """
+        await self._handle_leaving_intents([message])
+
+    async def _handle_leaving_intents(self, messages: List[ChatMessage]):
+        """
+        Sends the leaving-platform warnings (and flags) for several messages. All
+        warnings and flags are written in one transaction.
+        """
         warning = (
             "WARNING: Leaving the platform is very risky. You will assume all liabilities, "
             "and the platform will not cover any losses. Please reconsider your action."
         )
-        loop = asyncio.get_running_loop()
-
-        # Create a system-generated message for the sender
-        system_message_sender = {
-            "sender_id": "system",
-            "receiver_id": message.sender_id,
-            "message": warning,
-            "dispute_id": getattr(message, "dispute_id", None)
-        }
-        await loop.run_in_executor(None, save_chat_message, system_message_sender)
-
-        # Create a system-generated message for the receiver
-        system_message_receiver = {
-            "sender_id": "system",
-            "receiver_id": message.receiver_id,
-            "message": warning,
-            "dispute_id": getattr(message, "dispute_id", None)
-        }
-        await loop.run_in_executor(None, save_chat_message, system_message_receiver)
-
-        # Flag the conversation in the database if a dispute_id is present
-        dispute_id = getattr(message, "dispute_id", None)
-        if dispute_id:
-            await loop.run_in_executor(None, flag_conversation, dispute_id)
+        system_messages = []
+        flagged_disputes = set()
+        for message in messages:
+            dispute_id = getattr(message, "dispute_id", None)
+            # System warnings belong to the conversation that triggered them.
+            conversation_key = conversation_key_for(message.sender_id, message.receiver_id, dispute_id)
+
+            # Create a system-generated message for the sender and one for the receiver
+            system_messages.extend(
+                {
+                    "sender_id": "system",
+                    "receiver_id": recipient_id,
+                    "message": warning,
+                    "dispute_id": dispute_id,
+                    "conversation_key": conversation_key,
+                }
+                for recipient_id in (message.sender_id, message.receiver_id)
+            )
+            if dispute_id:
+                flagged_disputes.add(dispute_id)
+
+        async with unit_of_work() as session:
+            rows = await save_chat_messages(session, system_messages)
+            # Flag the conversation in the database if a dispute_id is present
+            for dispute_id in flagged_disputes:
+                await flag_conversation(session, dispute_id)
+        # Push the warnings to both parties once they are committed.
+        for row in rows:
+            await publish_event(row.conversation_key, "warning", message_event(row))
 
         # Log the action (could also update a UI flag)
-        print("Conversation flagged for potential fraud (leaving intent detected).")
+        if len(messages) == 1:
+            print("Conversation flagged for potential fraud (leaving intent detected).")
+        else:
+            print(f"{len(messages)} conversations flagged for potential fraud (leaving intent detected).")
 
-    async def process_dispute_chat_message(self, message: ChatMessage) -> Dict[str, Any]:
+    async def process_dispute_chat_message(self, message: ChatMessage, dispute_id: str = None) -> Dict[str, Any]:
         """
         Processes messages exchanged during a dispute resolution chat.
         At this point, the conversation context is different – the buyer/seller are now interacting
         with an automated dispute resolution agent that can pull in historical trade context and profile data.
+        With a dispute_id, the agent's reply is pushed to the dispute's channel.
         """
         profile_info = self._get_profile_info(message.sender_id)
         context_message = f"User Profile: {profile_info}\nMessage: {message.message}"
         resolution = await self.dispute_resolver.resolve_from_chat(context_message)
+        if dispute_id:
+            await self._publish_ai_reply(message, dispute_id, resolution)
         return resolution
 
+    async def stream_dispute_chat_message(self, message: ChatMessage, dispute_id: str = None):
+        """
+        Streaming variant of process_dispute_chat_message: yields the agent's
+        reply as {"type": "delta", "text": ...} events while it is generated and
+        a final {"type": "result", ...} event with the parsed decision.
+        """
+        profile_info = self._get_profile_info(message.sender_id)
+        context_message = f"User Profile: {profile_info}\nMessage: {message.message}"
+        started = time.perf_counter()
+        first_delta = True
+        async for event in self.dispute_resolver.resolve_from_chat_stream(context_message):
+            if event["type"] == "delta" and first_delta:
+                metrics.observe("dispute_chat.stream.first_token_ms", (time.perf_counter() - started) * 1000)
+                first_delta = False
+            elif event["type"] == "result":
+                metrics.observe("dispute_chat.stream.total_ms", (time.perf_counter() - started) * 1000)
+                if dispute_id:
+                    resolution = {key: value for key, value in event.items() if key != "type"}
+                    await self._publish_ai_reply(message, dispute_id, resolution)
+            yield event
+
+    async def _publish_ai_reply(self, message: ChatMessage, dispute_id: str, resolution: Dict[str, Any]):
+        await publish_event(dispute_channel(dispute_id), "ai_reply", {
+            "dispute_id": dispute_id,
+            "in_reply_to": message.model_dump(),
+            **resolution,
+        })
+
     def _get_profile_info(self, user_id: str) -> str:
         return f"Profile data for user {user_id}"
 
@@ -0,0 +1,220 @@
+# prompt_budget.py
+"""
+Token-budgeted assembly of the chat history section of resolution prompts.
+
+The dispute prompts used to embed the whole pre- and post-dispute history, so
+long disputes produced huge prompts that were slow, expensive and sometimes
+rejected. `ChatPromptBudget.render` fits the history into a token budget:
+
+  1. Every message gets a priority: dispute-relevant content (payments,
+     transfers, receipts, the disputed amount or transaction id, ...) ranks
+     first, then post-dispute messages, then recency.
+  2. Messages are taken verbatim in priority order while they fit.
+  3. Whatever does not fit is compressed into a short summary (by the model,
+     falling back to an extractive summary), cached per dispute and omitted set
+     so repeated resolutions of the same dispute do not re-summarize. A
+     fallback summary is not cached, and the render is reported as degraded.
+
+The kept messages are rendered in chronological order. Token counts are
+estimated from characters (PROMPT_CHARS_PER_TOKEN) to avoid a network round
+trip per prompt. Prompt size and composition are recorded in `metrics`.
+"""
+import os
+import re
+import math
+import hashlib
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import metrics
+from db import format_chat_record
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "8000"))
+PROMPT_CHARS_PER_TOKEN = float(os.getenv("PROMPT_CHARS_PER_TOKEN", "4"))
+# Tokens reserved for the summary of the omitted messages.
+PROMPT_SUMMARY_TOKENS = int(os.getenv("PROMPT_SUMMARY_TOKENS", "400"))
+# Cap on the omitted history sent to the model for summarization.
+PROMPT_SUMMARY_INPUT_TOKENS = int(os.getenv("PROMPT_SUMMARY_INPUT_TOKENS", "12000"))
+# "llm" summarizes omitted messages with the model, "extractive" only quotes the most relevant ones.
+PROMPT_SUMMARY_MODE = os.getenv("PROMPT_SUMMARY_MODE", "llm")
+PROMPT_SUMMARY_CACHE_SIZE = int(os.getenv("PROMPT_SUMMARY_CACHE_SIZE", "512"))
+# Single messages longer than this are truncated.
+PROMPT_MESSAGE_MAX_TOKENS = int(os.getenv("PROMPT_MESSAGE_MAX_TOKENS", "200"))
+
+RELEVANT_TERMS = (
+    "pay", "paid", "transfer", "sent", "send", "receipt", "proof", "bank", "account", "refund",
+    "release", "received", "receive", "amount", "money", "deposit", "screenshot", "cancel",
+    "scam", "fraud", "wrong", "missing", "never", "late", "dispute", "appeal",
+)
+
+
+def estimate_tokens(text: str) -> int:
+    return int(math.ceil(len(text) / PROMPT_CHARS_PER_TOKEN))
+
+
+def size_bucket(tokens: int) -> str:
+    """Power-of-two bucket label (e.g. "le_4096") for grouping metrics by prompt size."""
+    bucket = 1024
+    while bucket < tokens:
+        bucket *= 2
+    return f"le_{bucket}"
+
+
+def relevance(record: dict, dispute) -> int:
+    text = record["message"].lower()
+    score = sum(1 for term in RELEVANT_TERMS if term in text)
+    if dispute is not None:
+        if dispute.transaction_id and dispute.transaction_id.lower() in text:
+            score += 3
+        if dispute.amount is not None and re.search(rf"(?<![\d.]){re.escape(f'{dispute.amount:g}')}(?![\d])", text):
+            score += 2
+    return score
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    max_chars = int(max_tokens * PROMPT_CHARS_PER_TOKEN)
+    return text if len(text) <= max_chars else text[:max_chars - 3] + "..."
+
+
+class ChatPromptBudget:
+    def __init__(self, summarizer=None, summary_mode: str = PROMPT_SUMMARY_MODE):
+        # summarizer: an llm_client.LLMClient used to compress omitted history.
+        self.summarizer = summarizer
+        self.summary_mode = summary_mode
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+
+    async def render(
+        self,
+        records: List[dict],
+        available_tokens: int,
+        dispute=None,
+        cache_key: str = "",
+        name: str = "prompt",
+    ) -> Tuple[str, dict]:
+        """
+        Renders `records` (dicts from db.iter_split_chat_history) as the
+        pre/post-dispute chat section in at most `available_tokens` tokens.
+
+        Returns (text, stats) where stats has the included and summarized
+        message counts, the section's estimated token count and
+        "summary_degraded" (the model summary failed and the extractive one was
+        used instead).
+        """
+        lines = [_truncate(format_chat_record(record), PROMPT_MESSAGE_MAX_TOKENS) for record in records]
+        costs = [estimate_tokens(line) + 1 for line in lines]
+
+        if sum(costs) <= available_tokens:
+            kept, omitted = list(range(len(records))), []
+        else:
+            newest = max(len(records) - 1, 1)
+            order = sorted(
+                range(len(records)),
+                key=lambda i: (
+                    min(relevance(records[i], dispute), 3),
+                    records[i].get("phase") == "post",
+                    i / newest,
+                ),
+                reverse=True,
+            )
+            remaining = max(available_tokens - PROMPT_SUMMARY_TOKENS, 0)
+            kept = []
+            for i in order:
+                if costs[i] <= remaining:
+                    kept.append(i)
+                    remaining -= costs[i]
+            kept_set = set(kept)
+            kept = sorted(kept)
+            omitted = [i for i in range(len(records)) if i not in kept_set]
+
+        sections = []
+        summary_degraded = False
+        if omitted:
+            summary, summary_degraded = await self._summary(
+                [records[i] for i in omitted], [lines[i] for i in omitted], dispute, cache_key
+            )
+            sections.append(f"Summary of {len(omitted)} earlier or less relevant messages (not shown verbatim):\n{summary}")
+        pre = [lines[i] for i in kept if records[i].get("phase") == "pre"]
+        post = [lines[i] for i in kept if records[i].get("phase") != "pre"]
+        sections.append("Pre-Dispute Chat History:\n" + "\n".join(pre))
+        sections.append("Post-Dispute Chat History:\n" + "\n".join(post))
+        text = "\n\n".join(sections)
+
+        stats = {
+            "messages_total": len(records),
+            "messages_included": len(kept),
+            "messages_summarized": len(omitted),
+            "chat_tokens": estimate_tokens(text),
+            "summary_degraded": summary_degraded,
+        }
+        metrics.observe(f"{name}.chat_tokens", stats["chat_tokens"])
+        metrics.observe(f"{name}.messages_included", stats["messages_included"])
+        metrics.observe(f"{name}.messages_summarized", stats["messages_summarized"])
+        return text, stats
+
+    async def _summary(self, records: List[dict], lines: List[str], dispute, cache_key: str) -> Tuple[str, bool]:
+        digest = hashlib.sha256(",".join(str(record.get("id")) for record in records).encode()).hexdigest()[:16]
+        key = f"{cache_key}:{digest}"
+        if key in self._summaries:
+            self._summaries.move_to_end(key)
+            metrics.incr("prompt.summary.cache_hit")
+            return self._summaries[key], False
+        metrics.incr("prompt.summary.cache_miss")
+
+        summary = None
+        degraded = False
+        if self.summary_mode == "llm" and self.summarizer is not None:
+            history = _truncate("\n".join(lines), PROMPT_SUMMARY_INPUT_TOKENS)
+            prompt = (
+                "Summarize the following messages from a P2P trade chat for a dispute reviewer in at most "
+                f"{int(PROMPT_SUMMARY_TOKENS * 0.7)} words. Keep amounts, dates, payment and account details, "
+                "promises, and anything suspicious.\n\n" + history
+            )
+            try:
+                summary = _truncate((await self.summarizer.generate(prompt)).strip(), PROMPT_SUMMARY_TOKENS)
+            except Exception as e:
+                print(f"Chat history summarization failed, using extractive summary: {e}")
+                metrics.incr("prompt.summary.fallback")
+                degraded = True
+        if summary is None:
+            summary = self._extractive_summary(records, lines, dispute)
+
+        # A fallback summary is not cached, so the next resolution retries the model.
+        if not degraded:
+            self._summaries[key] = summary
+            while len(self._summaries) > PROMPT_SUMMARY_CACHE_SIZE:
+                self._summaries.popitem(last=False)
+        return summary, degraded
+
+    @staticmethod
+    def _extractive_summary(records: List[dict], lines: List[str], dispute) -> str:
+        senders = sorted({record["sender_id"] for record in records})
+        header = (
+            f"{len(records)} messages from {', '.join(senders)} "
+            f"between {records[0]['created_at']} and {records[-1]['created_at']}."
+        )
+        remaining = PROMPT_SUMMARY_TOKENS - estimate_tokens(header)
+        picked = []
+        for i in sorted(range(len(records)), key=lambda i: relevance(records[i], dispute), reverse=True):
+            cost = estimate_tokens(lines[i]) + 1
+            if relevance(records[i], dispute) == 0 or cost > remaining:
+                break
+            picked.append(i)
+            remaining -= cost
+        quoted = "\n".join(lines[i] for i in sorted(picked))
+        return header + ("\nMost relevant:\n" + quoted if quoted else "")
+
+
+def observe_prompt(name: str, prompt: str, stats: Optional[dict] = None) -> int:
+    """Records the size of a complete prompt; returns its estimated token count."""
+    tokens = estimate_tokens(prompt)
+    metrics.observe(f"{name}.tokens", tokens)
+    metrics.incr(f"{name}.size.{size_bucket(tokens)}")
+    if stats is not None:
+        stats["prompt_tokens"] = tokens
+    return tokens
+
+
+def observe_latency(name: str, tokens: int, latency_ms: float):
+    """Records model latency overall and per prompt-size bucket."""
+    metrics.observe(f"{name}.latency_ms", latency_ms)
+    metrics.observe(f"{name}.latency_ms.{size_bucket(tokens)}", latency_ms)
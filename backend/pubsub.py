@@ -0,0 +1,131 @@
+# pubsub.py
+"""
+Real-time event fan-out for chat and dispute updates.
+
+Events are published to a channel named after the conversation they belong
+to, i.e. its conversation key (db.conversation_key_for): "dispute:<id>" for a
+dispute chat and "pair:<a>:<b>" for a buyer/seller conversation. Every event
+is a dict {"type": ..., "channel": ..., "data": {...}} where type is one of:
+
+  - "message":    a chat message was saved
+  - "warning":    a system warning was saved (e.g. leaving-platform intent)
+  - "ai_reply":   the dispute agent answered a dispute chat message
+  - "resolution": a dispute resolution was produced
+
+The chat router exposes the channels over WebSocket and Server-Sent Events.
+
+Subscribers get a bounded queue each (PUBSUB_QUEUE_SIZE); a subscriber that
+falls behind loses its oldest events rather than slowing down publishers.
+`InMemoryBroker` only reaches subscribers in the same process, so events
+published by dedicated worker processes (worker.py) are not delivered. A
+cross-process broker (e.g. Redis or PostgreSQL LISTEN/NOTIFY) can implement
+`Broker` and be installed with `set_broker`.
+"""
+import os
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Set
+
+import metrics
+
+PUBSUB_QUEUE_SIZE = int(os.getenv("PUBSUB_QUEUE_SIZE", "100"))
+# Idle SSE streams and WebSockets get a keep-alive this often.
+PUBSUB_HEARTBEAT_SECONDS = float(os.getenv("PUBSUB_HEARTBEAT_SECONDS", "15"))
+
+
+class Subscription:
+    def __init__(self, channel: str, max_size: int = PUBSUB_QUEUE_SIZE):
+        self.channel = channel
+        self._queue: asyncio.Queue = asyncio.Queue(max_size)
+
+    def put(self, event: dict):
+        if self._queue.full():
+            self._queue.get_nowait()
+            metrics.incr("pubsub.dropped")
+        self._queue.put_nowait(event)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[dict]:
+        """Returns the next event, or None if none arrives within `timeout` seconds."""
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class Broker:
+    """Interface for pub/sub backends."""
+
+    async def publish(self, channel: str, event: dict):
+        raise NotImplementedError
+
+    def subscribe(self, channel: str):
+        """Async context manager yielding a Subscription to `channel`."""
+        raise NotImplementedError
+
+
+class InMemoryBroker(Broker):
+    """Fans events out to the subscribers of this process."""
+
+    def __init__(self):
+        self._subscriptions: Dict[str, Set[Subscription]] = {}
+
+    async def publish(self, channel: str, event: dict):
+        subscriptions = self._subscriptions.get(channel, ())
+        for subscription in subscriptions:
+            subscription.put(event)
+        metrics.incr("pubsub.published")
+        metrics.observe("pubsub.fanout", len(subscriptions))
+
+    @asynccontextmanager
+    async def subscribe(self, channel: str) -> AsyncIterator[Subscription]:
+        subscription = Subscription(channel)
+        self._subscriptions.setdefault(channel, set()).add(subscription)
+        metrics.incr("pubsub.subscribed")
+        try:
+            yield subscription
+        finally:
+            subscriptions = self._subscriptions.get(channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[channel]
+
+    def subscriber_count(self, channel: str) -> int:
+        return len(self._subscriptions.get(channel, ()))
+
+
+_broker: Broker = InMemoryBroker()
+
+
+def get_broker() -> Broker:
+    return _broker
+
+
+def set_broker(broker: Broker):
+    global _broker
+    _broker = broker
+
+
+async def publish_event(channel: str, event_type: str, data: dict):
+    """Publishes an event; failures are logged and never fail the caller."""
+    try:
+        await _broker.publish(channel, {"type": event_type, "channel": channel, "data": data})
+    except Exception as e:
+        print(f"Failed to publish {event_type} event to {channel}: {e}")
+
+
+def dispute_channel(dispute_id) -> str:
+    # Same key as db.conversation_key_for gives the dispute's messages.
+    return f"dispute:{dispute_id}"
+
+
+def message_event(row) -> dict:
+    """Event data for a saved ChatMessageDB row."""
+    return {
+        "id": row.id,
+        "sender_id": row.sender_id,
+        "receiver_id": row.receiver_id,
+        "message": row.message,
+        "dispute_id": row.dispute_id,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+    }
@@ -1,44 +1,100 @@
-from fastapi import APIRouter, HTTPException, Depends
-from sqlalchemy.orm import Session
-from db import SessionLocal, get_split_chat_history
-from models import DisputeSubmissionDB  # Your ORM dispute model
-from agents.dispute_resolution import DisputeResolver
+from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi.responses import StreamingResponse
+from typing import Optional
+from db import join_split_chat_history
+from db import DisputeSubmissionDB  # Your ORM dispute model
+from db_async import AsyncSessionLocal, get_dispute_watermark, get_split_chat_records, iter_split_chat_history
+from dispute_cache import get_dispute_aggregate
+from pubsub import publish_event, dispute_channel
+from llm_scheduler import llm_call_class
+from llm_resilience import llm_deadline, FINALIZE_DEADLINE_SECONDS
+from agents.dispute_resolution import DisputeResolver, evidence_metadata
+from dependencies import get_dispute_resolver
+from singleflight import SingleFlight, DatabaseSingleFlight
+import datetime
+import json
+import time
+import os
 
 router = APIRouter()
 
-# This dependency matches the one defined in db.py,
-# ensuring the session is correctly created and closed.
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Concurrent finalize calls for one dispute share a single computation, and the
+# result is memoized until new chat messages or evidence arrive. "memory"
+# coalesces within this process; "db" also coalesces across API processes.
+FINALIZE_SINGLEFLIGHT = os.getenv("FINALIZE_SINGLEFLIGHT", "memory")
+FINALIZE_MEMO_SIZE = int(os.getenv("FINALIZE_MEMO_SIZE", "256"))
+
+# Failed and degraded outcomes (the model or its history summary was
+# unavailable) are not memoized, so the next call retries them.
+_memoize_finalize = lambda summary: not (
+    summary["final_resolution"].get("failed") or summary["final_resolution"].get("degraded")
+)
+
+if FINALIZE_SINGLEFLIGHT == "db":
+    finalize_flight = DatabaseSingleFlight(FINALIZE_MEMO_SIZE, "finalize", _memoize_finalize)
+else:
+    finalize_flight = SingleFlight(FINALIZE_MEMO_SIZE, "finalize", _memoize_finalize)
 
 @router.post("/{dispute_id}/finalize", response_model=dict)
-async def finalize_dispute(dispute_id: str, db: Session = Depends(get_db)):
+async def finalize_dispute(
+    dispute_id: int,
+    include_chat: bool = True,
+    dispute_resolver: DisputeResolver = Depends(get_dispute_resolver),
+):
     """
     Finalizes a dispute resolution by retrieving dispute details, associated evidence, 
     and splitting chat history into pre and post dispute segments. Then, it calls the 
     finalize_resolution function to generate the final AI resolution. This final summary 
     is formatted as JSON for easy consumption by frontend UI for human review.
+
+    With include_chat=false the chat history is left out of the summary and a
+    link to the paginated /{dispute_id}/chat-history endpoint is returned instead.
     """
-    # Retrieve the dispute record by its ID. This includes associated evidence if it exists.
-    dispute = db.query(DisputeSubmissionDB).filter(DisputeSubmissionDB.id == dispute_id).first()
-    if not dispute:
+    # Retrieve the dispute record by its ID, with its evidence (if any) and participant
+    # summary loaded in one go; hot disputes are served from the dispute cache.
+    aggregate = await get_dispute_aggregate(dispute_id)
+    if not aggregate:
         raise HTTPException(status_code=404, detail="Dispute not found")
-    
-    # Evidence is optionally retrieved via the relationship in the dispute record.
-    evidence = dispute.evidence
+    dispute = aggregate["dispute"]
+    evidence = aggregate["evidence"]
+
+    # Calls for the same dispute with the same chat/evidence high-water mark share one result.
+    async with AsyncSessionLocal() as session:
+        watermark = await get_dispute_watermark(session, dispute.id)
+    key = f"finalize:{dispute.id}:{watermark}"
+    # Finalization is reviewer-facing, so its model calls are scheduled ahead of all others.
+    with llm_call_class("finalize"), llm_deadline(FINALIZE_DEADLINE_SECONDS):
+        summary = await finalize_flight.do(key, lambda: _finalize(aggregate, dispute_resolver))
+    # Only the summary is shared and memoized; the chat history is loaded (and its
+    # text built) for the callers that asked for it.
+    if include_chat:
+        async with AsyncSessionLocal() as session:
+            chat_records = await get_split_chat_records(session, dispute.id, dispute.created_at)
+        pre_chat, post_chat = join_split_chat_history(chat_records)
+        chat_history = {"pre_dispute": pre_chat, "post_dispute": post_chat}
+    else:
+        chat_history = {"href": f"/dispute/{dispute.id}/chat-history"}
+    return {**summary, "chat_history": chat_history}
 
+async def _finalize(aggregate: dict, dispute_resolver: DisputeResolver) -> dict:
+    """
+    Returns the finalization summary; its chat_history is filled in by
+    finalize_dispute, depending on include_chat.
+    """
+    dispute: DisputeSubmissionDB = aggregate["dispute"]
+    evidence = aggregate["evidence"]
     # Retrieve the split chat history (pre- and post-dispute) using the dispute's creation timestamp.
-    pre_chat, post_chat = get_split_chat_history(dispute_id, dispute.created_at)
-    
-    # Instantiate the dispute resolution AI agent.
-    dispute_resolver = DisputeResolver()
+    # It is loaded once here and handed to the resolver rather than fetched again inside it.
+    timings = {}
+    started = time.perf_counter()
+    async with AsyncSessionLocal() as session:
+        chat_records = await get_split_chat_records(session, dispute.id, dispute.created_at)
+    timings["chat_history"] = round((time.perf_counter() - started) * 1000, 2)
     
     # Finalize the resolution using the AI agent.
-    final_result = await dispute_resolver.finalize_resolution(dispute, evidence=evidence)
+    started = time.perf_counter()
+    final_result = await dispute_resolver.finalize_resolution(dispute, evidence=evidence, chat_records=chat_records)
+    timings["finalize_resolution"] = round((time.perf_counter() - started) * 1000, 2)
     
     # Aggregate all relevant details into a summary for the frontend.
     summary = {
@@ -50,17 +106,76 @@ async def finalize_dispute(dispute_id: str, db: Session = Depends(get_db)):
             "additional_info": dispute.additional_info,
             "created_at": str(dispute.created_at)
         },
-        "chat_history": {
-            "pre_dispute": pre_chat,
-            "post_dispute": post_chat
-        },
-        "evidence_metadata": evidence.metadata if evidence else None,
+        "participants": aggregate["participants"],
+        "chat_history": None,
+        "evidence_metadata": evidence_metadata(evidence) if evidence else None,
         "final_resolution": {
             "status": final_result.get("status"),
             "reason": final_result.get("reason"),
             "confidence": final_result.get("confidence"),
-            "requires_human_review": final_result.get("requires_human_review", False)
-        }
+            "requires_human_review": final_result.get("requires_human_review", False),
+            "failed": final_result.get("failed", False),
+            "degraded": final_result.get("degraded", False),
+            "model_tier": final_result.get("model_tier")
+        },
+        "stage_timings_ms": timings
     }
+    # Push the outcome to the dispute chat; memoized repeats are not re-published.
+    await publish_event(dispute_channel(dispute.id), "resolution", {
+        "dispute_id": str(dispute.id),
+        **summary["final_resolution"],
+    })
     
-    return summary 
\ No newline at end of file
+    return summary
+
+def _encode_cursor(record: dict) -> str:
+    return f"{record['created_at'].isoformat()}|{record['id']}"
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        created_at, message_id = cursor.rsplit("|", 1)
+        return datetime.datetime.fromisoformat(created_at), int(message_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@router.get("/{dispute_id}/chat-history")
+async def get_dispute_chat_history(
+    dispute_id: int,
+    phase: Optional[str] = Query(None, pattern="^(pre|post)$"),
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+):
+    """
+    Returns the dispute's chat history as structured records (id, sender_id,
+    message, created_at and phase "pre"/"post" relative to the dispute's creation),
+    oldest first, optionally for one phase only.
+
+    format=json returns one page of `limit` records plus a `next_cursor` to pass
+    back for the following page (null on the last page). format=ndjson streams
+    every record from `cursor` on as newline-delimited JSON, so long histories
+    are never built in memory.
+    """
+    aggregate = await get_dispute_aggregate(dispute_id)
+    if not aggregate:
+        raise HTTPException(status_code=404, detail="Dispute not found")
+    dispute = aggregate["dispute"]
+    after = _decode_cursor(cursor) if cursor else None
+
+    if format == "ndjson":
+        async def lines():
+            # The session stays open for as long as the response is streaming.
+            async with AsyncSessionLocal() as session:
+                async for record in iter_split_chat_history(session, dispute.id, dispute.created_at, phase=phase, after=after):
+                    record["created_at"] = record["created_at"].isoformat()
+                    yield json.dumps(record) + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    async with AsyncSessionLocal() as session:
+        records = [
+            record async for record in iter_split_chat_history(
+                session, dispute.id, dispute.created_at, phase=phase, after=after, limit=limit + 1
+            )
+        ]
+    next_cursor = _encode_cursor(records[limit - 1]) if len(records) > limit else None
+    return {"items": records[:limit], "next_cursor": next_cursor}
@@ -0,0 +1,208 @@
+# singleflight.py
+"""
+Request coalescing for expensive, idempotent computations.
+
+`SingleFlight.do(key, fn)` runs `fn()` once per key at a time: callers that
+arrive while a computation for the same key is in flight await that same
+computation instead of starting their own. With `memo_size` > 0 finished
+results are also kept (least recently used first out), so repeat calls for a
+key return immediately. Callers make the key change when the inputs change,
+e.g. by including a data high-water mark.
+
+`DatabaseSingleFlight` gives the same guarantee across processes (several API
+workers): a row in the "singleflight_locks" table elects one computing process
+per key and the result is published in "singleflight_results", where the other
+processes poll for it. Published results are kept for
+SINGLEFLIGHT_RESULT_TTL_SECONDS; expired rows are ignored, and deleted by the
+first save after each SINGLEFLIGHT_PURGE_INTERVAL_SECONDS, so the table does
+not grow without bound. Results are stored whole, so callers should keep them
+small (e.g. ids and summaries rather than loaded rows). The table is accessed
+through db_async, without blocking the event loop or the default executor.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import datetime
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+
+from db import SingleFlightLockDB, SingleFlightResultDB
+from db_async import AsyncSessionLocal, unit_of_work
+import metrics
+
+SINGLEFLIGHT_LOCK_SECONDS = float(os.getenv("SINGLEFLIGHT_LOCK_SECONDS", "120"))
+SINGLEFLIGHT_POLL_INTERVAL_SECONDS = float(os.getenv("SINGLEFLIGHT_POLL_INTERVAL_SECONDS", "0.2"))
+SINGLEFLIGHT_RESULT_TTL_SECONDS = float(os.getenv("SINGLEFLIGHT_RESULT_TTL_SECONDS", "3600"))
+SINGLEFLIGHT_PURGE_INTERVAL_SECONDS = float(os.getenv("SINGLEFLIGHT_PURGE_INTERVAL_SECONDS", "300"))
+
+
+class SingleFlight:
+    """In-process coalescing (and optional memoization) of async computations."""
+
+    def __init__(
+        self,
+        memo_size: int = 0,
+        name: str = "singleflight",
+        should_memoize: Optional[Callable[[Any], bool]] = None,
+    ):
+        self.memo_size = memo_size
+        self.name = name
+        # Results for which this returns False (e.g. transient failures) are not kept.
+        self.should_memoize = should_memoize or (lambda result: True)
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._memo: "OrderedDict[Hashable, Any]" = OrderedDict()
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        if key in self._memo:
+            self._memo.move_to_end(key)
+            metrics.incr(f"{self.name}.memo_hit")
+            return self._memo[key]
+
+        future = self._inflight.get(key)
+        if future is not None:
+            metrics.incr(f"{self.name}.coalesced")
+            # shield: one impatient caller must not cancel the shared computation.
+            return await asyncio.shield(future)
+
+        metrics.incr(f"{self.name}.computed")
+        future = asyncio.ensure_future(fn())
+        self._inflight[key] = future
+        future.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(future)
+
+    def _finish(self, key: Hashable, future: asyncio.Future):
+        self._inflight.pop(key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        if self.memo_size > 0 and self.should_memoize(future.result()):
+            self._memo[key] = future.result()
+            self._memo.move_to_end(key)
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+
+    def forget(self, key: Hashable):
+        self._memo.pop(key, None)
+
+
+async def _acquire_lock(key: str, owner: str, lease_seconds: float) -> bool:
+    now = datetime.datetime.utcnow()
+    expires_at = now + datetime.timedelta(seconds=lease_seconds)
+    try:
+        async with unit_of_work() as session:
+            session.add(SingleFlightLockDB(key=key, owner=owner, expires_at=expires_at))
+        return True
+    except IntegrityError:
+        pass
+    # Take over a lock whose holder died without releasing it.
+    async with unit_of_work() as session:
+        taken = await session.execute(
+            update(SingleFlightLockDB)
+            .where(SingleFlightLockDB.key == key, SingleFlightLockDB.expires_at < now)
+            .values(owner=owner, expires_at=expires_at)
+            .execution_options(synchronize_session=False)
+        )
+    return taken.rowcount == 1
+
+
+async def _release_lock(key: str, owner: str):
+    async with unit_of_work() as session:
+        await session.execute(
+            delete(SingleFlightLockDB)
+            .where(SingleFlightLockDB.key == key, SingleFlightLockDB.owner == owner)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def _result_cutoff() -> datetime.datetime:
+    return datetime.datetime.utcnow() - datetime.timedelta(seconds=SINGLEFLIGHT_RESULT_TTL_SECONDS)
+
+
+async def _get_result(key: str) -> Optional[str]:
+    async with AsyncSessionLocal() as session:
+        row = await session.get(SingleFlightResultDB, key)
+        if row is None or row.created_at < _result_cutoff():
+            return None
+        return row.result
+
+
+_next_purge = 0.0
+
+
+async def _save_result(key: str, result: str):
+    """
+    Publishes the result for `key`. At most once per SINGLEFLIGHT_PURGE_INTERVAL_SECONDS
+    per process, results past SINGLEFLIGHT_RESULT_TTL_SECONDS are deleted as well.
+    """
+    global _next_purge
+    async with unit_of_work() as session:
+        if time.monotonic() >= _next_purge:
+            _next_purge = time.monotonic() + SINGLEFLIGHT_PURGE_INTERVAL_SECONDS
+            expired = await session.execute(
+                delete(SingleFlightResultDB)
+                .where(SingleFlightResultDB.created_at < _result_cutoff(), SingleFlightResultDB.key != key)
+                .execution_options(synchronize_session=False)
+            )
+            if expired.rowcount:
+                metrics.incr("singleflight.results_expired", expired.rowcount)
+        row = await session.get(SingleFlightResultDB, key)
+        if row is None:
+            session.add(SingleFlightResultDB(key=key, result=result))
+        else:
+            row.result = result
+            row.created_at = datetime.datetime.utcnow()
+
+
+class DatabaseSingleFlight(SingleFlight):
+    """
+    Cross-process variant of SingleFlight. Keys must be strings and results
+    JSON-serializable. Calls within one process are still coalesced in memory
+    first, so each process holds at most one database lock per key.
+    """
+
+    def __init__(
+        self,
+        memo_size: int = 0,
+        name: str = "singleflight",
+        should_memoize: Optional[Callable[[Any], bool]] = None,
+        lease_seconds: float = SINGLEFLIGHT_LOCK_SECONDS,
+        poll_interval: float = SINGLEFLIGHT_POLL_INTERVAL_SECONDS,
+    ):
+        super().__init__(memo_size, name, should_memoize)
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        return await super().do(key, lambda: self._do_locked(key, fn))
+
+    async def _do_locked(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        started = time.perf_counter()
+        while True:
+            stored = await _get_result(key)
+            if stored is not None:
+                metrics.incr(f"{self.name}.db_result_hit")
+                return json.loads(stored)
+            if await _acquire_lock(key, self.owner, self.lease_seconds):
+                break
+            if time.perf_counter() - started > self.lease_seconds:
+                raise TimeoutError(f"Timed out waiting for the computation of {key}")
+            # Wait for the holder to publish its result (or to fail and release the lock).
+            await asyncio.sleep(self.poll_interval)
+
+        try:
+            # Another process may have published the result between our check and the lock.
+            stored = await _get_result(key)
+            if stored is not None:
+                return json.loads(stored)
+            result = await fn()
+            if self.should_memoize(result):
+                await _save_result(key, json.dumps(result, default=str))
+            return result
+        finally:
+            await _release_lock(key, self.owner)
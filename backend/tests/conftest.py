@@ -0,0 +1,20 @@
+# tests/conftest.py
+"""
+Shared setup for the backend tests: backend/ on the import path, and a
+throwaway SQLite database, local evidence storage and fake models configured
+before any backend module is imported.
+
+Run from backend/:
+    python -m pytest -q tests
+"""
+import os
+import sys
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="backend-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_tmp, 'test.db')}")
+os.environ.setdefault("STORAGE_BACKEND", "local")
+os.environ.setdefault("LOCAL_STORAGE_DIR", os.path.join(_tmp, "uploads"))
+os.environ.setdefault("LLM_BACKEND", "fake")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,47 @@
+# tests/test_chat_ingest.py
+import uuid
+import asyncio
+
+from sqlalchemy.exc import IntegrityError
+
+import db
+from chat_ingest import ChatWriteBuffer
+
+
+def _message(text: str, **extra) -> dict:
+    return {"sender_id": "ingest-a", "receiver_id": "ingest-b", "message": text, **extra}
+
+
+def test_one_bad_message_fails_only_its_own_caller():
+    db.init_db()
+    existing_id = db.save_chat_message(_message("already stored")).id
+    tag = uuid.uuid4().hex
+    buffer = ChatWriteBuffer(max_size=100, max_delay_ms=20)
+
+    async def run():
+        messages = [_message(f"{tag}-{i}") for i in range(7)]
+        messages.insert(3, _message(f"{tag}-duplicate", id=existing_id))
+        return await asyncio.gather(*(buffer.save(message) for message in messages), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert isinstance(results[3], IntegrityError)
+    saved = [result for index, result in enumerate(results) if index != 3]
+    assert all(isinstance(result, dict) and result["message_id"] for result in saved)
+
+    session = db.SessionLocal()
+    try:
+        stored = session.query(db.ChatMessageDB).filter(db.ChatMessageDB.message.like(f"{tag}-%")).count()
+    finally:
+        session.close()
+    assert stored == 7
+
+
+def test_group_is_written_in_one_flush():
+    db.init_db()
+    buffer = ChatWriteBuffer(max_size=4, max_delay_ms=1000)
+
+    async def run():
+        return await asyncio.gather(*(buffer.save(_message(f"group-{i}")) for i in range(4)))
+
+    ids = [result["message_id"] for result in asyncio.run(run())]
+    assert ids == sorted(ids) and len(set(ids)) == 4
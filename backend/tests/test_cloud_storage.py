@@ -0,0 +1,66 @@
+# tests/test_cloud_storage.py
+import io
+import asyncio
+import hashlib
+
+from cloud_storage import LocalStorageBackend, _GCSWriter, content_key, stream_upload_deduplicated
+
+
+class _Upload:
+    def __init__(self, data: bytes):
+        self._file = io.BytesIO(data)
+
+    async def read(self, size: int) -> bytes:
+        return self._file.read(size)
+
+
+def test_identical_uploads_are_stored_once(tmp_path):
+    backend = LocalStorageBackend(str(tmp_path))
+    data = b"receipt" * 1000
+
+    async def run():
+        first = await stream_upload_deduplicated(_Upload(data), backend, chunk_size=1024)
+        second = await stream_upload_deduplicated(_Upload(data), backend, chunk_size=1024)
+        return first, second
+
+    first, second = asyncio.run(run())
+    sha256 = hashlib.sha256(data).hexdigest()
+    assert first["sha256"] == sha256 and first["size"] == len(data)
+    assert (first["deduplicated"], second["deduplicated"]) == (False, True)
+    assert first["uri"] == second["uri"] == backend.uri_for(content_key(sha256))
+    assert not [path for path in tmp_path.rglob("*.part")]
+
+
+class _Transport:
+    def __init__(self):
+        self.deleted = []
+
+    def delete(self, url):
+        self.deleted.append(url)
+
+
+class _ResumableUpload:
+    resumable_url = "https://storage.googleapis.com/upload/session-1"
+
+
+class _BlobWriter:
+    def __init__(self, transport):
+        self._upload_and_transport = (_ResumableUpload(), transport)
+
+    def close(self):
+        raise AssertionError("closing would commit the partial upload")
+
+
+class _Blob:
+    def __init__(self, writer):
+        self.writer = writer
+
+    def open(self, mode, chunk_size):
+        return self.writer
+
+
+def test_gcs_abort_cancels_the_resumable_session():
+    transport = _Transport()
+    writer = _GCSWriter(_Blob(_BlobWriter(transport)), "gs://bucket/key", 256 * 1024)
+    writer.abort()
+    assert transport.deleted == [_ResumableUpload.resumable_url]
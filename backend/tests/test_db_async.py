@@ -0,0 +1,82 @@
+# tests/test_db_async.py
+import uuid
+import asyncio
+
+import pytest
+
+import db
+from db_async import (
+    AsyncSessionLocal,
+    claim_funds_release,
+    get_conversation_fraud_state,
+    get_conversation_window,
+    save_chat_messages,
+    save_conversation_fraud_state,
+    save_dispute,
+    unit_of_work,
+)
+
+
+def _dispute_data() -> dict:
+    return {
+        "transaction_id": f"tx-{uuid.uuid4().hex}",
+        "buyer_id": "buyer-1",
+        "seller_id": "seller-1",
+        "dispute_type": "seller_not_released",
+        "amount": 100.0,
+        "currency": "USD",
+    }
+
+
+def test_funds_release_claim_is_part_of_the_unit_of_work():
+    db.init_db()
+
+    async def run():
+        async with unit_of_work() as session:
+            dispute_id = (await save_dispute(session, _dispute_data())).id
+        with pytest.raises(RuntimeError):
+            async with unit_of_work() as session:
+                assert await claim_funds_release(session, dispute_id)
+                raise RuntimeError("payment gateway failed")
+        # The claim was rolled back with the rest of the work, so it can be made again, once.
+        async with unit_of_work() as session:
+            first = await claim_funds_release(session, dispute_id)
+        async with unit_of_work() as session:
+            second = await claim_funds_release(session, dispute_id)
+        return first, second
+
+    assert asyncio.run(run()) == (True, False)
+
+
+def test_conversation_window_is_bounded_and_oldest_first():
+    db.init_db()
+    key = f"conv-{uuid.uuid4().hex}"
+
+    async def run():
+        async with unit_of_work() as session:
+            await save_chat_messages(session, [
+                {"sender_id": "a", "receiver_id": "b", "message": f"m{i}", "conversation_key": key}
+                for i in range(5)
+            ])
+        async with AsyncSessionLocal() as session:
+            return await get_conversation_window(session, key, limit=3)
+
+    assert [row["message"] for row in asyncio.run(run())] == ["m2", "m3", "m4"]
+
+
+def test_conversation_fraud_state_round_trip():
+    db.init_db()
+    key = f"conv-{uuid.uuid4().hex}"
+
+    async def run():
+        async with AsyncSessionLocal() as session:
+            missing = await get_conversation_fraud_state(session, key)
+        for risk_score in (0.2, 0.7):
+            async with unit_of_work() as session:
+                await save_conversation_fraud_state(session, key, {"risk_score": risk_score, "last_message_id": 9})
+        async with AsyncSessionLocal() as session:
+            return missing, await get_conversation_fraud_state(session, key)
+
+    missing, state = asyncio.run(run())
+    assert missing is None
+    assert (state["risk_score"], state["last_message_id"], state["analyses_since_full"]) == (0.7, 9, 0)
@@ -0,0 +1,57 @@
+# tests/test_dispute_cache.py
+import uuid
+import asyncio
+
+import pytest
+
+import db
+import metrics
+from dispute_cache import dispute_cache, get_dispute_aggregate
+
+
+@pytest.fixture
+def dispute_id():
+    db.init_db()
+    dispute_cache.clear()
+    record = db.save_dispute({
+        "transaction_id": f"tx-{uuid.uuid4().hex}",
+        "buyer_id": "cache-buyer",
+        "seller_id": "cache-seller",
+        "dispute_type": "buyer_not_paid",
+        "amount": 50.0,
+        "currency": "USD",
+    })
+    return record.id
+
+
+def test_aggregate_is_loaded_once_and_served_from_cache(dispute_id):
+    async def run():
+        first = await get_dispute_aggregate(str(dispute_id))
+        hits = metrics.snapshot()["counters"].get("dispute_cache.hit", 0)
+        second = await get_dispute_aggregate(str(dispute_id))
+        return first, second, metrics.snapshot()["counters"]["dispute_cache.hit"] - hits
+
+    first, second, new_hits = asyncio.run(run())
+    assert first["dispute"].id == dispute_id
+    assert first["evidence"] is None
+    assert [p["role"] for p in first["participants"]] == ["buyer", "seller"]
+    assert second is first
+    assert new_hits == 1
+
+
+def test_saving_evidence_invalidates_the_aggregate(dispute_id):
+    async def run():
+        assert (await get_dispute_aggregate(dispute_id))["evidence"] is None
+        db.save_evidence({
+            "dispute_id": dispute_id,
+            "file_url": "gs://bucket/receipt.png",
+            "file_type": "image",
+        })
+        return await get_dispute_aggregate(dispute_id)
+
+    assert asyncio.run(run())["evidence"].file_url == "gs://bucket/receipt.png"
+
+
+def test_missing_dispute_is_none():
+    db.init_db()
+    assert asyncio.run(get_dispute_aggregate(10 ** 9)) is None
@@ -0,0 +1,144 @@
+# tests/test_dispute_routes.py
+import json
+import uuid
+import asyncio
+import datetime
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+import db
+from agents.dispute_resolution import DisputeResolver
+from dependencies import get_dispute_resolver
+import routes.disputes
+from routes.disputes import router
+from singleflight import DatabaseSingleFlight
+
+
+@pytest.fixture
+def dispute_id():
+    db.init_db()
+    created_at = datetime.datetime(2025, 3, 1, 12, 0)
+    record = db.save_dispute({
+        "transaction_id": f"tx-{uuid.uuid4().hex}",
+        "buyer_id": "route-buyer",
+        "seller_id": "route-seller",
+        "dispute_type": "buyer_not_paid",
+        "amount": 20.0,
+        "currency": "USD",
+        "created_at": created_at,
+    })
+    for minutes, text in ((-10, "sent the money"), (-5, "not received"), (5, "please check again")):
+        db.save_chat_message({
+            "sender_id": "route-buyer",
+            "receiver_id": "route-seller",
+            "message": text,
+            "dispute_id": str(record.id),
+            "created_at": created_at + datetime.timedelta(minutes=minutes),
+        })
+    return record.id
+
+
+@pytest.fixture
+def app(monkeypatch):
+    resolver = DisputeResolver()
+
+    async def decide(*args):
+        return {"status": "escalated", "reason": "Needs review.", "confidence": 0.9}
+
+    monkeypatch.setattr(resolver, "_decide", decide)
+    app = FastAPI()
+    app.include_router(router, prefix="/dispute")
+    app.dependency_overrides[get_dispute_resolver] = lambda: resolver
+    return app
+
+
+def _request(app, method: str, url: str) -> httpx.Response:
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await client.request(method, url)
+    return asyncio.run(run())
+
+
+def test_finalize_with_and_without_chat(app, dispute_id):
+    with_chat = _request(app, "POST", f"/dispute/{dispute_id}/finalize").json()
+    assert with_chat["chat_history"]["pre_dispute"].count("\n") == 1
+    assert "please check again" in with_chat["chat_history"]["post_dispute"]
+
+    # Served from the memoized result, which must not carry the previous caller's choice.
+    without_chat = _request(app, "POST", f"/dispute/{dispute_id}/finalize?include_chat=false").json()
+    assert without_chat["chat_history"] == {"href": f"/dispute/{dispute_id}/chat-history"}
+    assert without_chat["final_resolution"] == with_chat["final_resolution"]
+
+
+def test_published_finalize_result_holds_only_the_summary(app, dispute_id, monkeypatch):
+    monkeypatch.setattr(
+        routes.disputes, "finalize_flight", DatabaseSingleFlight(name="finalize", should_memoize=routes.disputes._memoize_finalize)
+    )
+    first = _request(app, "POST", f"/dispute/{dispute_id}/finalize").json()
+    # A second process would serve the published summary with the history reloaded.
+    monkeypatch.setattr(
+        routes.disputes, "finalize_flight", DatabaseSingleFlight(name="finalize", should_memoize=routes.disputes._memoize_finalize)
+    )
+    second = _request(app, "POST", f"/dispute/{dispute_id}/finalize").json()
+    assert second == first
+    assert "please check again" in second["chat_history"]["post_dispute"]
+
+    session = db.SessionLocal()
+    try:
+        rows = session.query(db.SingleFlightResultDB).filter(
+            db.SingleFlightResultDB.key.like(f"finalize:{dispute_id}:%")
+        ).all()
+    finally:
+        session.close()
+    assert len(rows) == 1
+    assert "please check again" not in rows[0].result
+    assert set(json.loads(rows[0].result)) >= {"dispute_details", "final_resolution"}
+
+
+def test_degraded_finalize_result_is_not_memoized(app, dispute_id, monkeypatch):
+    class FailingSummarizer:
+        async def generate(self, prompt):
+            raise RuntimeError("summarizer down")
+
+    resolver = app.dependency_overrides[get_dispute_resolver]()
+    resolver.chat_budget.summarizer = FailingSummarizer()
+    # No room for verbatim history: every message goes into the summary.
+    monkeypatch.setattr("agents.dispute_resolution.PROMPT_TOKEN_BUDGET", 0)
+    prompts = []
+
+    async def decide(prompt, *args):
+        prompts.append(prompt)
+        return {"status": "escalated", "reason": "Needs review.", "confidence": 0.9}
+
+    monkeypatch.setattr(resolver, "_decide", decide)
+    first = _request(app, "POST", f"/dispute/{dispute_id}/finalize").json()
+    assert first["final_resolution"]["degraded"] is True
+    second = _request(app, "POST", f"/dispute/{dispute_id}/finalize").json()
+    assert second["final_resolution"]["degraded"] is True
+    # Neither the fallback summary nor the outcome was reused.
+    assert len(prompts) == 2
+
+
+def test_chat_history_pages_and_stream(app, dispute_id):
+    first = _request(app, "GET", f"/dispute/{dispute_id}/chat-history?limit=2").json()
+    assert [item["phase"] for item in first["items"]] == ["pre", "pre"]
+    rest = _request(app, "GET", f"/dispute/{dispute_id}/chat-history?limit=2&cursor={first['next_cursor']}").json()
+    assert [item["message"] for item in rest["items"]] == ["please check again"]
+    assert rest["next_cursor"] is None
+
+    streamed = _request(app, "GET", f"/dispute/{dispute_id}/chat-history?format=ndjson&phase=post")
+    records = [json.loads(line) for line in streamed.text.splitlines()]
+    assert [record["message"] for record in records] == ["please check again"]
+
+
+def test_unknown_dispute_is_404(app):
+    db.init_db()
+    assert _request(app, "GET", "/dispute/999999999/chat-history").status_code == 404
+
+
+def test_non_numeric_dispute_id_is_rejected(app):
+    # Ids are bound as integers (asyncpg rejects strings for integer columns).
+    assert _request(app, "GET", "/dispute/abc/chat-history").status_code == 422
+    assert _request(app, "POST", "/dispute/abc/finalize").status_code == 422
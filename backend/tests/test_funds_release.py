@@ -0,0 +1,81 @@
+# tests/test_funds_release.py
+import uuid
+import asyncio
+
+import pytest
+
+import db
+import job_handlers
+from dispute_cache import get_dispute_aggregate
+from models import DisputeSubmission
+from orchestrator import DisputeOrchestrator
+
+
+def _persisted_dispute() -> tuple:
+    db.init_db()
+    data = {
+        "transaction_id": f"tx-{uuid.uuid4().hex}",
+        "buyer_id": "buyer-1",
+        "seller_id": "seller-1",
+        "dispute_type": "seller_not_released",
+        "amount": 100.0,
+        "currency": "USD",
+    }
+    record = db.save_dispute(data)
+    return record.id, data
+
+
+@pytest.fixture
+def orchestrator(monkeypatch):
+    orchestrator = DisputeOrchestrator()
+    resolver = orchestrator.dispute_resolver
+    released = []
+    release_funds = resolver._release_funds
+
+    async def spy(dispute, dispute_id):
+        result = await release_funds(dispute, dispute_id)
+        if result:
+            released.append(dispute_id)
+        return result
+
+    async def no_alerts(dispute):
+        return {"has_alerts": False}
+
+    async def no_chat_scan(*args):
+        return {}
+
+    async def approve(*args, **kwargs):
+        return {"status": "approved", "reason": "Paid.", "confidence": 0.95}
+
+    monkeypatch.setattr(resolver, "_release_funds", spy)
+    monkeypatch.setattr(resolver, "resolve", approve)
+    monkeypatch.setattr(resolver, "_decide", approve)
+    monkeypatch.setattr(orchestrator.fraud_detector, "_check_fraud_history", no_alerts)
+    monkeypatch.setattr(orchestrator.chat_fraud_detector, "analyze_conversation", no_chat_scan)
+    job_handlers.set_orchestrator(orchestrator)
+    orchestrator.released = released
+    return orchestrator
+
+
+def test_dispute_processed_twice_and_finalized_releases_funds_once(orchestrator):
+    dispute_id, data = _persisted_dispute()
+    payload = {"dispute": data, "dispute_id": dispute_id}
+
+    async def run():
+        first = await job_handlers.process_dispute(payload)
+        retry = await job_handlers.process_dispute(payload)
+        dispute = (await get_dispute_aggregate(dispute_id))["dispute"]
+        final = await orchestrator.dispute_resolver.finalize_resolution(dispute, chat_records=[])
+        return first, retry, final, (await get_dispute_aggregate(dispute_id))["dispute"]
+
+    first, retry, final, dispute = asyncio.run(run())
+    assert first["status"] == retry["status"] == final["status"] == "approved"
+    assert orchestrator.released == [dispute_id]
+    assert dispute.status == "resolved"
+
+
+def test_dispute_without_id_is_never_released(orchestrator):
+    dispute = DisputeSubmission(**_persisted_dispute()[1])
+    released = asyncio.run(orchestrator.dispute_resolver._release_funds(dispute, None))
+    assert released is False
+    assert orchestrator.released == []
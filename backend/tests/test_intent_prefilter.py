@@ -0,0 +1,62 @@
+# tests/test_intent_prefilter.py
+import pytest
+
+from intent_prefilter import prefilter_intent
+
+
+@pytest.mark.parametrize("text", [
+    "Let's continue on WhatsApp",
+    "add me on wechat",
+    "text me on signal",
+    "whatsapp me",
+    "My Insta is john_doe99",
+    "My tele is @joe123",
+    "hmu @trader_joe on tg",
+    "my number is 0123456789",
+    "Call me on 0123456789",
+    "My number is +60 12-345 6789",
+    "email me at a.b@example.com",
+    "wa.me/60123456789",
+    "my phone: (012) 345 6789",
+    "whatsapp me at +60 12-345 6789",
+])
+def test_concrete_contacts_are_positive(text):
+    assert prefilter_intent(text)["decision"] == "positive"
+
+
+@pytest.mark.parametrize("text", [
+    # Ordinary messages the rules used to flag.
+    "call me on monday if the payment is late",
+    "My number is wrong in the order form",
+    "can you signal me when you have paid",
+    "order id 1234567890, please call support",
+    "My tele is broken",
+    "I have paid 1500, please release",
+    # Example phrases without a contact: ordinary complaints and questions.
+    "This platform is kinda slow",
+    "I find this platform less convenient",
+    "Do you have Insta?",
+    "Check my Instagram",
+    # Order and transaction ids, and numbers that are not phone numbers.
+    "My order no is 0123 456 7890",
+    "transaction 012-345 6789",
+    "my order number is 0123 456 7890",
+    "My number is 3.5 on the list",
+    "payment ref +60 12-345 6789",
+    # Off-platform settlement without a messaging app; the rules used to skip the model.
+    "skip the escrow, just bank transfer me",
+    "can we meet face to face and pay cash",
+    "pay me through paypal instead",
+    "we can deal in person tomorrow",
+    "lets settle this between us",
+    "send it to my gmail",
+    "kita deal luar je",
+    "加我微信",
+])
+def test_everything_without_a_concrete_contact_goes_to_the_model(text):
+    assert prefilter_intent(text)["decision"] == "ambiguous"
+
+
+@pytest.mark.parametrize("text", ["ok thanks", "Hi", "received, thank you", "good morning bro", "noted"])
+def test_acknowledgements_and_greetings_are_negative(text):
+    assert prefilter_intent(text)["decision"] == "negative"
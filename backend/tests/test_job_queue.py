@@ -0,0 +1,155 @@
+# tests/test_job_queue.py
+import asyncio
+import datetime
+
+import pytest
+from sqlalchemy import update
+
+import db
+import job_queue
+from job_queue import (
+    JobWorkerPool,
+    claim_next_job,
+    complete_job,
+    enqueue_job,
+    fail_job,
+    get_job,
+    job_handler,
+    requeue_stale_jobs,
+)
+
+
+@pytest.fixture(autouse=True)
+def empty_queue():
+    db.init_db()
+    session = db.SessionLocal()
+    try:
+        session.query(db.JobDB).delete()
+        session.commit()
+    finally:
+        session.close()
+
+
+def _expire_lease(job_id: int):
+    session = db.SessionLocal()
+    try:
+        session.execute(
+            update(db.JobDB)
+            .where(db.JobDB.id == job_id)
+            .values(locked_at=datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+        )
+        session.commit()
+    finally:
+        session.close()
+
+
+def test_expired_lease_requeues_job_with_attempts_left():
+    job_id = enqueue_job("test.noop", {}, max_attempts=2)
+    claim_next_job("worker-a")
+    _expire_lease(job_id)
+
+    assert requeue_stale_jobs() == 1
+    assert get_job(job_id)["status"] == "queued"
+
+
+def test_expired_lease_on_last_attempt_fails_job():
+    # A job that kills its worker every time used to be requeued forever.
+    job_id = enqueue_job("test.noop", {}, max_attempts=1)
+    claim_next_job("worker-a")
+    _expire_lease(job_id)
+
+    assert requeue_stale_jobs() == 0
+    job = get_job(job_id)
+    assert job["status"] == "failed"
+    assert job["last_error"] == "Lease expired on the last attempt"
+
+
+def test_running_job_renews_its_lease(monkeypatch):
+    monkeypatch.setattr(job_queue, "JOB_LEASE_RENEW_SECONDS", 0.05)
+    runs = []
+
+    @job_handler("test.slow")
+    async def slow(payload):
+        runs.append(payload)
+        await asyncio.sleep(0.6)
+        return {"ok": True}
+
+    job_id = enqueue_job("test.slow", {"n": 1})
+
+    async def run():
+        pool = JobWorkerPool(concurrency=1)
+        job = await asyncio.get_running_loop().run_in_executor(None, claim_next_job, "worker-a")
+        execution = asyncio.ensure_future(pool._execute(job, "worker-a"))
+        for _ in range(5):
+            await asyncio.sleep(0.1)
+            # A lease of 0.3s would have expired halfway through without renewal.
+            assert requeue_stale_jobs(lease_seconds=0.3) == 0
+        await execution
+
+    asyncio.run(run())
+    assert get_job(job_id)["status"] == "succeeded"
+    assert len(runs) == 1
+
+
+def test_cancelled_job_is_released():
+    @job_handler("test.blocked")
+    async def blocked(payload):
+        await asyncio.sleep(10)
+
+    job_id = enqueue_job("test.blocked", {})
+
+    async def run():
+        pool = JobWorkerPool(concurrency=1)
+        job = claim_next_job("worker-a")
+        execution = asyncio.ensure_future(pool._execute(job, "worker-a"))
+        await asyncio.sleep(0.05)
+        execution.cancel()
+        await asyncio.gather(execution, return_exceptions=True)
+
+    asyncio.run(run())
+    job = get_job(job_id)
+    assert job["status"] == "queued"
+    assert job["attempts"] == 0
+
+
+def test_worker_that_lost_its_lease_cannot_overwrite_the_new_owner():
+    job_id = enqueue_job("test.noop", {}, max_attempts=3)
+    claim_next_job("worker-a")
+    _expire_lease(job_id)
+    requeue_stale_jobs()
+    assert claim_next_job("worker-b")["attempts"] == 2
+
+    # worker-a finally finishes (or fails) its stale attempt.
+    assert complete_job(job_id, "worker-a", {"stale": True}) is False
+    assert fail_job(job_id, "worker-a", "stale failure") is False
+    job = get_job(job_id)
+    assert (job["status"], job["attempts"], job["result"], job["last_error"]) == ("running", 2, None, "Lease expired")
+
+    assert complete_job(job_id, "worker-b", {"ok": True}) is True
+    assert get_job(job_id)["result"] == {"ok": True}
+
+
+def test_stale_worker_outcome_is_discarded_by_the_pool():
+    @job_handler("test.stale")
+    async def stale(payload):
+        # The lease expires mid-run and another worker takes the job over.
+        await asyncio.get_running_loop().run_in_executor(None, _expire_lease, payload["job_id"])
+        requeue_stale_jobs()
+        claim_next_job("worker-b")
+        raise RuntimeError("late failure")
+
+    job_id = enqueue_job("test.stale", {})
+    session = db.SessionLocal()
+    try:
+        session.get(db.JobDB, job_id).payload = {"job_id": job_id}
+        session.commit()
+    finally:
+        session.close()
+
+    async def run():
+        job = claim_next_job("worker-a")
+        await JobWorkerPool(concurrency=1)._execute(job, "worker-a")
+
+    asyncio.run(run())
+    job = get_job(job_id)
+    assert (job["status"], job["attempts"]) == ("running", 2)
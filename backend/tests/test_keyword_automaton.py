@@ -0,0 +1,88 @@
+# tests/test_keyword_automaton.py
+import os
+import time
+import threading
+
+import pytest
+
+from agents.fraud_prevention import FRAUD_KEYWORDS_PATH
+import keyword_automaton
+from keyword_automaton import KeywordAutomaton, KeywordRuleSet, load_keywords, normalize
+
+
+@pytest.fixture(scope="module")
+def rules():
+    return KeywordAutomaton(load_keywords(FRAUD_KEYWORDS_PATH))
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("p@ssw0rd!", "password"),
+    ("URGENT!!", "urgent"),
+    ("send b4nk-details", "send bank details"),
+    ("I paid 1500 USD, order 10023", "i paid 1500 usd order 10023"),
+    ("Café", "cafe"),
+])
+def test_normalize(text, expected):
+    assert normalize(text) == expected
+
+
+def test_matches_whole_words_only():
+    automaton = KeywordAutomaton(["urgent", "bank details"])
+    assert automaton.search("the insurgent army") == []
+    assert automaton.search("mybank details") == []
+    assert automaton.search("Urgent!! send your b4nk details") == ["urgent", "bank details"]
+
+
+def test_unspaced_scripts_match_inside_text():
+    assert KeywordAutomaton(["密码"]).search("请告诉我密码") == ["密码"]
+
+
+@pytest.mark.parametrize("text", [
+    "I will release first thing tomorrow",
+    "segerak ke kedai",
+    "the insurgent group",
+    "I paid 1500, please check",
+])
+def test_rules_file_ignores_ordinary_messages(rules, text):
+    assert rules.search(text) == []
+
+
+@pytest.mark.parametrize("text, keyword", [
+    ("you release first and I will pay", "you release first"),
+    ("what is your p@ssw0rd", "password"),
+    ("sila hantar kod pengesahan", "kod pengesahan"),
+    ("请发验证码给我", "验证码"),
+])
+def test_rules_file_flags_scam_phrases(rules, text, keyword):
+    assert keyword in rules.search(text)
+
+
+def test_rule_set_reloads_in_the_background(tmp_path, monkeypatch):
+    rules = tmp_path / "rules.txt"
+    rules.write_text("urgent\n", encoding="utf-8")
+    rule_set = KeywordRuleSet(str(rules), [], check_interval=0)
+    assert rule_set.automaton.keywords == ["urgent"]
+
+    rules.write_text("urgent\nbank details\n", encoding="utf-8")
+    os.utime(rules, (time.time() + 5, time.time() + 5))
+    built = threading.Event()
+    build = keyword_automaton.KeywordAutomaton
+
+    def slow_build(keywords):
+        time.sleep(0.2)  # a large rule set
+        automaton = build(keywords)
+        built.set()
+        return automaton
+
+    monkeypatch.setattr(keyword_automaton, "KeywordAutomaton", slow_build)
+    started = time.perf_counter()
+    current = rule_set.automaton
+    # The caller gets the previous automaton straight away instead of waiting for the rebuild.
+    assert time.perf_counter() - started < 0.1
+    assert current.keywords == ["urgent"]
+    assert built.wait(2)
+    for _ in range(50):
+        if rule_set.automaton.keywords == ["urgent", "bank details"]:
+            break
+        time.sleep(0.01)
+    assert rule_set.automaton.keywords == ["urgent", "bank details"]
@@ -0,0 +1,129 @@
+# tests/test_llm_resilience.py
+import asyncio
+
+import pytest
+
+import llm_resilience
+from llm_client import FakeLLMClient
+from llm_resilience import (
+    CircuitBreaker,
+    LLMCircuitOpenError,
+    LLMDeadlineExceededError,
+    LLMTimeoutError,
+    LLMUnavailableError,
+    get_breaker,
+    llm_deadline,
+)
+from llm_scheduler import LLMScheduler, llm_call_class, set_llm_scheduler
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(llm_resilience, "_breakers", {})
+    set_llm_scheduler(LLMScheduler(rate_per_second=0))
+
+
+def test_breaker_opens_after_consecutive_failures_and_probe_closes_it():
+    breaker = CircuitBreaker("model/test", failure_threshold=3, reset_seconds=0)
+    for _ in range(3):
+        breaker.before_call()
+        breaker.record_error(LLMTimeoutError("timed out"))
+    assert breaker.state == "open"
+
+    breaker.before_call()  # the reset period has passed: this is the probe
+    assert breaker.state == "half_open"
+    with pytest.raises(LLMCircuitOpenError):
+        breaker.before_call()  # only one probe at a time
+    breaker.record_success(0.01)
+    assert breaker.state == "closed"
+
+
+def test_hung_backend_opens_the_breaker_under_a_short_deadline():
+    # The intent deadline is far below the client timeout, so a hung backend
+    # only ever shows up as deadline expiries; those must still open the
+    # breaker of their class, and only that one.
+    hung = FakeLLMClient("model-a", latency_ms=2000)
+    healthy = FakeLLMClient("model-a", latency_ms=1)
+
+    async def run():
+        for _ in range(llm_resilience.LLM_BREAKER_FAILURES):
+            with llm_call_class("intent"), llm_deadline(0.05):
+                with pytest.raises(LLMDeadlineExceededError):
+                    await hung.generate("prompt")
+        with llm_call_class("intent"), llm_deadline(0.05), pytest.raises(LLMCircuitOpenError):
+            await hung.generate("prompt")
+        with llm_call_class("finalize"), llm_deadline(60):
+            return await healthy.generate("prompt")
+
+    assert asyncio.run(run())
+    assert hung.calls == llm_resilience.LLM_BREAKER_FAILURES
+    assert get_breaker("model-a", "intent").state == "open"
+    assert get_breaker("model-a", "finalize").state == "closed"
+
+
+def test_deadline_spent_waiting_for_a_slot_does_not_count():
+    client = FakeLLMClient("model-e", latency_ms=1)
+    scheduler = LLMScheduler(rate_per_second=0, max_concurrency=1)
+    set_llm_scheduler(scheduler)
+
+    async def run():
+        async with scheduler.slot():  # the model is busy; the calls below only queue
+            for _ in range(llm_resilience.LLM_BREAKER_FAILURES + 1):
+                with llm_call_class("intent"), llm_deadline(0.02):
+                    with pytest.raises(LLMUnavailableError):
+                        await client.generate("prompt")
+
+    asyncio.run(run())
+    assert client.calls == 0
+    assert get_breaker("model-e", "intent").state == "closed"
+
+
+def test_client_timeouts_open_only_the_breaker_of_their_class():
+    client = FakeLLMClient("model-b", latency_ms=200, timeout=0.02)
+    fast = FakeLLMClient("model-b", latency_ms=1)
+
+    async def run():
+        for _ in range(llm_resilience.LLM_BREAKER_FAILURES):
+            with llm_call_class("intent"):
+                with pytest.raises(LLMTimeoutError) as raised:
+                    await client.generate("prompt")
+                assert not isinstance(raised.value, LLMDeadlineExceededError)
+        with llm_call_class("intent"), pytest.raises(LLMCircuitOpenError):
+            await fast.generate("prompt")
+        with llm_call_class("finalize"):
+            return await fast.generate("prompt")
+
+    assert asyncio.run(run())
+    assert get_breaker("model-b", "intent").state == "open"
+    assert get_breaker("model-b", "finalize").state == "closed"
+
+
+def test_expired_deadline_fails_before_calling_the_model():
+    client = FakeLLMClient("model-c", latency_ms=1)
+
+    async def run():
+        with llm_deadline(-1):
+            await client.generate("prompt")
+
+    with pytest.raises(LLMDeadlineExceededError):
+        asyncio.run(run())
+    assert client.calls == 0
+    assert get_breaker("model-c").failures == 0
+
+
+def test_slow_call_is_hedged(monkeypatch):
+    monkeypatch.setattr(llm_resilience, "LLM_HEDGE_MIN_SAMPLES", 5)
+    latencies = iter([10] * 5 + [500, 10])
+    client = FakeLLMClient("model-d", latency_ms=lambda: next(latencies))
+
+    async def run():
+        with llm_call_class("intent"):
+            for _ in range(5):
+                await client.generate("prompt")
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            await client.generate("prompt")
+            return loop.time() - started
+
+    assert asyncio.run(run()) < 0.3
+    assert client.calls == 7
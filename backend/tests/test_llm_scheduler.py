@@ -0,0 +1,87 @@
+# tests/test_llm_scheduler.py
+import asyncio
+
+import pytest
+
+from llm_resilience import llm_deadline
+from llm_scheduler import LLMOverloadedError, LLMQuotaError, LLMScheduler, llm_call_class
+
+
+def test_waiting_calls_are_served_by_priority():
+    scheduler = LLMScheduler(rate_per_second=0, max_concurrency=1)
+    order = []
+
+    async def call(name: str):
+        with llm_call_class(name):
+            async with scheduler.slot():
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+    async def run():
+        async with scheduler.slot():  # occupy the only slot while the others queue up
+            tasks = [asyncio.ensure_future(call(name)) for name in ("chat_scan", "intent", "finalize")]
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == ["finalize", "intent", "chat_scan"]
+
+
+def test_rate_limit_spaces_out_calls():
+    scheduler = LLMScheduler(rate_per_second=20, burst=1)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for _ in range(5):
+            async with scheduler.slot():
+                pass
+        return loop.time() - started
+
+    assert asyncio.run(run()) >= 0.18
+
+
+def test_full_queue_sheds_low_priority_calls_only():
+    scheduler = LLMScheduler(rate_per_second=0, max_concurrency=1, max_queue_depth=1)
+
+    async def run():
+        async with scheduler.slot():
+            waiting = asyncio.ensure_future(scheduler.acquire("dispute", 1))
+            await asyncio.sleep(0)
+            with pytest.raises(LLMOverloadedError):
+                await scheduler.acquire("chat_scan", 3)
+            urgent = asyncio.ensure_future(scheduler.acquire("finalize", 0))
+            await asyncio.sleep(0)
+        await urgent
+        scheduler.release("finalize")
+        await waiting
+        scheduler.release("dispute")
+
+    asyncio.run(run())
+
+
+def test_queue_wait_respects_the_deadline():
+    scheduler = LLMScheduler(rate_per_second=0, max_concurrency=1, queue_timeout=10)
+
+    async def run():
+        async with scheduler.slot():
+            with llm_deadline(0.05), pytest.raises(LLMOverloadedError):
+                await scheduler.acquire("intent", 2)
+        assert scheduler.depth == 0
+
+    asyncio.run(run())
+
+
+def test_quota_error_pauses_the_bucket():
+    class ResourceExhausted(Exception):
+        pass
+
+    scheduler = LLMScheduler(rate_per_second=100, burst=5)
+
+    async def run():
+        with pytest.raises(LLMQuotaError):
+            async with scheduler.slot():
+                raise ResourceExhausted("429 quota exceeded")
+        return scheduler.degraded
+
+    assert asyncio.run(run()) is True
@@ -0,0 +1,72 @@
+# tests/test_model_cascade.py
+import json
+import asyncio
+
+import pytest
+
+import llm_client
+import llm_resilience
+from llm_client import FakeLLMClient, set_llm_client
+from llm_scheduler import LLMOverloadedError, LLMScheduler, set_llm_scheduler
+from model_cascade import ModelCascade
+
+
+@pytest.fixture
+def models(monkeypatch):
+    monkeypatch.setattr(llm_client, "_clients", {})
+    monkeypatch.setattr(llm_resilience, "_breakers", {})
+    set_llm_scheduler(LLMScheduler(rate_per_second=0))
+
+    def install(fast_confidence, strong_confidence=0.95):
+        fast = FakeLLMClient("fast", latency_ms=1, response=json.dumps({"status": "approved", "confidence": fast_confidence}))
+        strong = FakeLLMClient("strong", latency_ms=1, response=json.dumps({"status": "rejected", "confidence": strong_confidence}))
+        set_llm_client("fast", fast)
+        set_llm_client("strong", strong)
+        return fast, strong, ModelCascade("test", "strong", fast_model="fast", strong_model="strong", enabled=True)
+
+    return install
+
+
+def test_confident_fast_answer_is_used(models):
+    fast, strong, cascade = models(0.9)
+    result = asyncio.run(cascade.generate("prompt", json.loads, "buyer_not_paid", 10))
+    assert (result["model_tier"], result["status"]) == ("fast", "approved")
+    assert strong.calls == 0
+
+
+def test_uncertain_fast_answer_escalates(models):
+    fast, strong, cascade = models(0.4)
+    result = asyncio.run(cascade.generate("prompt", json.loads, "buyer_not_paid", 10))
+    assert (result["model_tier"], result["status"]) == ("strong", "rejected")
+    assert (fast.calls, strong.calls) == (1, 1)
+
+
+def test_high_value_case_skips_fast_tier(models):
+    fast, strong, cascade = models(0.9)
+    result = asyncio.run(cascade.generate("prompt", json.loads, "buyer_not_paid", 10 ** 6))
+    assert result["model_tier"] == "strong"
+    assert fast.calls == 0
+
+
+def test_failed_fast_call_escalates(models, monkeypatch):
+    fast, strong, cascade = models(0.9)
+
+    async def fail(*args):
+        raise RuntimeError("backend error")
+
+    monkeypatch.setattr(fast, "generate", fail)
+    result = asyncio.run(cascade.generate("prompt", json.loads, "buyer_not_paid", 10))
+    assert result["model_tier"] == "strong"
+    assert strong.calls == 1
+
+
+def test_shed_call_is_not_escalated(models, monkeypatch):
+    fast, strong, cascade = models(0.9)
+
+    async def shed(*args):
+        raise LLMOverloadedError("queue full")
+
+    monkeypatch.setattr(fast, "generate", shed)
+    with pytest.raises(LLMOverloadedError):
+        asyncio.run(cascade.generate("prompt", json.loads, "buyer_not_paid", 10))
+    assert strong.calls == 0
@@ -0,0 +1,83 @@
+# tests/test_singleflight.py
+import uuid
+import asyncio
+import datetime
+
+import db
+import singleflight
+from singleflight import DatabaseSingleFlight, SingleFlight, _get_result, _save_result
+
+
+def test_concurrent_calls_share_one_computation():
+    flight = SingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"value": 42}
+
+    async def run():
+        return await asyncio.gather(*(flight.do("key", compute) for _ in range(5)))
+
+    assert asyncio.run(run()) == [{"value": 42}] * 5
+    assert len(calls) == 1
+    assert flight._inflight == {}
+
+
+def test_memo_is_bounded():
+    flight = SingleFlight(memo_size=2)
+
+    async def run():
+        for key in ("a", "b", "c"):
+            await flight.do(key, lambda: asyncio.sleep(0, key))
+
+    asyncio.run(run())
+    assert list(flight._memo) == ["b", "c"]
+
+
+def test_database_results_expire(monkeypatch):
+    db.init_db()
+    old_key, new_key = f"old-{uuid.uuid4().hex}", f"new-{uuid.uuid4().hex}"
+    monkeypatch.setattr(singleflight, "_next_purge", 0.0)
+
+    async def run():
+        await _save_result(old_key, '"old"')
+        session = db.SessionLocal()
+        try:
+            row = session.get(db.SingleFlightResultDB, old_key)
+            row.created_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=singleflight.SINGLEFLIGHT_RESULT_TTL_SECONDS + 1)
+            session.commit()
+        finally:
+            session.close()
+        expired = await _get_result(old_key)
+        monkeypatch.setattr(singleflight, "_next_purge", 0.0)
+        await _save_result(new_key, '"new"')
+        return expired, await _get_result(new_key)
+
+    assert asyncio.run(run()) == (None, '"new"')
+    session = db.SessionLocal()
+    try:
+        assert session.get(db.SingleFlightResultDB, old_key) is None
+    finally:
+        session.close()
+
+
+def test_database_flight_publishes_result():
+    db.init_db()
+    flight = DatabaseSingleFlight(name="test")
+    key = f"flight-{uuid.uuid4().hex}"
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return {"value": 1}
+
+    async def run():
+        first = await flight.do(key, compute)
+        # A second process would find the published result instead of computing.
+        second = await DatabaseSingleFlight(name="test").do(key, compute)
+        return first, second
+
+    assert asyncio.run(run()) == ({"value": 1}, {"value": 1})
+    assert len(calls) == 1
@@ -4,6 +4,7 @@ from fastapi.middleware.cors import CORSMiddleware
 import google.generativeai as genai
 import json
 from dotenv import load_dotenv
+from intent_prefilter import PLATFORM_SWITCH_EXAMPLES
 
 load_dotenv()
 
@@ -27,58 +28,16 @@ def configure_model():
   )
 
 def build_prompt():
+    examples = "\n".join(f'* "{example}"' for example in PLATFORM_SWITCH_EXAMPLES)
     return """Analyze the following text and determine if the user is attempting to leave the platform.  Look for phrases suggesting a switch to another communication channel, even subtle indications or indirect suggestions. Consider slang, informal language, and Gen Z slang. Pay close attention to any expression of inconvenience with the current platform or preference for another.
 
 Examples of phrases indicating a platform switch intent:
 
-* "Let's continue on WhatsApp"
-* "Do you have Insta?"
-* "We can talk on Telegram"
-* "Let's move to Messenger"
-* "Switch to Signal"
-* "Continue on WeChat"
-* "Talk on Viber"
-* "Hit me up on WhatsApp"
-* "My Insta is..."
-* "Text me on Telegram"
-* "DM me on Messenger"
-* "Let's chat on Signal"
-* "Add me on WeChat"
-* "My Viber is..."
-* "WhatsApp me!"
-* "Let's use Insta instead"
-* "I'm on Telegram now"
-* "Slide into my DMs on Insta"
-* "Hit me up on my WhatsApp"
-* "My Snapchat is..."
-* "Let's chat on Snap"
-* "What's your Insta?"
-* "Let's connect on TikTok"
-* "My TikTok is..."
-* "I'm bouta head to Insta"
-* "Bet, hmu on WhatsApp"
-* "Let's take this convo to Insta"
-* "This platform is kinda slow"
-* "I prefer chatting on WhatsApp"
-* "Is there a way to continue this on Telegram?"
-* "WhatsApp is easier for me"
-* "I find this platform less convenient"
-* "Let's chat on WhatsApp Business"
-* "My number is..."
-* "Call me on..."
-* "Let's connect on Facebook"
-* "Check my Instagram"
-* "My Telegram is..."
-* "Let's use Telegram instead"
-* "I'm on Imo now"
-* "Let's chat on Imo"
-* "My Imo is..."
-* "Let's use 2go"
-* "My 2go is..."
+{examples}
 
 
 Return a JSON object with a "platform_switch_intent" field (boolean, true if a switch is indicated, false otherwise) and a "text" field containing the original text.
-"""
+""".format(examples=examples)
 
 @app.post("/analyze_text")
 async def analyze_text(text: str):
@@ -1,16 +1,17 @@
 import os
-import vertexai
+import asyncio
+import hashlib
 
-from vertexai.generative_models import GenerativeModel, Part
-from dotenv import load_dotenv
+from llm_client import get_llm_client
+from llm_scheduler import llm_call_class
+from db import get_content_hash_for_uri, get_cached_video_analysis, save_video_analysis
+import metrics
 
-load_dotenv()
+VIDEO_MODEL_NAME = "gemini-2.0-flash-001"
+vision_model = get_llm_client(VIDEO_MODEL_NAME)
 
-PROJECT_ID = os.environ.get("PROJECT_ID")
-
-vertexai.init(project=PROJECT_ID, location="us-central1")
-
-vision_model = GenerativeModel("gemini-2.0-flash-001")
+# Video analysis is much slower than text prompts, so it gets its own timeout.
+VIDEO_ANALYSIS_TIMEOUT_SECONDS = float(os.getenv("VIDEO_ANALYSIS_TIMEOUT_SECONDS", "180"))
 
 # Generate text
 # response = vision_model.generate_content(
@@ -25,21 +26,53 @@ vision_model = GenerativeModel("gemini-2.0-flash-001")
 #     ]
 # )
 
-def analyze_video(gcs_uri: str):
-    response = vision_model.generate_content(
-        [
-            Part.from_uri(gcs_uri, mime_type="video/mp4"),
-            """You are a fraud detection expert. Your task is to:
+VIDEO_ANALYSIS_PROMPT = """You are a fraud detection expert. Your task is to:
         1) Extract important details like bank account information to help next steps in verification that the user made the right transfer to the right account.
         2) Analyse the behaviours and actions of the individual in the video to detect any suspicious activity.
-        3) Respond concisely with the required information from the video.""",
-        ]
-    )
-    return response.text
+        3) Respond concisely with the required information from the video."""
+
+# Cached results are keyed on this, so editing the prompt invalidates them.
+VIDEO_ANALYSIS_PROMPT_VERSION = hashlib.sha256(VIDEO_ANALYSIS_PROMPT.encode()).hexdigest()[:12]
+
+async def analyze_video(gcs_uri: str, content_hash: str = None):
+    """
+    Analyzes a video with the vision model.
+
+    Results are cached by the video's content hash plus the model and prompt
+    version, so the same recording submitted again (under any URI) is answered
+    from the cache. If `content_hash` is not given it is looked up from the
+    stored evidence; without one the video is analyzed uncached.
+    """
+    loop = asyncio.get_running_loop()
+    if content_hash is None:
+        content_hash = await loop.run_in_executor(None, get_content_hash_for_uri, gcs_uri)
+
+    if content_hash:
+        cached = await loop.run_in_executor(
+            None, get_cached_video_analysis, content_hash, VIDEO_MODEL_NAME, VIDEO_ANALYSIS_PROMPT_VERSION
+        )
+        if cached is not None:
+            metrics.incr("video_analysis.cache.hit")
+            return cached
+        metrics.incr("video_analysis.cache.miss")
+
+    with llm_call_class("video"):
+        result = await vision_model.generate(
+            [
+                vision_model.video_part(gcs_uri, mime_type="video/mp4"),
+                VIDEO_ANALYSIS_PROMPT,
+            ],
+            timeout=VIDEO_ANALYSIS_TIMEOUT_SECONDS,
+        )
+    if content_hash:
+        await loop.run_in_executor(
+            None, save_video_analysis, content_hash, VIDEO_MODEL_NAME, VIDEO_ANALYSIS_PROMPT_VERSION, result
+        )
+    return result
 
 if __name__ == "__main__":
     # For testing: replace with the URI returned from your upload endpoint.
     gcs_uri = "gs://your-bucket-name/uploads/videos/animals.mp4"
-    analysis = analyze_video(gcs_uri)
+    analysis = asyncio.run(analyze_video(gcs_uri))
     print(analysis)
 
@@ -0,0 +1,40 @@
+# worker.py
+"""
+Standalone background job worker.
+
+Runs the job worker pool in its own process so slow AI work does not take
+request capacity from the API. Start as many of these as needed:
+
+    python worker.py --concurrency 4
+
+and set JOB_WORKERS_IN_PROCESS=0 for the API so it only enqueues jobs.
+"""
+import argparse
+import asyncio
+import signal
+
+from db import init_db
+from job_queue import JobWorkerPool, JOB_POLL_INTERVAL_SECONDS
+import job_handlers  # noqa: F401  (registers the job handlers)
+
+
+async def run(concurrency: int, poll_interval: float):
+    pool = JobWorkerPool(concurrency, poll_interval)
+    pool.start()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    print(f"Job worker {pool.worker_prefix} started with {concurrency} workers.")
+    await stop.wait()
+    await pool.stop()
+    print(f"Job worker {pool.worker_prefix} stopped.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run background job workers.")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of concurrent jobs")
+    parser.add_argument("--poll-interval", type=float, default=JOB_POLL_INTERVAL_SECONDS)
+    args = parser.parse_args()
+    init_db()
+    asyncio.run(run(args.concurrency, args.poll_interval))